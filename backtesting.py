@@ -0,0 +1,303 @@
+'''
+This module backtests the Prophet model with cross-validation folds that are
+fitted in parallel across a process pool. Every fold's predictions are cached on
+disk under a key built from the training data, the hyperparameters and the cutoff,
+so re-runs only fit new cutoffs.
+'''
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+import pandas as pd
+try:
+    from prophet.diagnostics import generate_cutoffs
+    from prophet.diagnostics import performance_metrics
+except ImportError: # Prophet was published as fbprophet before version 1.0
+    from fbprophet.diagnostics import generate_cutoffs
+    from fbprophet.diagnostics import performance_metrics
+import baselines
+import model_registry
+import phase_calendar
+import prophet_model
+
+# Directory holding the cached fold predictions
+CACHE_DIR = 'cv_cache'
+
+# Metrics reported by performance_metrics
+DEFAULT_METRICS = ['mae', 'rmse', 'mape', 'coverage']
+
+
+def fold_key(digest, calendar, hyperparameters, cutoff, horizon, engine='prophet'):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A helper function that builds the cache key of one fold.
+
+    Parameters
+    ----------
+    digest : The fingerprint of the training data.
+    calendar : The compiled phase calendar.
+    hyperparameters : The complete hyperparameter dictionary.
+    cutoff : The last training date of the fold.
+    horizon : The forecast horizon as a timedelta.
+    engine : 'prophet' or the name of a baseline engine.
+
+    Returns
+    -------
+    The hex digest identifying the fold.
+    '''
+    fold = {'data': digest,
+            'phases': calendar['phases'],
+            'seasonality_phases': calendar['seasonality_phases'],
+            'hyperparameters': hyperparameters,
+            'cutoff': str(cutoff),
+            'horizon': str(horizon)}
+
+    # Prophet folds keep the keys they were cached under before baselines existed, and
+    # baseline folds cached with intervals of the daily mean's residuals are not reused
+    if engine != 'prophet':
+        fold['engine'] = engine
+        fold['interval_quantiles'] = baselines.INTERVAL_QUANTILES
+
+    return hashlib.sha256(json.dumps(fold, sort_keys=True).encode()).hexdigest()
+
+
+def fit_fold(task):
+    '''
+    A function that fits a model on the history up to a cutoff and predicts the
+    horizon after it.
+
+    Parameters
+    ----------
+    task : A tuple of the prepared training data, the cutoff, the horizon, the phase
+    calendar, the hyperparameters and the engine.
+
+    Returns
+    -------
+    The cutoff and a dataframe with ds, yhat, yhat_lower, yhat_upper, y and cutoff
+    columns, as returned by Prophet's cross_validation.
+    '''
+    dataframe, cutoff, horizon, calendar, hyperparameters, engine = task
+
+    history = dataframe[dataframe.ds <= cutoff]
+    horizon_data = dataframe[(dataframe.ds > cutoff) & (dataframe.ds <= cutoff + horizon)]
+
+    if engine == 'prophet':
+        prophet = prophet_model.build_prophet_model(calendar, hyperparameters)
+        prophet.fit(history)
+        predictions = prophet.predict(horizon_data.drop(['y'], axis=1))
+    else:
+        predictions = baselines.forecast_rows(history, horizon_data, engine, calendar,
+                                              hyperparameters)
+
+    fold = predictions[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].copy()
+    fold['y'] = horizon_data['y'].values
+    fold['cutoff'] = cutoff
+
+    return cutoff, fold
+
+
+def add_fold_to_totals(totals, fold):
+    '''
+    A helper function that adds one fold's errors to running metric totals.
+
+    Parameters
+    ----------
+    totals : A dictionary of running sums (updated in place).
+    fold : A fold dataframe with y, yhat, yhat_lower and yhat_upper columns.
+    '''
+    errors = fold['y'] - fold['yhat']
+    nonzero = fold['y'] != 0
+
+    totals['count'] = totals.get('count', 0) + len(fold)
+    totals['absolute_error'] = totals.get('absolute_error', 0) + errors.abs().sum()
+    totals['squared_error'] = totals.get('squared_error', 0) + (errors ** 2).sum()
+    totals['percentage_error'] = totals.get('percentage_error', 0) + (
+        errors[nonzero] / fold['y'][nonzero]).abs().sum()
+    totals['nonzero_count'] = totals.get('nonzero_count', 0) + nonzero.sum()
+    totals['covered'] = totals.get('covered', 0) + (
+        (fold['y'] >= fold['yhat_lower']) & (fold['y'] <= fold['yhat_upper'])).sum()
+
+
+def summarize_totals(totals):
+    '''
+    A helper function that turns running metric totals into overall metrics.
+
+    Parameters
+    ----------
+    totals : A dictionary of running sums from add_fold_to_totals.
+
+    Returns
+    -------
+    A dictionary with the overall mae, rmse, mape and coverage.
+    '''
+    return {'mae': totals['absolute_error'] / totals['count'],
+            'rmse': np.sqrt(totals['squared_error'] / totals['count']),
+            'mape': totals['percentage_error'] / max(totals['nonzero_count'], 1),
+            'coverage': totals['covered'] / totals['count']}
+
+
+def prepare_backtest_data(dataframe, calendar=None):
+    '''
+    A helper function that prepares the history that is backtested: the Prophet
+    training columns for every day before the forecast window.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    A dataframe with ds, y and condition columns.
+    '''
+    prepared = prophet_model.prepare_training_data(dataframe, calendar)
+
+    return prepared[prepared.ds < prophet_model.FORECAST_START]
+
+
+def backtest_cutoffs(dataframe, initial='730 days', period='180 days', horizon='122 days',
+                     calendar=None):
+    '''
+    A function that lists the cutoffs backtest evaluates by default.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    initial, period, horizon : Cross-validation windows, as in Prophet's cross_validation.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    A list of cutoff timestamps in ascending order.
+    '''
+    return list(generate_cutoffs(prepare_backtest_data(dataframe, calendar), pd.Timedelta(horizon),
+                                 pd.Timedelta(initial), pd.Timedelta(period)))
+
+
+def backtest_candidates(dataframe, candidates, initial='730 days', period='180 days',
+                        horizon='122 days', calendar=None, max_workers=None, cache_dir=CACHE_DIR,
+                        metrics=None, cutoffs=None, engine='prophet'):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    '''
+    A function that cross-validates several hyperparameter candidates on the same
+    cutoffs. The uncached folds of every candidate are submitted to one process
+    pool, so workers stay busy across candidates instead of idling while the pool
+    of each candidate drains. Metrics are aggregated as each fold completes.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    candidates : A list of hyperparameter dictionaries, completed with
+    prophet_model.DEFAULT_HYPERPARAMETERS, or with baseline settings for a baseline engine.
+    initial, period, horizon : Cross-validation windows, as in Prophet's cross_validation.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    max_workers : The number of worker processes (defaults to the number of CPUs).
+    cache_dir : The directory holding cached folds (None disables caching).
+    metrics : The metrics computed by performance_metrics (defaults to DEFAULT_METRICS).
+    cutoffs : Specific cutoffs to evaluate (defaults to Prophet's generated cutoffs).
+    engine : 'prophet' or a baseline engine ('seasonal_naive', 'exponential_smoothing'
+    or 'ridge').
+
+    Returns
+    -------
+    A list with, for every candidate, a cross validated results dataframe, a
+    performance metrics dataframe by horizon and a dataframe of overall metrics
+    after each completed fold.
+    '''
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+    defaults = (prophet_model.DEFAULT_HYPERPARAMETERS if engine == 'prophet'
+                else baselines.BASELINE_HYPERPARAMETERS)
+    candidates = [dict(defaults, **(hyperparameters or {})) for hyperparameters in candidates]
+    horizon = pd.Timedelta(horizon)
+
+    # Only the history before the forecast window is backtested
+    prepared = prepare_backtest_data(dataframe, calendar)
+
+    if cutoffs is None:
+        cutoffs = generate_cutoffs(prepared, horizon, pd.Timedelta(initial), pd.Timedelta(period))
+    digest = model_registry.data_hash(prepared[['ds', 'y']])
+
+    # Load cached folds and collect the ones that still need fitting
+    folds = [{} for _ in candidates]
+    totals = [{} for _ in candidates]
+    progress = [[] for _ in candidates]
+    pending = []
+    for index, hyperparameters in enumerate(candidates):
+        for cutoff in cutoffs:
+            key = fold_key(digest, calendar, hyperparameters, cutoff, horizon, engine)
+            path = os.path.join(cache_dir, key + '.pkl') if cache_dir else None
+            if path and os.path.exists(path):
+                folds[index][cutoff] = pd.read_pickle(path)
+            else:
+                pending.append((index, cutoff, path))
+
+        for cutoff in sorted(folds[index]):
+            add_fold_to_totals(totals[index], folds[index][cutoff])
+            progress[index].append(dict(summarize_totals(totals[index]), cutoff=cutoff,
+                                        cached=True))
+
+    if pending:
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=prophet_model.WORKER_CONTEXT,
+                                 initializer=prophet_model.init_forecasting_worker) as executor:
+            futures = {executor.submit(fit_fold, (prepared, cutoff, horizon, calendar,
+                                                  candidates[index], engine)): (index, path)
+                       for index, cutoff, path in pending}
+            for future in as_completed(futures):
+                index, path = futures[future]
+                cutoff, fold = future.result()
+                folds[index][cutoff] = fold
+                if path:
+                    with open(path, 'wb') as file:
+                        pickle.dump(fold, file)
+
+                add_fold_to_totals(totals[index], fold)
+                progress[index].append(dict(summarize_totals(totals[index]), cutoff=cutoff,
+                                            cached=False))
+
+    results = []
+    for index in range(len(candidates)):
+        cv_results = pd.concat([folds[index][cutoff] for cutoff in sorted(folds[index])],
+                               ignore_index=True)
+        results.append((cv_results,
+                        performance_metrics(cv_results, metrics=list(metrics or DEFAULT_METRICS)),
+                        pd.DataFrame(progress[index])))
+
+    return results
+
+
+def backtest(dataframe, initial='730 days', period='180 days', horizon='122 days',
+             calendar=None, hyperparameters=None, max_workers=None, cache_dir=CACHE_DIR,
+             metrics=None, cutoffs=None, engine='prophet'):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that cross-validates the Prophet model with folds fitted in parallel.
+    Folds already in the cache are loaded instead of fitted, and metrics are
+    aggregated as each fold completes.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    initial, period, horizon : Cross-validation windows, as in Prophet's cross_validation.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    prophet_model.DEFAULT_HYPERPARAMETERS), or of baseline settings for a baseline engine.
+    max_workers : The number of worker processes (defaults to the number of CPUs).
+    cache_dir : The directory holding cached folds (None disables caching).
+    metrics : The metrics computed by performance_metrics (defaults to DEFAULT_METRICS).
+    cutoffs : Specific cutoffs to evaluate (defaults to Prophet's generated cutoffs).
+    engine : 'prophet' or a baseline engine ('seasonal_naive', 'exponential_smoothing'
+    or 'ridge').
+
+    Returns
+    -------
+    A cross validated results dataframe, a performance metrics dataframe by horizon
+    and a dataframe of overall metrics after each completed fold.
+    '''
+    return backtest_candidates(dataframe, [hyperparameters], initial, period, horizon, calendar,
+                               max_workers, cache_dir, metrics, cutoffs, engine)[0]
@@ -0,0 +1,355 @@
+'''
+This module is a lightweight alternative to the Prophet engine. Seasonal-naive,
+exponential smoothing and ridge regression on Fourier and Covid phase features are
+written as batched NumPy operations over a matrix with one column per series, so
+every station is fitted at once as a single matrix problem.
+'''
+import time
+import numpy as np
+import pandas as pd
+import hierarchy
+import phase_calendar
+import prophet_model
+import storage
+
+# Settings of the baseline engines
+BASELINE_HYPERPARAMETERS = {'season_length': 7,
+                            'smoothing_level': 0.2,
+                            'smoothing_seasonal': 0.1,
+                            'ridge_penalty': 1.0,
+                            'weekly_fourier_order': 3,
+                            'yearly_fourier_order': 5}
+
+# Normal quantile of an 80% interval, Prophet's default interval width, and the
+# residual quantiles bounding the same interval
+INTERVAL_Z = 1.2815515655446004
+INTERVAL_QUANTILES = [0.1, 0.9]
+
+
+def fourier_features(days, period, order):
+    '''
+    A helper function that computes sine and cosine terms of the days since the epoch.
+
+    Parameters
+    ----------
+    days : A numpy datetime64[D] array.
+    period : The period in days.
+    order : The number of sine and cosine pairs.
+
+    Returns
+    -------
+    An array with one row per day and 2 * order columns.
+    '''
+    t = days.astype('int64').astype(float)[:, None]
+    angles = 2 * np.pi * np.arange(1, order + 1) * t / period
+
+    return np.hstack([np.sin(angles), np.cos(angles)])
+
+
+def design_matrix(days, first_day, calendar, hyperparameters):
+    '''
+    A helper function that builds the ridge regression features: an intercept, a
+    linear trend, a Covid level and a level per phase, a weekly seasonality before
+    and during Covid, and a yearly seasonality per modelled phase condition, as in
+    the Prophet model.
+
+    Parameters
+    ----------
+    days : A numpy datetime64[D] array.
+    first_day : The first training day, where the trend starts.
+    calendar : A compiled phase calendar.
+    hyperparameters : The baseline hyperparameter dictionary.
+
+    Returns
+    -------
+    An array with one row per day.
+    '''
+    indicators = phase_calendar.phase_indicators(days, calendar)
+    weekly = fourier_features(days, 7, hyperparameters['weekly_fourier_order'])
+    yearly = fourier_features(days, 365.25, hyperparameters['yearly_fourier_order'])
+
+    columns = [np.ones((len(days), 1)),
+               ((days - first_day).astype('int64') / 365.25)[:, None],
+               indicators[['covid'] + [name for name, _, _ in calendar['phases']]].values]
+    for condition in ['covid', 'precovid']:
+        columns.append(weekly * indicators[[condition]].values)
+    for condition in prophet_model.phase_conditions(calendar)[2:]:
+        columns.append(yearly * indicators[[condition]].values)
+
+    return np.hstack(columns).astype(float)
+
+
+def seasonal_naive(days, rides, future_days, calendar, hyperparameters):
+    # pylint: disable=unused-argument
+    '''
+    A function that repeats the last season of every series.
+
+    Parameters
+    ----------
+    days : The training days as a datetime64[D] array.
+    rides : An array of daily rides with one column per series.
+    future_days : The forecast days as a datetime64[D] array.
+    calendar : A compiled phase calendar (unused).
+    hyperparameters : The baseline hyperparameter dictionary.
+
+    Returns
+    -------
+    An array of forecasts and an array of in-sample fitted values (NaN where
+    undefined), both with one column per series.
+    '''
+    season_length = hyperparameters['season_length']
+    steps = (future_days - days[-1]).astype('int64') - 1
+    yhat = rides[len(rides) - season_length + steps % season_length]
+    fitted = np.full(rides.shape, np.nan)
+    fitted[season_length:] = rides[:-season_length]
+
+    return yhat, fitted
+
+
+def exponential_smoothing(days, rides, future_days, calendar, hyperparameters):
+    # pylint: disable=unused-argument
+    '''
+    A function that fits additive exponential smoothing with a level and a seasonal
+    component to every series at once, stepping through the days once.
+
+    Parameters
+    ----------
+    days : The training days as a datetime64[D] array.
+    rides : An array of daily rides with one column per series.
+    future_days : The forecast days as a datetime64[D] array.
+    calendar : A compiled phase calendar (unused).
+    hyperparameters : The baseline hyperparameter dictionary.
+
+    Returns
+    -------
+    An array of forecasts and an array of in-sample fitted values (NaN where
+    undefined), both with one column per series.
+    '''
+    season_length = hyperparameters['season_length']
+    alpha = hyperparameters['smoothing_level']
+    gamma = hyperparameters['smoothing_seasonal']
+
+    level = rides[:season_length].mean(axis=0)
+    seasonal = rides[:season_length] - level
+    fitted = np.full(rides.shape, np.nan)
+    for step in range(season_length, len(rides)):
+        season = step % season_length
+        fitted[step] = level + seasonal[season]
+        error = rides[step] - fitted[step]
+        level = level + alpha * error
+        seasonal[season] = seasonal[season] + gamma * (1 - alpha) * error
+
+    steps = len(rides) + (future_days - days[-1]).astype('int64') - 1
+
+    return level + seasonal[steps % season_length], fitted
+
+
+def ridge(days, rides, future_days, calendar, hyperparameters):
+    '''
+    A function that fits a ridge regression on Fourier and Covid phase features to
+    every series with a single linear solve.
+
+    Parameters
+    ----------
+    days : The training days as a datetime64[D] array.
+    rides : An array of daily rides with one column per series.
+    future_days : The forecast days as a datetime64[D] array.
+    calendar : A compiled phase calendar.
+    hyperparameters : The baseline hyperparameter dictionary.
+
+    Returns
+    -------
+    An array of forecasts and an array of in-sample fitted values (NaN where
+    undefined), both with one column per series.
+    '''
+    features = design_matrix(days, days[0], calendar, hyperparameters)
+
+    # The intercept is not penalized
+    penalty = np.full(features.shape[1], hyperparameters['ridge_penalty'])
+    penalty[0] = 0
+    coefficients = np.linalg.solve(features.T @ features + np.diag(penalty),
+                                   features.T @ rides)
+
+    future_features = design_matrix(future_days, days[0], calendar, hyperparameters)
+
+    return future_features @ coefficients, features @ coefficients
+
+
+ENGINES = {'seasonal_naive': seasonal_naive,
+           'exponential_smoothing': exponential_smoothing,
+           'ridge': ridge}
+
+
+def fit_matrix(rides, future_days, method='ridge', calendar=None, hyperparameters=None):
+    '''
+    A function that fits a baseline engine to every column of a daily ride matrix at once.
+
+    Parameters
+    ----------
+    rides : A dataframe of daily rides indexed by consecutive days with one column
+    per series.
+    future_days : The days to forecast, after the last training day.
+    method : 'seasonal_naive', 'exponential_smoothing' or 'ridge'.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of baseline settings (defaults to
+    BASELINE_HYPERPARAMETERS).
+
+    Returns
+    -------
+    An array of forecasts with one row per future day and an array of fitted values
+    with one row per training day, both with one column per series.
+    '''
+    if method not in ENGINES:
+        raise ValueError('Unknown baseline engine ' + method)
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+    hyperparameters = dict(BASELINE_HYPERPARAMETERS, **(hyperparameters or {}))
+
+    return ENGINES[method](
+        phase_calendar.to_days(rides.index), rides.values.astype(float),
+        phase_calendar.to_days(future_days), calendar, hyperparameters)
+
+
+def forecast_matrix(rides, future_days, method='ridge', calendar=None, hyperparameters=None):
+    '''
+    A function that forecasts every column of a daily ride matrix at once. Intervals
+    are the forecast plus or minus the 80% normal quantile of each series' residual
+    standard deviation.
+
+    Parameters
+    ----------
+    rides : A dataframe of daily rides indexed by consecutive days with one column
+    per series.
+    future_days : The days to forecast, after the last training day.
+    method : 'seasonal_naive', 'exponential_smoothing' or 'ridge'.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of baseline settings (defaults to
+    BASELINE_HYPERPARAMETERS).
+
+    Returns
+    -------
+    Arrays of yhat, yhat_lower and yhat_upper with one row per future day and one
+    column per series.
+    '''
+    yhat, fitted = fit_matrix(rides, future_days, method, calendar, hyperparameters)
+    residual_std = np.nanstd(rides.values - fitted, axis=0)
+
+    return yhat, yhat - INTERVAL_Z * residual_std, yhat + INTERVAL_Z * residual_std
+
+
+def daily_series(dataframe):
+    '''
+    A helper function that turns Prophet training rows into one value per day. Days
+    with several rows (one per station) take their mean, which is what a single model
+    fitted on every row estimates, and days without rows carry the previous value.
+
+    Parameters
+    ----------
+    dataframe : A dataframe with ds and y columns.
+
+    Returns
+    -------
+    A dataframe of the daily value indexed by consecutive days.
+    '''
+    series = dataframe.groupby('ds')['y'].mean()
+
+    return series.reindex(pd.date_range(series.index.min(), series.index.max())).ffill().to_frame()
+
+
+def forecast_rows(history, future, method='ridge', calendar=None, hyperparameters=None):
+    '''
+    A function that fits a baseline on prepared training rows and predicts the days
+    of other rows, one prediction per row like Prophet's predict. The baseline is
+    fitted on the daily mean, and since every row is scored, the interval is bounded
+    by the 10% and 90% quantiles of the training rows' residuals around the daily fit.
+
+    Parameters
+    ----------
+    history : A dataframe with ds and y columns.
+    future : A dataframe with a ds column of days after the history.
+    method : 'seasonal_naive', 'exponential_smoothing' or 'ridge'.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of baseline settings (defaults to
+    BASELINE_HYPERPARAMETERS).
+
+    Returns
+    -------
+    A forecast dataframe with ds, yhat, yhat_lower and yhat_upper for every future row.
+    '''
+    future_days = pd.DatetimeIndex(future['ds'].unique()).sort_values()
+    daily_rides = daily_series(history)
+    yhat, fitted = fit_matrix(daily_rides, future_days, method, calendar, hyperparameters)
+
+    # Residuals of every training row, not of the daily mean
+    row_fitted = fitted[daily_rides.index.get_indexer(history['ds']), 0]
+    lower, upper = np.nanquantile(history['y'].values - row_fitted, INTERVAL_QUANTILES)
+    positions = future_days.get_indexer(future['ds'])
+
+    return pd.DataFrame({'ds': future['ds'].values,
+                         'yhat': yhat[positions, 0],
+                         'yhat_lower': yhat[positions, 0] + lower,
+                         'yhat_upper': yhat[positions, 0] + upper})
+
+
+def fit_and_forecast(dataframe, method='ridge', calendar=None, hyperparameters=None):
+    '''
+    A function that fits a baseline on the daily rides before FORECAST_START and
+    predicts through FORECAST_END, like prophet_model.fit_and_forecast.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    method : 'seasonal_naive', 'exponential_smoothing' or 'ridge'.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of baseline settings (defaults to
+    BASELINE_HYPERPARAMETERS).
+
+    Returns
+    -------
+    A forecast dataframe with ds, yhat, yhat_lower and yhat_upper.
+    '''
+    dataframe = prophet_model.prepare_training_data(dataframe, calendar)
+    future = pd.DataFrame({'ds': pd.date_range(prophet_model.FORECAST_START,
+                                               prophet_model.FORECAST_END)})
+
+    return forecast_rows(dataframe[dataframe.ds < prophet_model.FORECAST_START], future, method,
+                         calendar, hyperparameters)
+
+
+def forecast_stations(daily_df_2017_to_2020, method='ridge', calendar=None,
+                      hyperparameters=None):
+    '''
+    A function that fits a baseline to every station as one matrix problem and saves
+    the results in the same consolidated table as forecasting.forecast_stations.
+
+    Parameters
+    ----------
+    daily_df_2017_to_2020 : A dataframe containing Divvy ride share data at the daily
+    level for every station.
+    method : 'seasonal_naive', 'exponential_smoothing' or 'ridge'.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of baseline settings (defaults to
+    BASELINE_HYPERPARAMETERS).
+
+    Returns
+    -------
+    The consolidated forecast dataframe and the seconds spent fitting.
+    '''
+    rides = hierarchy.station_matrix(daily_df_2017_to_2020)
+    rides = rides[rides.index < prophet_model.FORECAST_START]
+    future_days = pd.date_range(prophet_model.FORECAST_START, prophet_model.FORECAST_END)
+
+    started = time.perf_counter()
+    yhat, yhat_lower, yhat_upper = forecast_matrix(rides, future_days, method, calendar,
+                                                   hyperparameters)
+    seconds = time.perf_counter() - started
+
+    station_forecasts = pd.DataFrame({
+        'from_station_id': np.repeat(rides.columns.values, len(future_days)),
+        'ds': np.tile(future_days.values, rides.shape[1]),
+        'yhat': yhat.T.ravel(),
+        'yhat_lower': yhat_lower.T.ravel(),
+        'yhat_upper': yhat_upper.T.ravel()})
+    storage.save_dataframe(station_forecasts, storage.STATION_FORECAST_TABLE)
+
+    return station_forecasts, seconds
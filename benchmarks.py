@@ -0,0 +1,349 @@
+'''
+This script benchmarks the pipeline on synthetic Divvy trips at configurable
+sizes. Cleaning (clean_and_engineer_dataframes, or the out-of-core Polars
+backend), the phase comparison (phase_percent_change) and the city model
+(final_model) are measured for wall time, peak memory and throughput; the
+streaming extraction can be measured at sizes beyond memory against a database
+loaded chunk by chunk. Every run is saved as a JSON file so results can be
+compared run over run.
+'''
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+import clean_data
+import data_visualizations
+import forecasting
+import lazy_cleaning
+import synthetic_trips
+
+# Directory holding the result file of every run
+BENCHMARK_DIR = 'benchmarks'
+
+# Benchmarked numbers of synthetic trips
+DEFAULT_SIZES = [1000000]
+
+
+@contextlib.contextmanager
+def scratch_directory():
+    '''
+    A context manager that runs the enclosed code in a temporary working directory,
+    so the tables, models and pickles written by the benchmarked functions do not
+    replace real ones.
+    '''
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='divvy_benchmark_')
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def measure(function, number_of_rows, repeat=1, trace_memory=True):
+    '''
+    A function that times a benchmarked function and measures its peak memory.
+    Memory is traced in a separate run, since tracing slows the code down.
+
+    Parameters
+    ----------
+    function : A callable taking no arguments.
+    number_of_rows : The number of input rows, for the throughput.
+    repeat : The number of timed runs (the fastest is kept).
+    trace_memory : If True, also measure the peak memory of the Python heap,
+    including numpy and pandas buffers, in one more run.
+
+    Returns
+    -------
+    A dictionary with the seconds taken, the peak memory in megabytes (None if not
+    traced) and the rows processed per second.
+    '''
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+
+    peak_megabytes = None
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak_megabytes = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    return {'rows': number_of_rows,
+            'seconds': min(timings),
+            'peak_megabytes': peak_megabytes,
+            'rows_per_second': number_of_rows / min(timings)}
+
+
+def benchmark_cleaning(source_data, repeat=1, trace_memory=True):
+    '''
+    A function that benchmarks cleaning and saving the yearly source data.
+
+    Parameters
+    ----------
+    source_data : The 2020, 2019, 2018 and 2017 source dataframes.
+    repeat : The number of timed runs.
+    trace_memory : If True, also measure peak memory.
+
+    Returns
+    -------
+    A dictionary of measurements (see measure).
+    '''
+    with scratch_directory():
+        return measure(lambda: clean_data.clean_and_engineer_dataframes(*source_data),
+                       sum(len(yearly_data) for yearly_data in source_data), repeat, trace_memory)
+
+
+def benchmark_lazy_cleaning(source_data, repeat=1):
+    '''
+    A function that benchmarks cleaning the yearly source data out of core with the
+    Polars backend, from source rows landed as Parquet files.
+
+    Parameters
+    ----------
+    source_data : The 2020, 2019, 2018 and 2017 source dataframes.
+    repeat : The number of timed runs.
+
+    Returns
+    -------
+    A dictionary of measurements (see measure). Polars allocates outside the Python
+    heap, so peak memory is not traced.
+    '''
+    with scratch_directory():
+        sources = {}
+        for year, yearly_data in zip(clean_data.SOURCE_TABLES, source_data):
+            sources[year] = 'raw_' + str(year) + '.parquet'
+            yearly_data.to_parquet(sources[year], index=False)
+
+        return measure(lambda: lazy_cleaning.clean_out_of_core(sources),
+                       sum(len(yearly_data) for yearly_data in source_data), repeat,
+                       trace_memory=False)
+
+
+def benchmark_phase_comparison(all_data_2020, all_data_2019, repeat=1, trace_memory=True):
+    '''
+    A function that benchmarks the 2019 to 2020 comparison of every phase.
+
+    Parameters
+    ----------
+    all_data_2020 : The cleaned 2020 trips.
+    all_data_2019 : The cleaned 2019 trips.
+    repeat : The number of timed runs.
+    trace_memory : If True, also measure peak memory.
+
+    Returns
+    -------
+    A dictionary of measurements (see measure).
+    '''
+    return measure(lambda: data_visualizations.phase_percent_change(all_data_2020, all_data_2019),
+                   len(all_data_2020) + len(all_data_2019), repeat, trace_memory)
+
+
+def benchmark_final_model(daily_df_2017_to_2020, repeat=1, trace_memory=False):
+    '''
+    A function that benchmarks fitting, backtesting and registering the city model.
+
+    Parameters
+    ----------
+    daily_df_2017_to_2020 : The daily rides of every station.
+    repeat : The number of timed runs.
+    trace_memory : If True, also measure peak memory (Stan runs in its own process
+    and is not traced).
+
+    Returns
+    -------
+    A dictionary of measurements (see measure).
+    '''
+    with scratch_directory():
+        return measure(lambda: forecasting.final_model(daily_df_2017_to_2020),
+                       len(daily_df_2017_to_2020), repeat, trace_memory)
+
+
+def benchmark_streaming(number_of_rows, seed=0, chunksize=100000, database_url=None):
+    '''
+    A function that benchmarks the streaming extraction of synthetic trips loaded
+    into a database. Trips are generated and loaded in chunks, so sizes beyond
+    memory can be measured.
+
+    Parameters
+    ----------
+    number_of_rows : The number of synthetic trips.
+    seed : The seed of the trips.
+    chunksize : The number of rows read per chunk.
+    database_url : A database to load the trips into; its source tables are replaced
+    (defaults to a temporary SQLite file).
+
+    Returns
+    -------
+    A dictionary of measurements (see measure) and the seconds taken to load the trips.
+    '''
+    with scratch_directory() as directory:
+        cnx = create_engine(database_url or 'sqlite:///' + os.path.join(directory, 'divvy.db'))
+        started = time.perf_counter()
+        synthetic_trips.load_source_tables(cnx, number_of_rows, seed)
+        load_seconds = time.perf_counter() - started
+
+        result = measure(lambda: clean_data.stream_clean_and_aggregate(cnx, chunksize),
+                         number_of_rows, trace_memory=False)
+        cnx.dispose()
+
+    return dict(result, load_seconds=load_seconds)
+
+
+def benchmark_extraction(number_of_rows, seed=0, worker_counts=(1, clean_data.EXTRACT_WORKERS),
+                         database_url=None):
+    '''
+    A function that benchmarks extracting the source tables of synthetic trips
+    loaded into a database, reading one table at a time and concurrently.
+
+    Parameters
+    ----------
+    number_of_rows : The number of synthetic trips.
+    seed : The seed of the trips.
+    worker_counts : The numbers of tables read at the same time.
+    database_url : A database to load the trips into; its source tables are replaced
+    (defaults to a temporary SQLite file).
+
+    Returns
+    -------
+    A list with a dictionary of measurements (see measure) for every worker count.
+    '''
+    with scratch_directory() as directory:
+        database_url = database_url or 'sqlite:///' + os.path.join(directory, 'divvy.db')
+        cnx = create_engine(database_url)
+        synthetic_trips.load_source_tables(cnx, number_of_rows, seed)
+        cnx.dispose()
+
+        return [dict(measure(lambda workers=workers: clean_data.sql_to_dataframe(
+            database_url, max_workers=workers), number_of_rows, trace_memory=False),
+                     workers=workers) for workers in worker_counts]
+
+
+def run_benchmarks(sizes=None, seed=0, repeat=1, include_model=True, streaming_sizes=(),
+                   include_lazy=False, extraction_sizes=(), benchmark_dir=BENCHMARK_DIR):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    '''
+    A function that benchmarks every stage on synthetic trips of each size and saves
+    the results with the run's environment as a JSON file.
+
+    Parameters
+    ----------
+    sizes : The numbers of synthetic trips benchmarked in memory (defaults to
+    DEFAULT_SIZES).
+    seed : The seed of the trips.
+    repeat : The number of timed runs of every benchmark.
+    include_model : If True, also benchmark final_model on the daily rides.
+    streaming_sizes : The numbers of synthetic trips benchmarked through a database
+    with the streaming extraction, e.g. [100000000, 500000000].
+    include_lazy : If True, also benchmark the out-of-core Polars cleaning backend.
+    extraction_sizes : The numbers of synthetic trips extracted from a database with
+    sql_to_dataframe, sequentially and concurrently.
+    benchmark_dir : The directory holding the result files.
+
+    Returns
+    -------
+    A dataframe with one row per benchmark and size. This also saves the results.
+    '''
+    results = []
+    for number_of_rows in sizes or DEFAULT_SIZES:
+        source_data = synthetic_trips.synthetic_source_data(number_of_rows, seed)
+        results.append({'benchmark': 'clean_and_engineer_dataframes', 'size': number_of_rows,
+                        **benchmark_cleaning(source_data, repeat)})
+        if include_lazy:
+            results.append({'benchmark': 'clean_out_of_core', 'size': number_of_rows,
+                            **benchmark_lazy_cleaning(source_data, repeat)})
+
+        all_data_2020 = clean_data.clean_2020_dataframe(source_data[0])
+        all_data_2019 = clean_data.clean_2017_to_2019_dataframe(source_data[1])
+        results.append({'benchmark': 'phase_percent_change', 'size': number_of_rows,
+                        **benchmark_phase_comparison(all_data_2020, all_data_2019, repeat)})
+
+        if include_model:
+            daily_df_2017_to_2020 = clean_data.aggregate_daily_rides(
+                clean_data.clean_trips(*source_data))
+            results.append({'benchmark': 'final_model', 'size': number_of_rows,
+                            **benchmark_final_model(daily_df_2017_to_2020, repeat)})
+
+    for number_of_rows in streaming_sizes:
+        results.append({'benchmark': 'stream_clean_and_aggregate', 'size': number_of_rows,
+                        **benchmark_streaming(number_of_rows, seed)})
+
+    for number_of_rows in extraction_sizes:
+        for result in benchmark_extraction(number_of_rows, seed):
+            results.append(dict(result, size=number_of_rows, benchmark='sql_to_dataframe_' +
+                                str(result['workers']) + '_workers'))
+
+    run = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+           'seed': seed,
+           'environment': {'python': platform.python_version(),
+                           'pandas': pd.__version__,
+                           'numpy': np.__version__,
+                           'machine': platform.machine(),
+                           'cpus': os.cpu_count()},
+           'results': results}
+
+    os.makedirs(benchmark_dir, exist_ok=True)
+    path = os.path.join(benchmark_dir, 'benchmark_' +
+                        datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + '.json')
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(run, file, indent=2)
+
+    return pd.DataFrame(results)
+
+
+def load_results(path):
+    '''
+    A helper function that reads the results of a benchmark run.
+
+    Parameters
+    ----------
+    path : The JSON file of the run.
+
+    Returns
+    -------
+    A dataframe with one row per benchmark and size.
+    '''
+    with open(path, encoding='utf-8') as file:
+        return pd.DataFrame(json.load(file)['results'])
+
+
+def compare_runs(baseline_path, current_path):
+    '''
+    A function that compares two benchmark runs.
+
+    Parameters
+    ----------
+    baseline_path : The JSON file of the earlier run.
+    current_path : The JSON file of the later run.
+
+    Returns
+    -------
+    A dataframe with the seconds and peak memory of both runs for every benchmark
+    and size they share, and the ratio of the later to the earlier run (above 1 is
+    a regression).
+    '''
+    columns = ['benchmark', 'size', 'seconds', 'peak_megabytes']
+    comparison = pd.merge(load_results(baseline_path)[columns], load_results(current_path)[columns],
+                          on=['benchmark', 'size'], suffixes=('_baseline', '_current'))
+    comparison['seconds_ratio'] = comparison['seconds_current'] / comparison['seconds_baseline']
+    comparison['memory_ratio'] = (comparison['peak_megabytes_current'].astype(float) /
+                                  comparison['peak_megabytes_baseline'].astype(float))
+
+    return comparison
+
+
+if __name__ == '__main__':
+    print(run_benchmarks())
@@ -1,156 +1,755 @@
 '''
 This script creates a connection to a local PostgreSQL database and pulls data
 needed to forecast Divvy demand. Data is then cleaned and the resulting
-tables are saved as a csv file.
+tables are saved to the Parquet store.
 '''
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 import pandas as pd
+from pandas.io.sql import DatabaseError
+import instrumentation
+import schema
+import station_snapping
+import storage
+import zip_boundaries
+
+# Local PostgreSQL database holding the raw Divvy tables
+DATABASE_URL = 'postgresql://lisavandervoort@localhost:5432/divvy'
+
+# Environment variable overriding DATABASE_URL, e.g. with a SQLite stand-in
+DATABASE_URL_VARIABLE = 'DIVVY_DATABASE_URL'
+
+# Source tables extracted at the same time, queries per table and seconds before
+# the first retry
+EXTRACT_WORKERS = 4
+EXTRACT_ATTEMPTS = 3
+RETRY_SECONDS = 1.0
+
+# Source tables for each year of Divvy data, newest year first
+SOURCE_TABLES = {
+    2020: ['jan_feb_march2020', 'april2020', 'may2020', 'june2020', 'july2020', 'august2020'],
+    2019: ['jan_feb_march2019', 'april_may_june2019', 'july_aug_sept2019', 'oct_nov_dec2019'],
+    2018: ['jan_feb_march2018', 'april_may_june2018', 'july_aug_sept2018', 'oct_nov_dec2018'],
+    2017: ['jan_feb_march2017', 'april_may_june2017', 'july_aug_sept2017', 'oct_nov_dec2017'],
+}
+
+# All columns of the 2020 schema (used to mirror the full path's dropna in SQL)
+COLUMNS_2020 = ['ride_id', 'rideable_type', 'started_at', 'ended_at', 'start_station_name',
+                'start_station_id', 'end_station_name', 'end_station_id', 'start_lat',
+                'start_lng', 'end_lat', 'end_lng', 'member_casual']
+
+# Id, start time and start station columns read from each schema
+PROJECTED_COLUMNS_2020 = ['ride_id', 'started_at', 'start_station_id']
+PROJECTED_COLUMNS_DOCKLESS_2020 = PROJECTED_COLUMNS_2020 + ['start_lat', 'start_lng']
+PROJECTED_COLUMNS_2017_TO_2019 = ['trip_id', 'start_time', 'from_station_id']
+
+# Columns kept after cleaning for every year
+CLEANED_COLUMNS = ['start_time', 'from_station_id', 'start_day_of_year', 'month']
+
+# Start coordinates kept when the source has them (2020 onwards)
+COORDINATE_COLUMNS = ['start_lat', 'start_lng']
+
+# Per-table daily count partitions and their watermarks for incremental refreshes
+PARTITION_DIR = 'daily_partitions'
+WATERMARK_FILE = 'watermarks.json'
+
+def database_engine(database_url=None, pool_size=EXTRACT_WORKERS):
+    '''
+    A function that creates an engine for the Divvy database with a connection pool
+    sized for the concurrent extraction queries.
+
+    Parameters
+    ----------
+    database_url : A SQLAlchemy database URL, e.g. of a local PostgreSQL database or a
+    SQLite file (defaults to the DIVVY_DATABASE_URL environment variable, then to
+    DATABASE_URL).
+    pool_size : The number of pooled connections.
+
+    Returns
+    -------
+    A SQLAlchemy engine.
+    '''
+    database_url = database_url or os.environ.get(DATABASE_URL_VARIABLE, DATABASE_URL)
+
+    # Connections are checked before use, so a dropped connection is replaced
+    return create_engine(database_url, pool_size=pool_size, max_overflow=0, pool_pre_ping=True)
+
+
+def read_source_table(cnx, table, max_attempts=EXTRACT_ATTEMPTS, retry_seconds=RETRY_SECONDS):
+    '''
+    A function that reads one source table, timing every attempt as an
+    instrumented stage and retrying operational errors, such as dropped
+    connections, with exponential backoff. Other errors are raised at once.
 
-def sql_to_dataframe():
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    table : The name of the source table.
+    max_attempts : The number of queries before giving up.
+    retry_seconds : The seconds waited before the first retry, doubled after each one.
+
+    Returns
+    -------
+    A dataframe with every row of the table.
+    '''
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(2 ** (attempt - 1) * retry_seconds)
+        try:
+            with instrumentation.stage('extract_' + table) as record:
+                table_data = pd.read_sql_query('SELECT * FROM ' + table, cnx)
+                record['rows_out'] = len(table_data)
+            return table_data
+        except (OperationalError, DatabaseError) as error:
+            # pandas wraps errors raised while the query runs
+            if not isinstance(error, OperationalError) and not isinstance(
+                    error.__cause__, OperationalError):
+                raise
+            logging.warning('Extracting %s failed (attempt %d of %d): %s', table, attempt + 1,
+                            max_attempts, error)
+            if attempt == max_attempts - 1:
+                raise
+
+    return None
+
+
+@instrumentation.instrumented('extract')
+def sql_to_dataframe(database_url=None, max_workers=EXTRACT_WORKERS,
+                     max_attempts=EXTRACT_ATTEMPTS):
     '''
-    A function that connects to a local PostgreSQL database and queries Divvy
-    bikeshare into yearly dataframes.
+    A function that connects to the Divvy database and queries Divvy bikeshare
+    into yearly dataframes. Source tables are read concurrently over a pooled
+    engine, so extraction takes about as long as the slowest table.
+
+    Parameters
+    ----------
+    database_url : A SQLAlchemy database URL (see database_engine).
+    max_workers : The number of tables read at the same time.
+    max_attempts : The number of queries per table before giving up.
 
     Returns
     -------
     A dataframe for each year of Divvy data (4 in total).
     '''
-    # Use SQLAlchemy to connect to PostgreSQL database
-    cnx = create_engine('postgresql://lisavandervoort@localhost:5432/divvy')
-
-    # Create dataframes containing each year's individual ride data
-    all_data_2020 = pd.read_sql_query('''SELECT * FROM jan_feb_march2020
-                                UNION SELECT * FROM april2020
-                                UNION SELECT * FROM may2020
-                                UNION SELECT * FROM june2020
-                                UNION SELECT * FROM july2020
-                                UNION SELECT * FROM august2020
-                            ''', cnx)
-
-    all_data_2019 = pd.read_sql_query('''SELECT * FROM jan_feb_march2019
-                                UNION SELECT * FROM april_may_june2019
-                                UNION SELECT * FROM july_aug_sept2019
-                                UNION SELECT * FROM oct_nov_dec2019
-                            ''', cnx)
-
-    all_data_2018 = pd.read_sql_query('''SELECT * FROM jan_feb_march2018
-                                UNION SELECT * FROM april_may_june2018
-                                UNION SELECT * FROM july_aug_sept2018
-                                UNION SELECT * FROM oct_nov_dec2018
-                            ''', cnx)
-
-    all_data_2017 = pd.read_sql_query('''SELECT * FROM jan_feb_march2017
-                                UNION SELECT * FROM april_may_june2017
-                                UNION SELECT * FROM july_aug_sept2017
-                                UNION SELECT * FROM oct_nov_dec2017
-                            ''', cnx)
-
+    # Use SQLAlchemy to connect with one pooled connection per worker
+    cnx = database_engine(database_url, pool_size=max_workers)
+    tables = [table for year_tables in SOURCE_TABLES.values() for table in year_tables]
+
+    # Read every source table concurrently
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            table_data = dict(zip(tables, executor.map(
+                lambda table: read_source_table(cnx, table, max_attempts), tables)))
+    finally:
+        cnx.dispose()
+
+    # Combine each year's tables, dropping repeated rows like a UNION
+    all_data_2020, all_data_2019, all_data_2018, all_data_2017 = (
+        pd.concat([table_data.pop(table) for table in year_tables],
+                  ignore_index=True).drop_duplicates(ignore_index=True)
+        for year_tables in SOURCE_TABLES.values())
 
     return all_data_2020, all_data_2019, all_data_2018, all_data_2017
 
-def clean_and_engineer_dataframes(all_data_2020, all_data_2019, all_data_2018, all_data_2017):
+@instrumentation.instrumented('clean')
+def clean_trips(all_data_2020, all_data_2019, all_data_2018, all_data_2017, snap_dockless=False,
+                memory_report=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that cleans the yearly Divvy data into one trip dataframe, with zip
+    codes when the boundary file is available.
+
+    Parameters
+    ----------
+    all_data_2020, all_data_2019, all_data_2018, all_data_2017 : Divvy bike share data
+    snap_dockless : If True, keep 2020 trips without a start station (including
+    electric bikes) by snapping them to the nearest station.
+    memory_report : A list of stage records the raw and cleaned sizes are added to.
+
+    Returns
+    -------
+    The cleaned 2017-2020 trips.
+    '''
+    if memory_report is None:
+        memory_report = []
+    for year, yearly_data in [(2020, all_data_2020), (2019, all_data_2019),
+                              (2018, all_data_2018), (2017, all_data_2017)]:
+        schema.record_memory(memory_report, 'raw_' + str(year), yearly_data)
+
+    # Clean each year's dataframe
+    all_data_2020 = clean_2020_dataframe(all_data_2020, snap_dockless)
+    all_data_2019 = clean_2017_to_2019_dataframe(all_data_2019)
+    all_data_2018 = clean_2017_to_2019_dataframe(all_data_2018)
+    all_data_2017 = clean_2017_to_2019_dataframe(all_data_2017)
+
+    # Concatenate 2017-2020 data together (station categories are unified again)
+    all_data_2017_to_2020 = schema.enforce_dtypes(pd.concat(
+        [all_data_2020, all_data_2019, all_data_2018, all_data_2017], ignore_index=True))
+    schema.record_memory(memory_report, 'cleaned_2017_to_2020', all_data_2017_to_2020)
+
+    # Assign trip start coordinates to zip codes offline when boundaries are available
+    if os.path.exists(zip_boundaries.BOUNDARIES_PATH):
+        all_data_2017_to_2020 = zip_boundaries.assign_trip_zip_codes(
+            all_data_2017_to_2020, zip_boundaries.BOUNDARIES_PATH)
+
+    return all_data_2017_to_2020
+
+@instrumentation.instrumented('daily_groupby')
+def aggregate_daily_rides(all_data_2017_to_2020):
+    '''
+    A function that counts the rides of every station and day.
+
+    Parameters
+    ----------
+    all_data_2017_to_2020 : Cleaned trips with from_station_id, start_day_of_year and
+    month columns.
+
+    Returns
+    -------
+    A daily ride dataframe with a number_daily_rides column.
+    '''
+    daily_df_2017_to_2020 = all_data_2017_to_2020.groupby(
+        ['from_station_id', 'start_day_of_year'], as_index=False, observed=True).month.count()
+
+    return schema.enforce_dtypes(daily_df_2017_to_2020.rename(
+        columns={'month': 'number_daily_rides'}))
+
+def clean_and_engineer_dataframes(all_data_2020, all_data_2019, all_data_2018, all_data_2017,
+                                  snap_dockless=False):
     '''
-    A function that cleans the yearly Divvy data and saves the dataframes to csv files.
+    A function that cleans the yearly Divvy data and saves the dataframes to the store.
 
     Parameters
     ----------
     all_data_2020, all_data_2019, all_data_2018, all_data_2017 : Divvy bike share data
+    snap_dockless : If True, keep 2020 trips without a start station (including
+    electric bikes) by snapping them to the nearest station.
 
     Returns
     -------
-    This saves each yearly dataframe cleaned as a csv file and a daily ride dataframe as a csv.
+    This saves the cleaned trips partitioned by year and month, a daily ride dataframe
+    and the memory report of every stage.
+    '''
+    memory_report = []
+    all_data_2017_to_2020 = clean_trips(all_data_2020, all_data_2019, all_data_2018,
+                                        all_data_2017, snap_dockless, memory_report)
+
+    # Group data by day
+    daily_df_2017_to_2020 = aggregate_daily_rides(all_data_2017_to_2020)
+    schema.record_memory(memory_report, 'daily', daily_df_2017_to_2020)
+
+    # Save cleaned trips partitioned by year and month
+    with instrumentation.stage('save_trips', len(all_data_2017_to_2020)):
+        storage.save_trips(all_data_2017_to_2020)
+
+    # Save daily dataframe
+    storage.save_dataframe(daily_df_2017_to_2020, storage.DAILY_TABLE)
+
+    # Save the memory report
+    storage.save_dataframe(pd.DataFrame(memory_report), schema.MEMORY_REPORT_TABLE)
+
+def clean_2020_dataframe(all_data_2020, snap_dockless=False):
     '''
-    ## Clean 2020 dataframe
-    # Drop nulls
-    all_data_2020.dropna(inplace=True)
+    A function that cleans 2020 Divvy data and renames its columns to match prior years.
+
+    Parameters
+    ----------
+    all_data_2020 : 2020 Divvy bike share data (all columns or a projected chunk).
+    snap_dockless : If True, keep trips without a start station (including electric
+    bikes) by snapping their start coordinate to the nearest station, instead of
+    dropping them.
 
-    # Drop rows with electric bikes
-    all_data_2020.drop(
-        all_data_2020[all_data_2020['rideable_type'] == 'electric_bike'].index, inplace=True)
+    Returns
+    -------
+    A dataframe with the cleaned columns.
+    '''
+    if snap_dockless:
+        # Only trips still without a station after snapping are dropped
+        all_data_2020 = all_data_2020.dropna(subset=['started_at'])
+        all_data_2020 = station_snapping.snap_trips(all_data_2020)
+        all_data_2020 = all_data_2020.dropna(subset=['start_station_id'])
+    else:
+        # Drop nulls
+        all_data_2020 = all_data_2020.dropna()
+
+        # Drop rows with electric bikes (already excluded in SQL for projected chunks)
+        if 'rideable_type' in all_data_2020.columns:
+            all_data_2020 = all_data_2020[all_data_2020['rideable_type'] != 'electric_bike']
 
     # Rename columns to match prior years
     all_data_2020 = all_data_2020.rename(
         columns={'started_at':'start_time', 'start_station_id': 'from_station_id'})
 
-    # Create new column with day of year
-    all_data_2020['start_day_of_year'] = all_data_2020.start_time.dt.date
+    return add_date_columns(all_data_2020)
 
-    # Create new column with month
-    all_data_2020['month'] = all_data_2020.start_time.dt.month
 
-    # Drop unnecessary columns
-    all_data_2020 = all_data_2020.drop(
-        ['ride_id', 'rideable_type', 'ended_at', 'start_station_name',
-         'end_station_id', 'member_casual', 'end_station_name', 'start_lat', 'start_lng',
-         'end_lat', 'end_lng'], axis=1)
+def clean_2017_to_2019_dataframe(yearly_data):
+    '''
+    A function that cleans 2017, 2018 or 2019 Divvy data.
 
+    Parameters
+    ----------
+    yearly_data : One year of 2017-2019 Divvy bike share data (all columns or a projected chunk).
 
-    ## Clean 2019 dataframe
-    # Create new column with day of year
-    all_data_2019['start_day_of_year'] = all_data_2019.start_time.dt.date # pylint: disable=no-member
+    Returns
+    -------
+    A dataframe with the cleaned columns.
+    '''
+    return add_date_columns(yearly_data)
 
-    # Create new column with month
-    all_data_2019['month'] = all_data_2019.start_time.dt.month # pylint: disable=no-member
 
-    # Drop unnecessary columns
-    all_data_2019 = all_data_2019.drop(
-        ['trip_id', 'end_time', 'bikeid', 'tripduration', 'from_station_name',
-         'to_station_id', 'gender', 'to_station_name', 'birthyear', 'usertype'], axis=1)
+def add_date_columns(trip_data):
+    '''
+    A helper function that adds day of year and month columns to trip data and
+    drops every column that is not needed downstream. Start coordinates are kept
+    when the data has them, and every column gets its compact dtype.
+
+    Parameters
+    ----------
+    trip_data : Divvy bike share data with a start_time column.
 
+    Returns
+    -------
+    A dataframe with only the cleaned columns.
+    '''
+    trip_data = trip_data.copy()
+    trip_data['start_time'] = pd.to_datetime(trip_data['start_time'])
 
-    ## Clean 2018 dataframe
     # Create new column with day of year
-    all_data_2018['start_day_of_year'] = all_data_2018.start_time.dt.date # pylint: disable=no-member
+    trip_data['start_day_of_year'] = trip_data.start_time.dt.normalize()
 
     # Create new column with month
-    all_data_2018['month'] = all_data_2018.start_time.dt.month # pylint: disable=no-member
+    trip_data['month'] = trip_data.start_time.dt.month
 
     # Drop unnecessary columns
-    all_data_2018 = all_data_2018.drop(
-        ['trip_id', 'end_time', 'bikeid', 'tripduration', 'from_station_name',
-         'to_station_id', 'gender', 'to_station_name', 'birthyear', 'usertype'], axis=1)
+    return schema.enforce_dtypes(trip_data[CLEANED_COLUMNS + [
+        column for column in COORDINATE_COLUMNS if column in trip_data.columns]])
 
 
-    ## Clean 2017 dataframe
-    # Create new column with day of year
-    all_data_2017['start_day_of_year'] = all_data_2017.start_time.dt.date # pylint: disable=no-member
+def projected_columns(year, snap_dockless=False, coordinates=False):
+    '''
+    A helper function that lists the columns read from one year's source tables.
 
-    # Create new column with month
-    all_data_2017['month'] = all_data_2017.start_time.dt.month # pylint: disable=no-member
+    Parameters
+    ----------
+    year : The year of Divvy data.
+    snap_dockless : If True, also read the 2020 start coordinates to snap.
+    coordinates : If True, also read the start coordinates of 2020 trips.
 
-    # Drop unnecessary columns
-    all_data_2017 = all_data_2017.drop(
-        ['trip_id', 'end_time', 'bikeid', 'tripduration', 'from_station_name',
-         'to_station_id', 'gender', 'to_station_name', 'birthyear', 'usertype'], axis=1)
+    Returns
+    -------
+    A list of column names, the trip id first and the start time second.
+    '''
+    if year != 2020:
+        return PROJECTED_COLUMNS_2017_TO_2019
+    if snap_dockless or coordinates:
+        return PROJECTED_COLUMNS_DOCKLESS_2020
 
-    # Concatenate 2017-2020 data together
-    all_data_2017_to_2020 = pd.concat(
-        [all_data_2020, all_data_2019, all_data_2018, all_data_2017], ignore_index=True)
+    return PROJECTED_COLUMNS_2020
+
+
+def source_table_query(table, year, snap_dockless=False, coordinates=False):
+    '''
+    A helper function that builds the projected query for one source table. Nulls
+    and electric bikes are filtered in the database so that only rows the cleaning
+    step keeps are transferred.
+
+    Parameters
+    ----------
+    table : The name of the source table.
+    year : The year of Divvy data stored in the table.
+    snap_dockless : If True, also read 2020 trips without a start station that have
+    a start coordinate to snap, including electric bikes.
+    coordinates : If True, also read the start coordinates of 2020 trips.
+
+    Returns
+    -------
+    A SQL query string.
+    '''
+    columns = ', '.join(projected_columns(year, snap_dockless, coordinates))
+    if year == 2020 and snap_dockless:
+        return ('SELECT ' + columns + ' FROM ' + table +
+                ' WHERE started_at IS NOT NULL AND (start_station_id IS NOT NULL OR '
+                '(start_lat IS NOT NULL AND start_lng IS NOT NULL))')
+    if year == 2020:
+        not_null = ' AND '.join(column + ' IS NOT NULL' for column in COLUMNS_2020)
+        return ('SELECT ' + columns + ' FROM ' + table +
+                ' WHERE ' + not_null + " AND rideable_type <> 'electric_bike'")
+    return 'SELECT ' + columns + ' FROM ' + table
+
+
+def deduplicated_year_query(year, snap_dockless=False, coordinates=False):
+    '''
+    A helper function that builds the projected query of one year's source tables
+    keeping the first trip of every trip_id/ride_id, the trips counted by the
+    COUNT(DISTINCT id) of pushdown_daily_counts. The database only numbers the
+    projected rows of each id rather than sorting every column of every row as a
+    UNION does.
+
+    Parameters
+    ----------
+    year : The year of Divvy data.
+    snap_dockless : If True, also read 2020 trips without a start station.
+    coordinates : If True, also read the start coordinates of 2020 trips.
+
+    Returns
+    -------
+    A SQL query string.
+    '''
+    columns = projected_columns(year, snap_dockless, coordinates)
+    trips = ' UNION ALL '.join(source_table_query(table, year, snap_dockless, coordinates)
+                               for table in SOURCE_TABLES[year])
+
+    return ('SELECT ' + ', '.join(columns) + ' FROM (SELECT ' + ', '.join(columns) +
+            ', ROW_NUMBER() OVER (PARTITION BY ' + columns[0] + ' ORDER BY ' + columns[1] +
+            ') AS trip_number FROM (' + trips + ') AS trips_' + str(year) +
+            ') AS numbered_trips_' + str(year) + ' WHERE trip_number = 1')
+
+
+def stream_source_table(cnx, table, year, chunksize, snap_dockless=False, query=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A generator that reads one source table in bounded chunks through a
+    server-side cursor.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    table : The name of the source table (unused when a query is given).
+    year : The year of Divvy data stored in the table.
+    chunksize : The number of rows read per chunk.
+    snap_dockless : If True, also read 2020 trips without a start station.
+    query : A query to run instead of the projected, filtered one of the table.
+
+    Returns
+    -------
+    Yields dataframes of at most chunksize rows.
+    '''
+    start_column = 'started_at' if year == 2020 else 'start_time'
+    if query is None:
+        query = source_table_query(table, year, snap_dockless)
+    with cnx.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        yield from pd.read_sql_query(query, connection, chunksize=chunksize,
+                                     parse_dates=[start_column])
+
+
+def combine_daily_counts(partial_counts):
+    '''
+    A helper function that sums partial per-station daily ride counts.
+
+    Parameters
+    ----------
+    partial_counts : A list of series indexed by from_station_id and start_day_of_year.
+
+    Returns
+    -------
+    A single series with the summed counts.
+    '''
+    return pd.concat(partial_counts).groupby(level=[0, 1], observed=True).sum()
+
+
+@instrumentation.instrumented('stream_clean_and_aggregate')
+def stream_clean_and_aggregate(cnx, chunksize=100000, dedupe=False, snap_dockless=False):
+    '''
+    A function that streams each source table in chunks, cleans every chunk, appends
+    it to the stored trips and aggregates daily rides incrementally. Peak memory
+    is bounded by the chunk size rather than by the years of history. Trips get
+    zip codes chunk by chunk when the boundary file is available.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    chunksize : The number of rows read per chunk.
+    dedupe : If True, keep the first trip of every trip_id/ride_id within each year,
+    deduplicated in the database by deduplicated_year_query, and stream one query
+    per year instead of one per table.
+    snap_dockless : If True, keep 2020 trips without a start station by snapping them
+    to the nearest station.
+
+    Returns
+    -------
+    This saves the cleaned trips partitioned by year and month and a daily ride dataframe.
+    '''
+    partial_counts = []
+    storage.remove_table(storage.TRIPS_TABLE)
+    assign_zip_codes = os.path.exists(zip_boundaries.BOUNDARIES_PATH)
+
+    for year, tables in SOURCE_TABLES.items():
+        if dedupe:
+            queries = [deduplicated_year_query(year, snap_dockless, assign_zip_codes)]
+        else:
+            queries = [source_table_query(table, year, snap_dockless, assign_zip_codes)
+                       for table in tables]
+
+        for query in queries:
+            for chunk in stream_source_table(cnx, None, year, chunksize, query=query):
+                if year == 2020:
+                    cleaned = clean_2020_dataframe(chunk, snap_dockless)
+                else:
+                    cleaned = clean_2017_to_2019_dataframe(chunk)
+
+                # The stored schema comes from the first file read, so every partition
+                # gets the coordinates of the 2020 trips, missing before 2020
+                if snap_dockless or assign_zip_codes:
+                    cleaned = cleaned.reindex(columns=CLEANED_COLUMNS + COORDINATE_COLUMNS)
+                if assign_zip_codes:
+                    cleaned = zip_boundaries.assign_trip_zip_codes(
+                        cleaned, zip_boundaries.BOUNDARIES_PATH)
+                storage.save_trips(cleaned, append=True)
+
+                # Aggregate the chunk and compact the partial counts now and then
+                partial_counts.append(
+                    cleaned.groupby(['from_station_id', 'start_day_of_year'],
+                                    observed=True).size())
+                if len(partial_counts) >= 50:
+                    partial_counts = [combine_daily_counts(partial_counts)]
 
     # Group data by day
-    daily_df_2017_to_2020 = all_data_2017_to_2020.groupby(
-        ['from_station_id', 'start_day_of_year'], as_index=False).month.count()
-    daily_df_2017_to_2020 = daily_df_2017_to_2020.rename(
-        columns={'month': 'number_daily_rides'})
+    daily_df_2017_to_2020 = combine_daily_counts(partial_counts).reset_index(
+        name='number_daily_rides')
+
+    # Save daily dataframe
+    storage.save_dataframe(daily_df_2017_to_2020, storage.DAILY_TABLE)
+
+def daily_counts_query(year, dedupe=False, tables=None, counted_tables=None):
+    '''
+    A function that builds the SQL that aggregates one year of trips into per-station
+    daily ride counts, applying the same renames and filters as the cleaning step.
 
-    # Save dataframes to csv files
-    all_data_2020.to_csv(r'all_data_2020.csv', index=False)
-    all_data_2019.to_csv(r'all_data_2019.csv', index=False)
-    all_data_2018.to_csv(r'all_data_2018.csv', index=False)
-    all_data_2017.to_csv(r'all_data_2017.csv', index=False)
+    Parameters
+    ----------
+    year : The year of Divvy data to aggregate.
+    dedupe : If True, count each trip_id/ride_id once.
+    tables : The source tables to aggregate (defaults to every table for the year).
+    counted_tables : Source tables of the same year whose trips are counted elsewhere;
+    trips with one of their ids are skipped.
+
+    Returns
+    -------
+    A SQL query string returning from_station_id, start_day_of_year and
+    number_daily_rides.
+    '''
+    if tables is None:
+        tables = SOURCE_TABLES[year]
+
+    if year == 2020:
+        id_column, start_column, station_column = PROJECTED_COLUMNS_2020
+    else:
+        id_column, start_column, station_column = PROJECTED_COLUMNS_2017_TO_2019
+
+    trips = ' UNION ALL '.join(source_table_query(table, year) for table in tables)
+    if counted_tables:
+        counted_ids = ' UNION ALL '.join('SELECT ' + id_column + ' FROM (' +
+                                         source_table_query(table, year) + ') AS counted_' +
+                                         table for table in counted_tables)
+        trips = ('SELECT * FROM (' + trips + ') AS new_trips WHERE ' + id_column +
+                 ' NOT IN (' + counted_ids + ')')
+    count = 'COUNT(DISTINCT ' + id_column + ')' if dedupe else 'COUNT(*)'
+
+    return ('SELECT ' + station_column + ' AS from_station_id, DATE(' + start_column +
+            ') AS start_day_of_year, ' + count + ' AS number_daily_rides FROM (' + trips +
+            ') AS trips_' + str(year) + ' GROUP BY ' + station_column + ', DATE(' +
+            start_column + ')')
+
+
+@instrumentation.instrumented('pushdown_daily_counts')
+def pushdown_daily_counts(cnx, dedupe=True):
+    '''
+    A function that lets PostgreSQL compute the per-station daily ride counts for
+    2017-2020 so only the aggregate is transferred.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    dedupe : If True, count each trip_id/ride_id once, like the UNION queries of the
+    full extraction.
+
+    Returns
+    -------
+    This saves the daily ride dataframe.
+    '''
+    yearly_counts = ' UNION ALL '.join(
+        daily_counts_query(year, dedupe) for year in SOURCE_TABLES)
+    query = ('SELECT from_station_id, start_day_of_year, '
+             'SUM(number_daily_rides) AS number_daily_rides FROM (' + yearly_counts +
+             ') AS yearly_counts GROUP BY from_station_id, start_day_of_year '
+             'ORDER BY from_station_id, start_day_of_year')
+
+    daily_df_2017_to_2020 = pd.read_sql_query(query, cnx)
+    daily_df_2017_to_2020['number_daily_rides'] = (
+        daily_df_2017_to_2020['number_daily_rides'].astype('int64'))
 
     # Save daily dataframe
-    daily_df_2017_to_2020.to_csv(r'daily_df_2017_to_2020.csv', index=False)
+    storage.save_dataframe(daily_df_2017_to_2020, storage.DAILY_TABLE)
 
-def main():
+def table_watermark(cnx, table, year):
     '''
-    Calls internal functions to the script to pull data from PostgreSQL, clean data,
-    create additional dataframes, and engineer features. All dataframes are saved as csv
-    files.
+    A function that reads the row count and latest start time of one source table
+    after the cleaning filters are applied.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    table : The name of the source table.
+    year : The year of Divvy data stored in the table.
+
+    Returns
+    -------
+    A dictionary with the row_count and max_start_time of the table.
     '''
+    start_column = 'started_at' if year == 2020 else 'start_time'
+    query = ('SELECT COUNT(*) AS row_count, MAX(' + start_column + ') AS max_start_time FROM (' +
+             source_table_query(table, year) + ') AS source_table')
+    watermark = pd.read_sql_query(query, cnx).iloc[0]
+
+    return {'row_count': int(watermark['row_count']),
+            'max_start_time': str(watermark['max_start_time'])}
 
-    # Call internal functions to this script
-    all_data_2020, all_data_2019, all_data_2018, all_data_2017 = sql_to_dataframe()
-    clean_and_engineer_dataframes(all_data_2020, all_data_2019, all_data_2018, all_data_2017)
 
-main()
+def file_checksum(path):
+    '''
+    A helper function that returns the SHA-256 checksum of a file.
+
+    Parameters
+    ----------
+    path : The path of the file.
+
+    Returns
+    -------
+    The hex digest of the file contents.
+    '''
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+@instrumentation.instrumented('incremental_refresh')
+def incremental_refresh(cnx, partition_dir=PARTITION_DIR, immutable_years=None, dedupe=False):
+    # pylint: disable=too-many-locals
+    '''
+    A function that refreshes the daily ride counts one source table at a time. Each
+    table's daily counts are cached as a partition together with a watermark (row
+    count, latest start time and partition checksum), and only tables whose
+    watermark moved are aggregated again. Tables from immutable years are reused
+    without querying the database as long as their cached partition is intact. With
+    dedupe, a trip is counted in the first table of its year holding its id, so the
+    later tables of a year are aggregated again when an earlier one changed, and the
+    counts match a full rebuild.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    partition_dir : The directory holding the partitions and their watermarks.
+    immutable_years : Years whose partitions never change (defaults to every year
+    but the latest).
+    dedupe : If True, count each trip_id/ride_id of a year once.
+
+    Returns
+    -------
+    A list of the source tables that were refreshed. This also saves the merged
+    daily ride dataframe.
+    '''
+    if immutable_years is None:
+        immutable_years = [year for year in SOURCE_TABLES if year != max(SOURCE_TABLES)]
+
+    os.makedirs(partition_dir, exist_ok=True)
+    watermark_path = os.path.join(partition_dir, WATERMARK_FILE)
+    watermarks = {}
+    if os.path.exists(watermark_path):
+        with open(watermark_path, encoding='utf-8') as file:
+            watermarks = json.load(file)
+
+    refreshed_tables = []
+    partition_paths = []
+
+    for year, tables in SOURCE_TABLES.items():
+        year_changed = False
+        for number, table in enumerate(tables):
+            partition_path = os.path.join(partition_dir, table + '.parquet')
+            partition_paths.append(partition_path)
+
+            # Check whether the cached partition is still intact and counted the same way
+            recorded = watermarks.get(table)
+            cached = (recorded is not None and os.path.exists(partition_path)
+                      and file_checksum(partition_path) == recorded['checksum']
+                      and recorded.get('dedupe', False) == dedupe)
+            if cached and year in immutable_years:
+                continue
+
+            # Compare the table's watermark with the recorded one
+            watermark = table_watermark(cnx, table, year)
+            if (cached and not (dedupe and year_changed)
+                    and watermark['row_count'] == recorded['row_count']
+                    and watermark['max_start_time'] == recorded['max_start_time']):
+                continue
+
+            # Aggregate the new or changed table, skipping trips of earlier tables
+            counted_tables = tables[:number] if dedupe else None
+            table_counts = pd.read_sql_query(
+                daily_counts_query(year, dedupe, [table], counted_tables), cnx)
+            table_counts.to_parquet(partition_path, index=False)
+            year_changed = True
+
+            watermark['dedupe'] = dedupe
+            watermark['checksum'] = file_checksum(partition_path)
+            watermarks[table] = watermark
+            refreshed_tables.append(table)
+
+    with open(watermark_path, 'w', encoding='utf-8') as file:
+        json.dump(watermarks, file, indent=2, sort_keys=True)
+
+    # Merge every partition into the daily dataframe
+    daily_df_2017_to_2020 = pd.concat(
+        [pd.read_parquet(path) for path in partition_paths], ignore_index=True)
+    daily_df_2017_to_2020 = daily_df_2017_to_2020.groupby(
+        ['from_station_id', 'start_day_of_year'], as_index=False).number_daily_rides.sum()
+
+    # Save daily dataframe
+    storage.save_dataframe(daily_df_2017_to_2020, storage.DAILY_TABLE)
+
+    return refreshed_tables
+
+def main(mode='full', chunksize=100000, dedupe=False, snap_dockless=False, database_url=None):
+    '''
+    Calls internal functions to the script to pull data from PostgreSQL, clean data,
+    create additional dataframes, and engineer features. All dataframes are saved to
+    the Parquet store. The out-of-core Polars backend runs from lazy_cleaning.main.
+
+    Parameters
+    ----------
+    mode : 'full' reads whole years, 'streaming' reads each source table in chunks and
+    'pushdown' has the database return only the daily ride counts and 'incremental'
+    only aggregates source tables that changed since the last run.
+    chunksize : The number of rows read per chunk in streaming mode.
+    dedupe : If True, count every trip_id/ride_id of a year once ('streaming',
+    'pushdown' and 'incremental' modes; 'full' mode always drops repeated rows).
+    snap_dockless : If True, keep 2020 trips without a start station by snapping them
+    to the nearest station ('full' and 'streaming' modes, since the other modes count
+    rides in the database).
+    database_url : A SQLAlchemy database URL (see database_engine).
+    '''
+    if snap_dockless and mode not in ['full', 'streaming']:
+        raise ValueError('Dockless trips can only be snapped in full or streaming mode')
+    # Call internal functions to this script
+    if mode == 'streaming':
+        stream_clean_and_aggregate(database_engine(database_url), chunksize, dedupe, snap_dockless)
+        return
+    if mode == 'pushdown':
+        pushdown_daily_counts(database_engine(database_url), dedupe)
+        return
+    if mode == 'incremental':
+        incremental_refresh(database_engine(database_url), dedupe=dedupe)
+        return
+
+    all_data_2020, all_data_2019, all_data_2018, all_data_2017 = sql_to_dataframe(database_url)
+    clean_and_engineer_dataframes(all_data_2020, all_data_2019, all_data_2018, all_data_2017,
+                                  snap_dockless)
+
+if __name__ == '__main__':
+    main()
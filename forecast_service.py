@@ -0,0 +1,234 @@
+'''
+This script serves forecasts from the registered Prophet models, in-process or over
+a local HTTP endpoint. Models are loaded once, the future regressor frame is built
+once, and each model version's forecast horizon is predicted once and cached, so a
+lookup is a slice of a cached dataframe. Registering a new version of a model makes
+later requests predict and cache the new version. Concurrent requests for the same
+model share a single prediction.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import threading
+import pandas as pd
+import model_registry
+import prophet_model
+
+# Columns returned for every forecast day
+FORECAST_COLUMNS = ['ds', 'yhat', 'yhat_lower', 'yhat_upper']
+
+
+def model_name(station_id):
+    '''
+    A helper function that returns the registry name of a station's model.
+
+    Parameters
+    ----------
+    station_id : A Divvy station id, or 'all' for the city-wide model.
+
+    Returns
+    -------
+    The name the model is registered under.
+    '''
+    if str(station_id) == 'all':
+        return 'city'
+    return 'station_' + str(station_id)
+
+
+class ForecastService:
+    '''
+    Serves forecasts from registered models with a cached horizon per model.
+
+    Parameters
+    ----------
+    registry_dir : The directory holding every registered model.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    horizon_start, horizon_end : The dates predicted and cached for every model.
+    '''
+    def __init__(self, registry_dir=model_registry.REGISTRY_DIR, calendar=None,
+                 horizon_start=prophet_model.FORECAST_START,
+                 horizon_end=prophet_model.FORECAST_END):
+        self.registry_dir = registry_dir
+        self.calendar = calendar
+        self.future = self.future_frame(horizon_start, horizon_end)
+        self.horizons = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def future_frame(self, start, end):
+        '''
+        Builds the daily frame with phase regressors that models predict on.
+
+        Parameters
+        ----------
+        start, end : The first and last day.
+
+        Returns
+        -------
+        A dataframe with ds and condition columns.
+        '''
+        future = pd.DataFrame({'ds': pd.date_range(start, end)})
+
+        return prophet_model.add_phase_regressors(future, self.calendar)
+
+    def model_lock(self, key):
+        '''
+        Returns the lock that serializes the first prediction of a model version.
+        '''
+        with self.locks_lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def latest_version(self, name):
+        '''
+        Returns the latest registered version of a model.
+        '''
+        return model_registry.load_metadata(name, registry_dir=self.registry_dir)['version']
+
+    def horizon(self, name, version=None):
+        '''
+        Returns a model version's cached horizon, predicting it on first use. Threads
+        asking for the same version while it is predicted wait for that one prediction.
+
+        Parameters
+        ----------
+        name : The registry name of the model.
+        version : The registered version (defaults to the latest).
+
+        Returns
+        -------
+        A dataframe of forecast columns indexed by ds.
+        '''
+        key = (name, self.latest_version(name) if version is None else version)
+        if key not in self.horizons:
+            with self.model_lock(key):
+                if key not in self.horizons:
+                    prophet = model_registry.load_model(*key, registry_dir=self.registry_dir)
+                    predictions = prophet.predict(self.future)
+                    self.horizons[key] = predictions[FORECAST_COLUMNS].set_index('ds')
+
+        return self.horizons[key]
+
+    def warm(self, station_ids):
+        '''
+        Loads and predicts the horizon of every given station ahead of requests.
+
+        Parameters
+        ----------
+        station_ids : Station ids (or 'all') to warm.
+        '''
+        for station_id in station_ids:
+            self.horizon(model_name(station_id))
+
+    def forecast(self, station_id, start=None, end=None):
+        '''
+        Returns the forecast of a station (or 'all') between two dates. Dates inside
+        the cached horizon are sliced from it; other dates are predicted on demand.
+
+        Parameters
+        ----------
+        station_id : A Divvy station id, or 'all' for the city-wide model.
+        start, end : The first and last day (default to the cached horizon).
+
+        Returns
+        -------
+        A dataframe with ds, yhat, yhat_lower and yhat_upper.
+        '''
+        name = model_name(station_id)
+        version = self.latest_version(name)
+        horizon = self.horizon(name, version)
+        start = horizon.index[0] if start is None else pd.Timestamp(start)
+        end = horizon.index[-1] if end is None else pd.Timestamp(end)
+
+        if horizon.index[0] <= start and end <= horizon.index[-1]:
+            return horizon.loc[start:end].reset_index()
+
+        prophet = model_registry.load_model(name, version, registry_dir=self.registry_dir)
+
+        return prophet.predict(self.future_frame(start, end))[FORECAST_COLUMNS]
+
+    def forecast_many(self, requests):
+        '''
+        Answers a batch of requests, predicting each distinct model at most once.
+
+        Parameters
+        ----------
+        requests : A list of (station_id, start, end) tuples.
+
+        Returns
+        -------
+        A list of forecast dataframes in the order of the requests.
+        '''
+        self.warm({station_id for station_id, _, _ in requests})
+
+        return [self.forecast(station_id, start, end) for station_id, start, end in requests]
+
+
+def make_handler(service):
+    '''
+    A function that creates an HTTP handler answering
+    GET /forecast?station=<id|all>&start=<date>&end=<date> with JSON records, 404
+    for unknown stations and 400 for malformed dates.
+
+    Parameters
+    ----------
+    service : The ForecastService answering requests.
+
+    Returns
+    -------
+    A BaseHTTPRequestHandler subclass.
+    '''
+    class ForecastHandler(BaseHTTPRequestHandler):
+        '''
+        Answers forecast requests from the shared service.
+        '''
+        def do_GET(self): # pylint: disable=invalid-name
+            '''
+            Handles a forecast request.
+            '''
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path != '/forecast' or 'station' not in query:
+                self.send_error(404, 'Use /forecast?station=<id|all>&start=<date>&end=<date>')
+                return
+
+            try:
+                forecast = service.forecast(query['station'], query.get('start'), query.get('end'))
+            except KeyError as error:
+                self.send_error(404, str(error))
+                return
+            except (ValueError, TypeError) as error:
+                self.send_error(400, str(error))
+                return
+
+            body = forecast.to_json(orient='records', date_format='iso').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            '''
+            Silences per-request logging.
+            '''
+
+    return ForecastHandler
+
+
+def main(host='127.0.0.1', port=8000, warm_station_ids=()):
+    '''
+    Starts the forecast service on a local HTTP port.
+
+    Parameters
+    ----------
+    host, port : The address to listen on.
+    warm_station_ids : Station ids (or 'all') whose horizons are predicted at startup.
+    '''
+    service = ForecastService()
+    service.warm(warm_station_ids)
+
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
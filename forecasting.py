@@ -1,189 +1,191 @@
 '''
 This script performs time series forecasting on Divvy bike share data using
-Facebook Prophet.
+Facebook Prophet. The model itself is built in prophet_model.
 '''
 
-import datetime as dt
-import pickle
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from fbprophet import Prophet
-from fbprophet.diagnostics import performance_metrics
-from fbprophet.diagnostics import cross_validation
-
-def is_covid(ds):
+import backtesting
+import baselines
+import hierarchy
+import incremental_refit
+import instrumentation
+import model_registry
+import phase_calendar
+import prophet_model
+import storage
+
+# Column dtypes of the consolidated per-station forecast table
+STATION_FORECAST_DTYPES = {'from_station_id': 'int64', 'ds': 'datetime64[ns]',
+                           'yhat': 'float64', 'yhat_lower': 'float64', 'yhat_upper': 'float64'}
+
+
+def final_model(dataframe, calendar=None, engine='prophet'):
     '''
-    A helper fucntion that takes in a date and returns a value of 0 or 1 if the
-    date is before or during Covid-19 (indicated by the initial date of Chicago's shut
-    down).
+    A function that registers a Facebook Prophet time series model using Chicago's
+    phased Covid response and reopening. Dates are Chicago specific.
 
     Parameters
     ----------
-    date : The date of a Divvy bike ride.
+    df : A dataframe containing Divvy ride share data at the daily level.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    engine : 'prophet', or 'seasonal_naive', 'exponential_smoothing' or 'ridge' to
+    forecast and backtest a vectorized baseline, which is not registered.
 
     Returns
     -------
-    A 0 if the date took place before Covid-19 and a 1 if the ride took place during
-    Covid-19.
-    '''
-    date = pd.to_dt(ds)
-    return date >= dt.date(year=2020, month=3, day=17)
-
-
-def is_phase_one(ds):
+    A registered Prophet model, a pickled forecast dataframe for the remaining
+    days of the year, and a pickled perforamnce metrics dataframe.
     '''
-    A helper fucntion that takes in a date and returns a value of 0 or 1 if the
-    date is during Chicago's Phase 1 Covid response (March 17-April 30, 2020).
+    if engine == 'prophet':
+        prophet, forecast = prophet_model.fit_and_forecast(dataframe, calendar)
+    else:
+        forecast = baselines.fit_and_forecast(dataframe, engine, calendar)
+
+    with instrumentation.stage('cross_validation', len(dataframe)) as record:
+        _, performance_results, _ = backtesting.backtest(
+            dataframe, initial='730 days', period='180 days', horizon='122 days',
+            calendar=calendar, engine=engine)
+        record['rows_out'] = len(performance_results)
+
+    # Register the model with its training data, hyperparameters and metrics
+    if engine == 'prophet':
+        model_registry.register_model(
+            prophet, 'city', dataframe, hyperparameters=prophet_model.DEFAULT_HYPERPARAMETERS,
+            metrics=performance_results.drop(['horizon'], axis=1).mean().to_dict())
 
-    Parameters
-    ----------
-    date : The date of a Divvy bike ride.
+    # Pickle the forecast dataframe
+    forecast.to_pickle("forecast.pkl")
 
-    Returns
-    -------
-    False if the date did not take place during Phase 1 and True if the ride took place during
-    Phase 1.
-    '''
-    date = pd.to_dt(ds)
-    return dt.date(year=2020, month=3, day=17) <= date <= dt.date(year=2020, month=4, day=30)
+    # Pickle the performance results
+    performance_results.to_pickle("performance_results.pkl")
 
 
-def is_phase_two(ds):
+def forecast_station(task):
     '''
-    A helper fucntion that takes in a date and returns a value of 0 or 1 if the
-    date is during Chicago's Phase 2 Covid response (May 1-June 2, 2020).
+    A function that fits, registers and forecasts one station. Failures are returned
+    instead of raised so one bad station does not stop the others.
 
     Parameters
     ----------
-    date : The date of a Divvy bike ride.
+    task : A tuple of the station id, its daily rides, the phase calendar and the
+    hyperparameters.
 
     Returns
     -------
-    False if the date did not take place during Phase 2 and True if the ride took place during
-    Phase 2.
+    The station id, its forecast dataframe (None on failure) and the error message
+    (None on success).
     '''
-    date = pd.to_dt(ds)
-    return dt.date(year=2020, month=5, day=1) <= date <= dt.date(year=2020, month=6, day=2)
-
-
-def is_phase_three(ds):
+    station_id, station_data, calendar, hyperparameters = task
+    try:
+        prophet, forecast = prophet_model.fit_and_forecast(station_data, calendar,
+                                                           hyperparameters)
+        model_registry.register_model(
+            prophet, 'station_' + str(station_id), station_data,
+            hyperparameters=dict(prophet_model.DEFAULT_HYPERPARAMETERS,
+                                 **(hyperparameters or {})))
+    except Exception as error: # pylint: disable=broad-except
+        return station_id, None, repr(error)
+
+    forecast = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+    forecast.insert(0, 'from_station_id', station_id)
+
+    return station_id, forecast, None
+
+
+@instrumentation.instrumented('forecast_stations')
+def forecast_stations(daily_df_2017_to_2020, max_workers=None, chunksize=8, calendar=None,
+                      hyperparameters=None):
     '''
-    A helper fucntion that takes in a date and returns a value of 0 or 1 if the
-    date is during Chicago's Phase 3 Covid response (June 3-June 25, 2020).
+    A function that fits and forecasts every station in parallel across a process pool
+    and saves the results as one consolidated forecast table.
 
     Parameters
     ----------
-    date : The date of a Divvy bike ride.
+    daily_df_2017_to_2020 : A dataframe containing Divvy ride share data at the daily
+    level for every station.
+    max_workers : The number of worker processes (defaults to the number of CPUs).
+    chunksize : The number of stations submitted to a worker at a time.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    prophet_model.DEFAULT_HYPERPARAMETERS).
 
     Returns
     -------
-    False if the date did not take place during Phase 3 and True if the ride took place during
-    Phase 3.
+    The consolidated forecast dataframe (empty when every station failed) and a
+    dictionary of error messages for stations that failed.
     '''
-    date = pd.to_dt(ds)
-    return dt.date(year=2020, month=6, day=3) <= date <= dt.date(year=2020, month=6, day=25)
-
-
-def final_model(dataframe):
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+
+    tasks = ((station_id, station_data, calendar, hyperparameters)
+             for station_id, station_data in daily_df_2017_to_2020.groupby(
+                 'from_station_id', observed=True))
+
+    forecasts = []
+    failures = {}
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=prophet_model.WORKER_CONTEXT,
+                             initializer=prophet_model.init_forecasting_worker) as executor:
+        for station_id, forecast, error in executor.map(forecast_station, tasks,
+                                                        chunksize=chunksize):
+            if error is None:
+                forecasts.append(forecast)
+            else:
+                failures[station_id] = error
+
+    if forecasts:
+        station_forecasts = pd.concat(forecasts, ignore_index=True)
+    else:
+        station_forecasts = pd.DataFrame(columns=list(STATION_FORECAST_DTYPES)).astype(
+            STATION_FORECAST_DTYPES)
+    storage.save_dataframe(station_forecasts, storage.STATION_FORECAST_TABLE)
+
+    return station_forecasts, failures
+
+
+def main(per_station=False, max_workers=None, chunksize=8, reconciliation=None,
+         engine='prophet', incremental=False):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
     '''
-    A function that pickles a Facebook Prophet time series model using Chicago's
-    phased Covid response and reopening. Dates are Chicago specific.
+    Loads the daily ride dataset and outputs a FacebookProphet model
 
     Parameters
     ----------
-    df : A dataframe containing Divvy ride share data at the daily level.
-
-    Returns
-    -------
-    A pickled Prophet model, a cross validated results dataframe containing the
-    forecast for the remaining 122 days of the year, and a perforamnce metrics
-    dataframe.
+    per_station : If True, forecast every station in parallel instead of fitting
+    one model on all stations.
+    max_workers : The number of worker processes in per-station and hierarchical mode.
+    chunksize : The number of stations submitted to a worker at a time.
+    reconciliation : If set to 'bottom_up', 'top_down' or 'mint', forecast the
+    station, zip code and city hierarchy reconciled with this method.
+    engine : 'prophet', or 'seasonal_naive', 'exponential_smoothing' or 'ridge' to
+    forecast with a vectorized baseline instead.
+    incremental : If True, refit only the registered city and station models whose
+    new days drifted, warm-started from their previous versions.
     '''
-    # Rename columns to match requirement for Prophet
-    dataframe = dataframe.rename(columns={'number_daily_rides': 'y', 'start_day_of_year': 'ds'})
-
-    # Drop all other columns
-    dataframe = dataframe.drop(['from_station_id'], axis=1)
-
-    # Add columns for Covid seasonality
-    dataframe['covid'] = dataframe['ds'].apply(is_covid)
-    dataframe['precovid'] = ~dataframe['ds'].apply(is_covid)
-
-    # Add columns for Phase 1 seasonality
-    dataframe['phase_one'] = dataframe['ds'].apply(is_phase_one)
-    dataframe['not_phase_one'] = ~dataframe['ds'].apply(is_phase_one)
-
-    # Add columns for Phase 2 seasonality
-    dataframe['phase_two'] = dataframe['ds'].apply(is_phase_two)
-    dataframe['not_phase_two'] = ~dataframe['ds'].apply(is_phase_two)
-
-    # Add columns for Phase 3 seasonality
-    dataframe['phase_three'] = dataframe['ds'].apply(is_phase_three)
-    dataframe['not_phase_three'] = ~dataframe['ds'].apply(is_phase_three)
-
-    # Split train and test data
-    start_date = pd.Timestamp(2020, 8, 1)
-    last_date = pd.Timestamp(2020, 12, 31)
-
-    cross_val_data = dataframe[(dataframe.ds < start_date)]
-    test_data = dataframe[(dataframe.ds >= start_date) & (dataframe.ds <= last_date)]
-
-    # Run model
-    prophet = Prophet(daily_seasonality=False, weekly_seasonality=False, yearly_seasonality=False,
-                      seasonality_prior_scale=20, changepoint_prior_scale=0.2)
-
-    prophet.add_seasonality(name='covid', period=7, fourier_order=10, condition_name='covid')
-    prophet.add_seasonality(name='precovid', period=7, fourier_order=3, condition_name='precovid')
-    prophet.add_seasonality(
-        name='phase_one', period=365.25, fourier_order=5, condition_name='phase_one')
-    prophet.add_seasonality(
-        name='not_phase_one', period=365.25, fourier_order=5, condition_name='not_phase_one')
-    prophet.add_seasonality(
-        name='phase_two', period=365.25, fourier_order=5, condition_name='phase_two')
-    prophet.add_seasonality(
-        name='not_phase_two', period=365.25, fourier_order=5, condition_name='not_phase_two')
-    prophet.add_seasonality(
-        name='phase_three', period=365.25, fourier_order=5, condition_name='phase_three')
-    prophet.add_seasonality(
-        name='not_phase_three', period=365.25, fourier_order=5, condition_name='not_phase_three')
-    prophet.add_country_holidays(country_name='US')
-
-    prophet.fit(cross_val_data)
-
-    future = prophet.make_future_dataframe(periods=153)
-    future['covid'] = future['ds'].apply(is_covid)
-    future['precovid'] = ~future['ds'].apply(is_covid)
-    future['phase_one'] = future['ds'].apply(is_phase_one)
-    future['not_phase_one'] = ~future['ds'].apply(is_phase_one)
-    future['phase_two'] = future['ds'].apply(is_phase_two)
-    future['not_phase_two'] = ~future['ds'].apply(is_phase_two)
-    future['phase_three'] = future['ds'].apply(is_phase_three)
-    future['not_phase_three'] = ~future['ds'].apply(is_phase_three)
-
-    test_data = future[(future.ds >= start_date) & (future.ds <= last_date)]
-
-    forecast = prophet.predict(test_data)
-
-    cv_results = cross_validation(
-        prophet, initial='730 days', period='180 days', horizon='122 days')
-    performance_results = performance_metrics(cv_results, metrics=['mae', 'rmse'])
-
-    # Pickle the model
-    with open(prophet.pkl, "wb") as f:
-        pickle.dump(prophet, f)
 
-    # Pickle the forecast dataframe
-    forecast.to_pickle("forecast.pkl")
+    daily_df_2017_to_2020 = storage.load_dataframe(storage.DAILY_TABLE)
+    if incremental:
+        incremental_refit.refit_models(daily_df_2017_to_2020, max_workers=max_workers,
+                                       chunksize=chunksize)
+        return
 
-    # Pickle the performance results
-    performance_results.to_pickle("performance_results.pkl")
+    if reconciliation:
+        hierarchy.forecast_hierarchy(daily_df_2017_to_2020, reconciliation,
+                                     max_workers=max_workers, chunksize=chunksize)
+        return
 
+    if engine != 'prophet':
+        if per_station:
+            baselines.forecast_stations(daily_df_2017_to_2020, engine)
+        else:
+            final_model(daily_df_2017_to_2020, engine=engine)
+        return
 
-def main():
-    '''
-    Loads the daily ride dataset and outputs a FacebookProphet model
-    '''
+    if per_station:
+        forecast_stations(daily_df_2017_to_2020, max_workers, chunksize)
+        return
 
-    daily_df_2017_to_2020 = pd.read_csv('daily_df_2017_to_2020.csv')
     final_model(daily_df_2017_to_2020)
 
-main()
+if __name__ == '__main__':
+    main()
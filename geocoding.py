@@ -0,0 +1,238 @@
+'''
+This module reverse geocodes coordinates to zip codes. Results are kept in an
+on-disk cache keyed by rounded latitude and longitude, seeded with the known zip
+codes of the Divvy stations, so only coordinates never seen before reach the
+geocoding provider. Those are deduplicated and looked up concurrently with rate
+limiting and retries. Providers are pluggable: any callable taking a latitude and
+a longitude and returning a zip code can replace the Google Maps provider.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import re
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+# Known zip codes of the Divvy station locations
+SEED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data',
+                         'zip_code_location_divvy_stations.csv')
+
+# File holding every geocoded location
+CACHE_PATH = 'geocode_cache.json'
+
+# Decimal places coordinates are rounded to before lookup (about 10 cm)
+PRECISION = 6
+
+# Default requests per second, concurrent lookups and attempts per lookup
+REQUESTS_PER_SECOND = 10
+MAX_WORKERS = 4
+MAX_ATTEMPTS = 3
+
+
+def location_key(latitude, longitude, precision=PRECISION):
+    '''
+    A helper function that builds the cache key of a coordinate.
+
+    Parameters
+    ----------
+    latitude, longitude : The coordinate.
+    precision : The decimal places the coordinate is rounded to.
+
+    Returns
+    -------
+    A 'latitude,longitude' string of the rounded coordinate.
+    '''
+    return (f'{round(float(latitude), precision):.{precision}f},'
+            f'{round(float(longitude), precision):.{precision}f}')
+
+
+def parse_zip_code(address):
+    '''
+    A helper function that extracts the zip code from a formatted address, e.g.
+    '1 N State St, Chicago, IL 60602, USA'.
+
+    Parameters
+    ----------
+    address : The formatted address.
+
+    Returns
+    -------
+    The zip code as an integer, or None if the address has none.
+    '''
+    address_zip_codes = re.findall(r'\b(\d{5})(?:-\d{4})?\b', address)
+
+    return int(address_zip_codes[-1]) if address_zip_codes else None
+
+
+class GoogleProvider: # pylint: disable=too-few-public-methods
+    '''
+    Reverse geocodes coordinates with the Google Maps API.
+
+    Parameters
+    ----------
+    api_key : Your API key to access Google Maps.
+    '''
+    def __init__(self, api_key='your_api_key'):
+        from geopy.geocoders import GoogleV3 # pylint: disable=import-outside-toplevel,import-error
+        self.geolocator = GoogleV3(api_key=api_key)
+
+    def __call__(self, latitude, longitude):
+        '''
+        Returns the zip code of a coordinate, or None if it has none.
+        '''
+        location = self.geolocator.reverse(str(latitude) + ', ' + str(longitude))
+        if location is None:
+            return None
+
+        # Prefer the structured postal code over parsing the address
+        for component in location.raw.get('address_components', []):
+            if 'postal_code' in component.get('types', []):
+                return int(component['short_name'][:5])
+
+        return parse_zip_code(location.address)
+
+
+class RateLimiter: # pylint: disable=too-few-public-methods
+    '''
+    Spaces calls shared between threads at least 1 / requests_per_second apart.
+
+    Parameters
+    ----------
+    requests_per_second : The largest number of calls allowed per second.
+    '''
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND):
+        self.interval = 1 / requests_per_second
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Blocks until the next call is allowed.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_cache(cache_path=CACHE_PATH, seed_path=SEED_PATH):
+    '''
+    A function that loads the geocoding cache, seeded with the known station zip codes.
+
+    Parameters
+    ----------
+    cache_path : The cache file (missing on the first run).
+    seed_path : A CSV with Location '(latitude, longitude)' and zip_code columns.
+
+    Returns
+    -------
+    A dictionary of zip codes (None where a location has none) by location key.
+    '''
+    cache = {}
+    if seed_path and os.path.exists(seed_path):
+        seed = pd.read_csv(seed_path)
+        coordinates = seed['Location'].str.strip('()').str.split(',', expand=True).astype(float)
+        for latitude, longitude, zip_code in zip(coordinates[0], coordinates[1],
+                                                  seed['zip_code']):
+            cache[location_key(latitude, longitude)] = int(zip_code)
+
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding='utf-8') as file:
+            cache.update(json.load(file))
+
+    return cache
+
+
+def save_cache(cache, cache_path=CACHE_PATH):
+    '''
+    A function that writes the geocoding cache, replacing the file atomically.
+
+    Parameters
+    ----------
+    cache : A dictionary of zip codes by location key.
+    cache_path : The cache file.
+    '''
+    temporary_path = cache_path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(cache, file, indent=0, sort_keys=True)
+    os.replace(temporary_path, cache_path)
+
+
+def lookup(provider, key, rate_limiter, max_attempts=MAX_ATTEMPTS):
+    '''
+    A function that geocodes one location, retrying failed calls with exponential
+    backoff.
+
+    Parameters
+    ----------
+    provider : A callable taking a latitude and a longitude and returning a zip code.
+    key : The location key to geocode.
+    rate_limiter : The RateLimiter shared by every lookup.
+    max_attempts : The number of calls before giving up.
+
+    Returns
+    -------
+    The location key, its zip code and the error of the last attempt (None on success).
+    '''
+    latitude, longitude = (float(value) for value in key.split(','))
+    error = None
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(2 ** attempt * rate_limiter.interval)
+        rate_limiter.wait()
+        try:
+            return key, provider(latitude, longitude), None
+        except Exception as exception: # pylint: disable=broad-except
+            error = repr(exception)
+
+    return key, None, error
+
+
+def zip_codes(latitudes, longitudes, provider=None, cache_path=CACHE_PATH, seed_path=SEED_PATH,
+              requests_per_second=REQUESTS_PER_SECOND, max_workers=MAX_WORKERS,
+              max_attempts=MAX_ATTEMPTS):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    '''
+    A function that returns the zip code of every coordinate. Coordinates are
+    deduplicated, cached locations are answered from the cache, and only the rest
+    are sent to the provider, concurrently and rate limited. Locations that still
+    fail after every attempt are not cached, so the next run retries them.
+
+    Parameters
+    ----------
+    latitudes, longitudes : Sequences of coordinates.
+    provider : A callable taking a latitude and a longitude and returning a zip code
+    (defaults to GoogleProvider(), created only if a location is missing).
+    cache_path : The cache file.
+    seed_path : A CSV of known zip codes to seed the cache with.
+    requests_per_second : The largest number of provider calls per second.
+    max_workers : The number of concurrent provider calls.
+    max_attempts : The number of calls per location before giving up.
+
+    Returns
+    -------
+    A numpy array of zip codes, NaN where a location has none or failed.
+    '''
+    keys = [location_key(latitude, longitude)
+            for latitude, longitude in zip(latitudes, longitudes)]
+
+    cache = load_cache(cache_path, seed_path)
+    missing = sorted(set(keys) - set(cache))
+    if missing:
+        provider = provider or GoogleProvider()
+        rate_limiter = RateLimiter(requests_per_second)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for key, zip_code, error in executor.map(
+                    lambda key: lookup(provider, key, rate_limiter, max_attempts), missing):
+                if error is None:
+                    cache[key] = zip_code
+                else:
+                    logging.warning('Geocoding %s failed: %s', key, error)
+        save_cache(cache, cache_path)
+
+    return np.array([np.nan if cache.get(key) is None else cache[key] for key in keys])
@@ -0,0 +1,350 @@
+'''
+This module forecasts Divvy rides coherently at station, zip code and city level.
+Stations are mapped to zip codes through their location, the hierarchy is encoded
+as a sparse aggregation matrix, base forecasts are fitted for every node in
+parallel, and the base forecasts are reconciled bottom-up, top-down or with MinT
+so that station forecasts add up exactly to their zip code and city forecasts.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
+import phase_calendar
+import point_forecast
+import prophet_model
+import storage
+
+# Station list and the zip code of every station location
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+STATIONS_PATH = os.path.join(DATA_DIR, 'Divvy_Bicycle_Stations.csv')
+ZIP_CODES_PATH = os.path.join(DATA_DIR, 'zip_code_location_divvy_stations.csv')
+
+# Zip code node of stations without a known location
+UNKNOWN_ZIP_CODE = 'unknown'
+
+# Table holding the latest reconciled forecasts
+HIERARCHY_FORECAST_TABLE = 'hierarchical_forecasts'
+
+RECONCILIATION_METHODS = ['bottom_up', 'top_down', 'mint']
+
+
+def load_station_zip_codes(stations_path=STATIONS_PATH, zip_codes_path=ZIP_CODES_PATH):
+    '''
+    A function that maps every Divvy station to its zip code through the station's
+    Location column.
+
+    Parameters
+    ----------
+    stations_path : The Divvy station list.
+    zip_codes_path : The zip code of every station location.
+
+    Returns
+    -------
+    A dataframe with from_station_id and zip_code columns.
+    '''
+    stations = pd.read_csv(stations_path, usecols=['ID', 'Location'])
+    zip_codes = pd.read_csv(zip_codes_path)
+    station_zip_codes = pd.merge(stations, zip_codes, on='Location')
+
+    return pd.DataFrame({'from_station_id': station_zip_codes['ID'].astype('int64'),
+                         'zip_code': station_zip_codes['zip_code'].astype(str)})
+
+
+def aggregation_matrix(station_ids, station_zip_codes):
+    '''
+    A function that builds the sparse summing matrix of the hierarchy. Rows are the
+    city, then every zip code, then every station; columns are the stations.
+
+    Parameters
+    ----------
+    station_ids : The stations at the bottom of the hierarchy.
+    station_zip_codes : A dataframe with from_station_id and zip_code columns.
+    Stations missing from it are grouped under UNKNOWN_ZIP_CODE.
+
+    Returns
+    -------
+    The summing matrix as a CSR matrix, a dataframe of node names and levels in row
+    order, and the number of stations.
+    '''
+    station_ids = np.asarray(station_ids).astype('int64')
+    zip_of_station = station_zip_codes.set_index('from_station_id')['zip_code']
+    station_zips = zip_of_station.reindex(station_ids).fillna(UNKNOWN_ZIP_CODE).values
+    zip_codes, zip_index = np.unique(station_zips, return_inverse=True)
+
+    number_of_stations = len(station_ids)
+    columns = np.arange(number_of_stations)
+    rows = np.concatenate([np.zeros(number_of_stations, dtype='int64'),
+                           1 + zip_index,
+                           1 + len(zip_codes) + columns])
+    summing_matrix = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, np.tile(columns, 3))),
+        shape=(1 + len(zip_codes) + number_of_stations, number_of_stations))
+
+    nodes = pd.DataFrame({
+        'node': (['city'] + ['zip_' + zip_code for zip_code in zip_codes]
+                 + ['station_' + str(station_id) for station_id in station_ids]),
+        'level': ['city'] + ['zip_code'] * len(zip_codes) + ['station'] * number_of_stations})
+
+    return summing_matrix, nodes, number_of_stations
+
+
+def station_matrix(daily_df_2017_to_2020):
+    '''
+    A helper function that pivots daily rides into one column per station, with days
+    without rides filled with zero.
+
+    Parameters
+    ----------
+    daily_df_2017_to_2020 : A dataframe containing Divvy ride share data at the daily
+    level for every station.
+
+    Returns
+    -------
+    A dataframe of daily rides indexed by day with one column per station id.
+    '''
+    daily = daily_df_2017_to_2020.assign(
+        from_station_id=np.asarray(daily_df_2017_to_2020['from_station_id']).astype('int64'))
+    rides = daily.pivot_table(index='start_day_of_year', columns='from_station_id',
+                              values='number_daily_rides', aggfunc='sum', fill_value=0)
+    days = pd.date_range(rides.index.min(), rides.index.max())
+
+    return rides.reindex(days, fill_value=0)
+
+
+def fit_node(task):
+    '''
+    A function that fits one node of the hierarchy and forecasts FORECAST_START to
+    FORECAST_END. Failures are returned instead of raised so one node does not stop
+    the others.
+
+    Parameters
+    ----------
+    task : A tuple of the node name, its daily rides, the phase calendar and the
+    hyperparameters.
+
+    Returns
+    -------
+    The node name, its forecast yhat values and in-sample residual variance (None
+    on failure), and the error message (None on success).
+    '''
+    node, node_data, calendar, hyperparameters = task
+    try:
+        prophet, forecast = prophet_model.fit_and_forecast(node_data, calendar, hyperparameters)
+        yhat = forecast.set_index('ds')['yhat'].reindex(
+            pd.date_range(prophet_model.FORECAST_START, prophet_model.FORECAST_END))
+        if yhat.isna().any():
+            raise ValueError('The forecast does not cover FORECAST_START to FORECAST_END')
+
+        fitted = point_forecast.point_forecast(prophet, prophet.history)
+        residuals = prophet.history['y'].values - fitted['yhat'].values
+    except Exception as error: # pylint: disable=broad-except
+        return node, None, None, repr(error)
+
+    return node, yhat.values, np.var(residuals), None
+
+
+def base_forecasts(node_rides, max_workers=None, chunksize=8, calendar=None,
+                   hyperparameters=None):
+    '''
+    A function that fits every node of the hierarchy in parallel across a process pool.
+
+    Parameters
+    ----------
+    node_rides : A dataframe of daily rides indexed by day with one column per node.
+    max_workers : The number of worker processes (defaults to the number of CPUs).
+    chunksize : The number of nodes submitted to a worker at a time.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    prophet_model.DEFAULT_HYPERPARAMETERS).
+
+    Returns
+    -------
+    A dictionary of forecast yhat values per node, a dictionary of residual
+    variances per node and a dictionary of error messages for nodes that failed.
+    '''
+    tasks = ((node, pd.DataFrame({'start_day_of_year': node_rides.index,
+                                  'number_daily_rides': node_rides[node].values}),
+              calendar, hyperparameters)
+             for node in node_rides.columns)
+
+    forecasts = {}
+    variances = {}
+    failures = {}
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=prophet_model.WORKER_CONTEXT,
+                             initializer=prophet_model.init_forecasting_worker) as executor:
+        for node, yhat, variance, error in executor.map(fit_node, tasks, chunksize=chunksize):
+            if error is None:
+                forecasts[node] = yhat
+                variances[node] = variance
+            else:
+                failures[node] = error
+
+    return forecasts, variances, failures
+
+
+def reconcile_bottom_up(summing_matrix, base, number_of_stations):
+    '''
+    A function that sums the station forecasts up the hierarchy.
+
+    Parameters
+    ----------
+    summing_matrix : The sparse summing matrix from aggregation_matrix.
+    base : An array of base forecasts with one row per node and one column per day.
+    number_of_stations : The number of stations, which are the last rows of base.
+
+    Returns
+    -------
+    The reconciled forecasts of every node.
+    '''
+    return summing_matrix @ base[-number_of_stations:]
+
+
+def reconcile_top_down(summing_matrix, base, proportions):
+    '''
+    A function that splits the city forecast between stations by their historical
+    share of rides and sums it back up the hierarchy.
+
+    Parameters
+    ----------
+    summing_matrix : The sparse summing matrix from aggregation_matrix.
+    base : An array of base forecasts with one row per node and one column per day.
+    proportions : The share of the city's rides of every station.
+
+    Returns
+    -------
+    The reconciled forecasts of every node.
+    '''
+    return summing_matrix @ np.outer(proportions, base[0])
+
+
+def mint_variances(variances):
+    '''
+    A helper function that prepares the residual variances MinT weights nodes by.
+    Zero variances are raised to the smallest positive one, and nodes without a
+    base forecast get a variance so large they carry almost no weight.
+
+    Parameters
+    ----------
+    variances : The in-sample residual variance of every node, NaN where the base
+    forecast failed.
+
+    Returns
+    -------
+    An array of positive variances.
+    '''
+    known = variances[~np.isnan(variances)]
+    if not (known > 0).any():
+        return np.ones(len(variances))
+
+    positive = known[known > 0]
+
+    return np.where(np.isnan(variances), positive.max() * 1e6,
+                    np.maximum(variances, positive.min()))
+
+
+def reconcile_mint(summing_matrix, base, variances):
+    '''
+    A function that reconciles the base forecasts with MinT using a diagonal error
+    covariance, i.e. the weighted least squares projection
+    S (S' W^-1 S)^-1 S' W^-1 y. The projection is solved as a sparse least squares
+    problem for every day, so the dense station by station matrix is never built.
+
+    Parameters
+    ----------
+    summing_matrix : The sparse summing matrix from aggregation_matrix.
+    base : An array of base forecasts with one row per node and one column per day.
+    variances : The in-sample residual variance of every node.
+
+    Returns
+    -------
+    The reconciled forecasts of every node.
+    '''
+    weights = 1 / np.sqrt(variances)
+    weighted_matrix = sparse.diags(weights) @ summing_matrix
+    weighted_base = base * weights[:, None]
+
+    stations = np.column_stack([
+        lsqr(weighted_matrix, weighted_base[:, day], atol=1e-12, btol=1e-12)[0]
+        for day in range(base.shape[1])])
+
+    return summing_matrix @ stations
+
+
+def forecast_hierarchy(daily_df_2017_to_2020, method='mint', station_zip_codes=None,
+                       max_workers=None, chunksize=8, calendar=None, hyperparameters=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    '''
+    A function that fits base forecasts at station, zip code and city level,
+    reconciles them and saves the reconciled forecasts of every node.
+
+    Parameters
+    ----------
+    daily_df_2017_to_2020 : A dataframe containing Divvy ride share data at the daily
+    level for every station.
+    method : 'bottom_up', 'top_down' or 'mint'.
+    station_zip_codes : A dataframe with from_station_id and zip_code columns
+    (defaults to load_station_zip_codes()).
+    max_workers : The number of worker processes (defaults to the number of CPUs).
+    chunksize : The number of nodes submitted to a worker at a time.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    prophet_model.DEFAULT_HYPERPARAMETERS).
+
+    Returns
+    -------
+    A dataframe with node, level, ds, base_yhat and yhat columns, and a dictionary of
+    error messages for nodes whose base forecast failed.
+    '''
+    if method not in RECONCILIATION_METHODS:
+        raise ValueError('Unknown reconciliation method ' + method)
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+    if station_zip_codes is None:
+        station_zip_codes = load_station_zip_codes()
+
+    station_rides = station_matrix(daily_df_2017_to_2020)
+    summing_matrix, nodes, number_of_stations = aggregation_matrix(
+        station_rides.columns, station_zip_codes)
+    node_rides = pd.DataFrame((summing_matrix @ station_rides.values.T).T,
+                              index=station_rides.index, columns=nodes['node'])
+
+    # Bottom-up and top-down only need one level of base forecasts
+    if method == 'bottom_up':
+        fitted_nodes = node_rides.columns[-number_of_stations:]
+    elif method == 'top_down':
+        fitted_nodes = node_rides.columns[:1]
+    else:
+        fitted_nodes = node_rides.columns
+    forecasts, variances, failures = base_forecasts(
+        node_rides[fitted_nodes], max_workers, chunksize, calendar, hyperparameters)
+
+    # Failed nodes forecast zero and carry almost no weight in MinT
+    horizon = pd.date_range(prophet_model.FORECAST_START, prophet_model.FORECAST_END)
+    base = np.zeros((len(nodes), len(horizon)))
+    node_variances = np.full(len(nodes), np.nan)
+    for row, node in enumerate(nodes['node']):
+        if node in forecasts:
+            base[row] = forecasts[node]
+            node_variances[row] = variances[node]
+    forecasted = nodes['node'].isin(forecasts).values
+
+    if method == 'bottom_up':
+        reconciled = reconcile_bottom_up(summing_matrix, base, number_of_stations)
+    elif method == 'top_down':
+        training_rides = station_rides[station_rides.index < prophet_model.FORECAST_START].sum()
+        reconciled = reconcile_top_down(summing_matrix, base,
+                                        (training_rides / training_rides.sum()).values)
+    else:
+        reconciled = reconcile_mint(summing_matrix, base, mint_variances(node_variances))
+
+    hierarchy_forecasts = pd.DataFrame({
+        'node': np.repeat(nodes['node'].values, len(horizon)),
+        'level': np.repeat(nodes['level'].values, len(horizon)),
+        'ds': np.tile(horizon.values, len(nodes)),
+        'base_yhat': np.where(forecasted[:, None], base, np.nan).ravel(),
+        'yhat': np.asarray(reconciled).ravel()})
+    storage.save_dataframe(hierarchy_forecasts, HIERARCHY_FORECAST_TABLE)
+
+    return hierarchy_forecasts, failures
@@ -0,0 +1,202 @@
+'''
+This module refits registered Prophet models when new days of rides arrive. Each
+model's previous version first predicts the new days; only models whose error on
+them exceeds a drift threshold are refitted, and those fits are warm-started from
+the previous version's parameters instead of from scratch. Every decision and fit
+time is appended to a refit log so the time saved can be tracked.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import time
+import numpy as np
+import pandas as pd
+import model_registry
+import phase_calendar
+import point_forecast
+import prophet_model
+import storage
+
+# Relative error on the new days above which a model is refitted
+DRIFT_THRESHOLD = 0.2
+
+# Table holding every refit decision
+REFIT_LOG_TABLE = 'refit_log'
+
+
+def stan_init(prophet):
+    '''
+    A helper function that extracts a fitted model's parameters in the form Stan
+    accepts as initial values.
+
+    Parameters
+    ----------
+    prophet : A fitted Prophet model.
+
+    Returns
+    -------
+    A dictionary with k, m, sigma_obs, delta and beta.
+    '''
+    init = {}
+    for name in ['k', 'm', 'sigma_obs']:
+        init[name] = float(prophet.params[name][0][0])
+    for name in ['delta', 'beta']:
+        init[name] = prophet.params[name][0]
+
+    return init
+
+
+def forecast_drift(prophet, new_data):
+    '''
+    A function that measures how far new days moved from a model's predictions, as
+    the mean absolute error relative to the mean number of rides.
+
+    Parameters
+    ----------
+    prophet : A fitted Prophet model.
+    new_data : A dataframe with ds, y and condition columns.
+
+    Returns
+    -------
+    The relative error of the model on the new days.
+    '''
+    yhat = point_forecast.point_forecast(prophet, new_data)['yhat'].values
+    errors = np.abs(new_data['y'].values - yhat)
+
+    return errors.mean() / max(np.abs(new_data['y'].values).mean(), 1)
+
+
+def refit_series(task):
+    '''
+    A function that decides whether a registered model needs a refit and refits it,
+    warm-started from its latest version when there is one. Failures are returned
+    instead of raised so one bad series does not stop the others.
+
+    Parameters
+    ----------
+    task : A tuple of the model name, its daily rides, the phase calendar, the
+    hyperparameters, the drift threshold and the registry directory.
+
+    Returns
+    -------
+    A dictionary describing the decision: the model name, the action taken
+    ('unchanged', 'skipped', 'warm', 'cold' or 'failed'), the previous and new
+    versions, the number of new days, the drift and the fit time in seconds.
+    '''
+    name, series_data, calendar, hyperparameters, drift_threshold, registry_dir = task
+    record = {'name': name, 'action': 'cold', 'previous_version': None, 'version': None,
+              'new_days': 0, 'drift': np.nan, 'fit_seconds': 0.0, 'error': None}
+    try:
+        prepared = prophet_model.prepare_training_data(series_data, calendar)
+
+        init = None
+        if model_registry.load_index(name, registry_dir):
+            record['previous_version'] = model_registry.load_metadata(
+                name, registry_dir=registry_dir)['version']
+            previous = model_registry.load_model(name, registry_dir=registry_dir)
+            new_data = prepared[prepared.ds > previous.history['ds'].max()]
+            record['new_days'] = new_data.ds.nunique()
+            if new_data.empty:
+                record.update(action='unchanged', version=record['previous_version'])
+                return record
+
+            record['drift'] = forecast_drift(previous, new_data)
+            if record['drift'] <= drift_threshold:
+                record.update(action='skipped', version=record['previous_version'])
+                return record
+            init = stan_init(previous)
+            record['action'] = 'warm'
+
+        prophet = prophet_model.build_prophet_model(calendar, hyperparameters)
+        started = time.perf_counter()
+        if init is None:
+            prophet.fit(prepared)
+        else:
+            prophet.fit(prepared, init=init)
+        record['fit_seconds'] = time.perf_counter() - started
+
+        record['version'] = model_registry.register_model(
+            prophet, name, series_data,
+            hyperparameters=dict(prophet_model.DEFAULT_HYPERPARAMETERS, **(hyperparameters or {})),
+            registry_dir=registry_dir)
+    except Exception as error: # pylint: disable=broad-except
+        record.update(action='failed', error=repr(error))
+
+    return record
+
+
+def add_time_saved(refits, refit_log):
+    '''
+    A helper function that estimates the fit time saved by every decision: the last
+    logged cold fit time of the model minus the time actually spent.
+
+    Parameters
+    ----------
+    refits : A dataframe of refit decisions from refit_series.
+    refit_log : The previously logged decisions.
+
+    Returns
+    -------
+    The refits dataframe with a seconds_saved column.
+    '''
+    cold_fits = pd.concat([refit_log, refits], ignore_index=True)
+    cold_fits = cold_fits[cold_fits.action == 'cold'].groupby('name')['fit_seconds'].last()
+
+    refits['seconds_saved'] = (refits['name'].map(cold_fits) - refits['fit_seconds']).where(
+        refits.action.isin(['unchanged', 'skipped', 'warm']))
+
+    return refits
+
+
+def refit_models(daily_df_2017_to_2020, drift_threshold=DRIFT_THRESHOLD, max_workers=None,
+                 chunksize=8, calendar=None, hyperparameters=None, include_city=True,
+                 registry_dir=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that refits the city model and every station model in parallel
+    across a process pool, warm-starting models that drifted and skipping the rest,
+    and appends the decisions to the refit log.
+
+    Parameters
+    ----------
+    daily_df_2017_to_2020 : A dataframe containing Divvy ride share data at the daily
+    level for every station, including the newly arrived days.
+    drift_threshold : The relative error on the new days above which a model is refitted.
+    max_workers : The number of worker processes (defaults to the number of CPUs).
+    chunksize : The number of models submitted to a worker at a time.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    prophet_model.DEFAULT_HYPERPARAMETERS).
+    include_city : If True, also refit the city model.
+    registry_dir : The directory holding every registered model (defaults to
+    model_registry.REGISTRY_DIR).
+
+    Returns
+    -------
+    A dataframe with one refit decision per model, including the estimated seconds saved.
+    '''
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+    if registry_dir is None:
+        registry_dir = model_registry.REGISTRY_DIR
+
+    series = [('station_' + str(station_id), station_data)
+              for station_id, station_data in daily_df_2017_to_2020.groupby(
+                  'from_station_id', observed=True)]
+    if include_city:
+        series.insert(0, ('city', daily_df_2017_to_2020))
+    tasks = ((name, series_data, calendar, hyperparameters, drift_threshold, registry_dir)
+             for name, series_data in series)
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=prophet_model.WORKER_CONTEXT,
+                             initializer=prophet_model.init_forecasting_worker) as executor:
+        refits = pd.DataFrame(list(executor.map(refit_series, tasks, chunksize=chunksize)))
+    refits['refitted_at'] = pd.Timestamp.now().floor('s')
+
+    try:
+        refit_log = storage.load_dataframe(REFIT_LOG_TABLE)
+    except FileNotFoundError:
+        refit_log = pd.DataFrame(columns=refits.columns)
+
+    refits = add_time_saved(refits, refit_log)
+    storage.save_dataframe(pd.concat([refit_log, refits], ignore_index=True), REFIT_LOG_TABLE)
+
+    return refits
@@ -0,0 +1,345 @@
+'''
+This module measures where time and memory go in every stage of the pipeline.
+Stages are wrapped with a context manager or a decorator that records wall and
+CPU time (including reaped worker processes), the growth of peak RSS, rows in and
+out, and bytes read and written. Every record is logged as one JSON document and
+the latest record of every stage can be written to a Prometheus textfile. A chosen
+stage can also be profiled with cProfile or with a low-overhead sampling profiler
+that writes collapsed stacks for flame graphs.
+'''
+import collections
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import pandas as pd
+
+# Logger receiving one JSON document per stage
+LOGGER = logging.getLogger('divvy.metrics')
+
+# Directory holding profiles of the profiled stages
+PROFILE_DIR = 'profiles'
+
+# Prometheus metrics written for every stage, with their record fields and help texts
+PROMETHEUS_METRICS = [
+    ('divvy_stage_wall_seconds', 'wall_seconds', 'Wall time of the last run'),
+    ('divvy_stage_cpu_seconds', 'cpu_seconds', 'CPU time of the process in the last run'),
+    ('divvy_stage_child_cpu_seconds', 'child_cpu_seconds',
+     'CPU time of worker processes reaped in the last run'),
+    ('divvy_stage_peak_rss_delta_bytes', 'peak_rss_delta_bytes',
+     'Growth of the peak resident set size in the last run'),
+    ('divvy_stage_rows_in', 'rows_in', 'Rows read by the last run'),
+    ('divvy_stage_rows_out', 'rows_out', 'Rows produced by the last run'),
+    ('divvy_stage_bytes_read', 'bytes_read', 'Bytes read by the last run'),
+    ('divvy_stage_bytes_written', 'bytes_written', 'Bytes written by the last run'),
+    ('divvy_stage_success', 'success', 'Whether the last run succeeded'),
+    ('divvy_stage_last_run_timestamp_seconds', 'finished_timestamp',
+     'Time the last run finished')]
+
+# Outputs and profiled stages, see configure
+SETTINGS = {'log_path': None, 'textfile_path': None, 'textfile_pid': None,
+            'profile_stages': set(), 'profiler': 'cprofile', 'sampling_interval': 0.01}
+
+# Every record of this process and the latest record of every stage
+RECORDS = []
+LATEST = {}
+LOCK = threading.Lock()
+
+
+def configure(log_path=None, textfile_path=None, profile_stages=(), profiler='cprofile',
+              sampling_interval=0.01):
+    '''
+    A function that sets where stage metrics go and which stages are profiled.
+
+    Parameters
+    ----------
+    log_path : A file every JSON record is appended to, from this process and its
+    workers (None to only log them).
+    textfile_path : A Prometheus textfile, e.g. in node_exporter's textfile
+    collector directory, rewritten after every stage (None to skip). Only this
+    process writes it.
+    profile_stages : The names of the stages to profile.
+    profiler : 'cprofile' for deterministic profiles or 'sampling' for collapsed
+    stacks sampled every sampling_interval seconds.
+    sampling_interval : The seconds between stack samples.
+    '''
+    if profiler not in ['cprofile', 'sampling']:
+        raise ValueError('Unknown profiler ' + profiler)
+
+    SETTINGS.update(log_path=log_path, textfile_path=textfile_path, textfile_pid=os.getpid(),
+                    profile_stages=set(profile_stages), profiler=profiler,
+                    sampling_interval=sampling_interval)
+
+
+def io_counters():
+    '''
+    A helper function that reads the bytes the process has read and written,
+    including database sockets, from /proc (Linux only).
+
+    Returns
+    -------
+    The bytes read and written so far, or None for both where unavailable.
+    '''
+    try:
+        with open('/proc/self/io', encoding='utf-8') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+    except OSError:
+        return None, None
+
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def peak_rss_bytes():
+    '''
+    A helper function that returns the peak resident set size of the process.
+
+    Returns
+    -------
+    The peak RSS in bytes.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes and Linux kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count_rows(value):
+    '''
+    A helper function that counts the rows of a dataframe or of the dataframes in a
+    tuple or list.
+
+    Parameters
+    ----------
+    value : Any value.
+
+    Returns
+    -------
+    The number of rows, or None if value holds no dataframe.
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+
+    return None
+
+
+class SamplingProfiler:
+    '''
+    Samples the stack of one thread at a fixed interval from a background thread,
+    in the spirit of py-spy, and counts collapsed stacks.
+
+    Parameters
+    ----------
+    thread_id : The thread to sample (defaults to the calling thread).
+    interval : The seconds between samples.
+    '''
+    def __init__(self, thread_id=None, interval=0.01):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        '''
+        Records the sampled thread's stack until stopped.
+        '''
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                stack.append(os.path.basename(frame.f_code.co_filename) + ':' +
+                             frame.f_code.co_name)
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        '''
+        Starts sampling.
+        '''
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stops sampling.
+        '''
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        '''
+        Writes the collapsed stacks, one 'frame;frame;frame count' line per stack, the
+        input format of flamegraph.pl and speedscope.
+        '''
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(stack + ' ' + str(count) + '\n')
+
+
+def prometheus_text(latest):
+    '''
+    A function that formats the latest record of every stage in the Prometheus text
+    exposition format.
+
+    Parameters
+    ----------
+    latest : A dictionary of records by stage name.
+
+    Returns
+    -------
+    The textfile contents.
+    '''
+    lines = []
+    for metric, field, help_text in PROMETHEUS_METRICS:
+        lines += ['# HELP ' + metric + ' ' + help_text, '# TYPE ' + metric + ' gauge']
+        for name, record in sorted(latest.items()):
+            if record.get(field) is not None:
+                lines.append(metric + '{stage="' + name + '"} ' + repr(float(record[field])))
+
+    return '\n'.join(lines) + '\n'
+
+
+def emit(record):
+    '''
+    A function that logs a stage record as JSON, appends it to the log file and
+    rewrites the Prometheus textfile.
+
+    Parameters
+    ----------
+    record : The stage record.
+    '''
+    document = json.dumps(record, default=str)
+    LOGGER.info(document)
+
+    with LOCK:
+        RECORDS.append(record)
+        LATEST[record['stage']] = record
+
+        if SETTINGS['log_path']:
+            with open(SETTINGS['log_path'], 'a', encoding='utf-8') as file:
+                file.write(document + '\n')
+
+        # Worker processes inherit the settings but must not replace the textfile
+        if SETTINGS['textfile_path'] and SETTINGS['textfile_pid'] == os.getpid():
+            temporary_path = SETTINGS['textfile_path'] + '.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                file.write(prometheus_text(LATEST))
+            os.replace(temporary_path, SETTINGS['textfile_path'])
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    '''
+    A context manager that measures the enclosed code as one stage. The yielded
+    record can be updated with rows_out (and rows_in) before the block ends. Failed
+    stages are recorded with their error and the error is raised again.
+
+    Parameters
+    ----------
+    name : The name of the stage.
+    rows_in : The number of input rows.
+
+    Returns
+    -------
+    Yields the stage record: stage, started, wall_seconds, cpu_seconds,
+    child_cpu_seconds, peak_rss_delta_bytes, rows_in, rows_out, bytes_read,
+    bytes_written, success, error and profile_path.
+    '''
+    record = {'stage': name, 'pid': os.getpid(),
+              'started': datetime.datetime.now().isoformat(timespec='milliseconds'),
+              'rows_in': rows_in, 'rows_out': None, 'success': 0, 'error': None,
+              'profile_path': None}
+
+    profiler = None
+    if name in SETTINGS['profile_stages']:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        record['profile_path'] = os.path.join(
+            PROFILE_DIR, name + '_' + datetime.datetime.now().strftime('%Y%m%dT%H%M%S') +
+            ('.prof' if SETTINGS['profiler'] == 'cprofile' else '.folded'))
+        if SETTINGS['profiler'] == 'cprofile':
+            profiler = cProfile.Profile()
+        else:
+            profiler = SamplingProfiler(interval=SETTINGS['sampling_interval'])
+
+    bytes_read, bytes_written = io_counters()
+    peak_rss = peak_rss_bytes()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    if isinstance(profiler, cProfile.Profile):
+        profiler.enable()
+    elif profiler is not None:
+        profiler.start()
+    try:
+        yield record
+        record['success'] = 1
+    except BaseException as error:
+        record['error'] = repr(error)
+        raise
+    finally:
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(record['profile_path'])
+        elif profiler is not None:
+            profiler.stop()
+            profiler.write(record['profile_path'])
+
+        record['wall_seconds'] = time.perf_counter() - started
+        record['cpu_seconds'] = time.process_time() - cpu_started
+        children_finished = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record['child_cpu_seconds'] = max(children_finished.ru_utime + children_finished.ru_stime -
+                                          children.ru_utime - children.ru_stime, 0.0)
+        record['peak_rss_delta_bytes'] = peak_rss_bytes() - peak_rss
+        bytes_read_finished, bytes_written_finished = io_counters()
+        if bytes_read is not None:
+            record['bytes_read'] = bytes_read_finished - bytes_read
+            record['bytes_written'] = bytes_written_finished - bytes_written
+        record['finished_timestamp'] = time.time()
+        emit(record)
+
+
+def instrumented(name):
+    '''
+    A decorator that measures every call of a function as a stage. Rows in are
+    counted from the dataframe arguments and rows out from the returned dataframes.
+
+    Parameters
+    ----------
+    name : The name of the stage.
+
+    Returns
+    -------
+    The decorator.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name, count_rows(list(args) + list(kwargs.values()))) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def collected_metrics():
+    '''
+    A function that returns every stage record of this process.
+
+    Returns
+    -------
+    A dataframe with one row per measured stage run.
+    '''
+    with LOCK:
+        return pd.DataFrame(RECORDS)
@@ -0,0 +1,255 @@
+'''
+This module is an out-of-core backend for cleaning the Divvy trips with Polars.
+Source tables are first landed as raw Parquet files chunk by chunk, then every
+year is cleaned by one lazy query: the 2020 schema is filtered and renamed to
+match prior years, trips are deduplicated on their id, and day and month columns
+are derived. Queries run on Polars' streaming engine, which reads the Parquet
+files in batches on every core, so peak memory is bounded by one year of cleaned
+trips in compact dtypes rather than by the raw years of history. The stored trips,
+daily rides and memory report match clean_data.clean_and_engineer_dataframes.
+'''
+import glob
+import os
+import pandas as pd
+import clean_data
+import instrumentation
+import schema
+import storage
+import zip_boundaries
+
+# Directory holding the landed source rows, one subdirectory per year
+RAW_DIR = 'raw_trips'
+
+# Columns landed from each schema
+RAW_COLUMNS_2020 = clean_data.COLUMNS_2020
+RAW_COLUMNS_2017_TO_2019 = clean_data.PROJECTED_COLUMNS_2017_TO_2019
+
+# Numeric columns of the source schemas, stored as floats in every landed chunk
+RAW_NUMERIC_COLUMNS = ['start_station_id', 'end_station_id', 'start_lat', 'start_lng',
+                       'end_lat', 'end_lng', 'trip_id', 'from_station_id']
+
+
+def land_chunk(chunk, path):
+    '''
+    A helper function that writes one source chunk with the same dtypes whatever
+    its values, so the landed files of a year share one schema.
+
+    Parameters
+    ----------
+    chunk : A dataframe of source rows.
+    path : The Parquet file to write.
+    '''
+    chunk = chunk.copy()
+    for column in chunk.columns:
+        if column in RAW_NUMERIC_COLUMNS:
+            chunk[column] = pd.to_numeric(chunk[column]).astype('float64')
+        elif chunk[column].dtype == object:
+            chunk[column] = chunk[column].astype('string')
+
+    chunk.to_parquet(path, index=False)
+
+
+@instrumentation.instrumented('land_raw_trips')
+def extract_to_parquet(cnx, raw_dir=RAW_DIR, chunksize=1000000):
+    '''
+    A function that streams every source table from the database into Parquet
+    files, one file per chunk. Nothing is filtered, so the lazy queries see the
+    rows the full extraction returns.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    raw_dir : The directory the files are written to (replaced).
+    chunksize : The number of rows read and written at a time.
+
+    Returns
+    -------
+    A dictionary of the landed files of every year, as glob patterns.
+    '''
+    sources = {}
+    for year, tables in clean_data.SOURCE_TABLES.items():
+        year_dir = os.path.join(raw_dir, str(year))
+        for path in glob.glob(os.path.join(year_dir, '*.parquet')):
+            os.remove(path)
+        os.makedirs(year_dir, exist_ok=True)
+
+        columns = RAW_COLUMNS_2020 if year == 2020 else RAW_COLUMNS_2017_TO_2019
+        for table in tables:
+            query = 'SELECT ' + ', '.join(columns) + ' FROM ' + table
+            for number, chunk in enumerate(clean_data.stream_source_table(
+                    cnx, table, year, chunksize, query=query)):
+                land_chunk(chunk, os.path.join(year_dir, table + '_' + str(number) + '.parquet'))
+        sources[year] = os.path.join(year_dir, '*.parquet')
+
+    return sources
+
+
+def clean_year_lazy(lazy_trips, dedupe=False):
+    '''
+    A function that expresses the cleaning of one year of source rows as a lazy
+    query. Rows of the 2020 schema with any null or on an electric bike are
+    dropped and their columns renamed, as in clean_data.clean_2020_dataframe.
+
+    Parameters
+    ----------
+    lazy_trips : A Polars LazyFrame of source rows in the 2020 or 2017-2019 schema.
+    dedupe : If True, keep the first trip of every trip_id/ride_id.
+
+    Returns
+    -------
+    A LazyFrame with the cleaned columns and start coordinates (null before 2020).
+    '''
+    import polars as pl # pylint: disable=import-outside-toplevel
+
+    names = lazy_trips.collect_schema().names()
+    id_column = 'ride_id' if 'started_at' in names else 'trip_id'
+    if dedupe and id_column in names:
+        lazy_trips = lazy_trips.unique(subset=[id_column], keep='first', maintain_order=True)
+
+    if 'started_at' in names:
+        # Drop nulls and electric bikes, then rename columns to match prior years
+        lazy_trips = lazy_trips.drop_nulls().filter(pl.col('rideable_type') != 'electric_bike')
+        lazy_trips = lazy_trips.rename({'started_at': 'start_time',
+                                        'start_station_id': 'from_station_id'})
+        coordinates = [pl.col(column).cast(pl.Float32)
+                       for column in clean_data.COORDINATE_COLUMNS]
+    else:
+        coordinates = [pl.lit(None, dtype=pl.Float32).alias(column)
+                       for column in clean_data.COORDINATE_COLUMNS]
+
+    return lazy_trips.select(
+        'start_time',
+        pl.col('from_station_id').cast(pl.Int16),
+        pl.col('start_time').dt.truncate('1d').alias('start_day_of_year'),
+        pl.col('start_time').dt.month().cast(pl.Int8).alias('month'),
+        *coordinates)
+
+
+def daily_rides_lazy(lazy_trips):
+    '''
+    A function that expresses the daily ride count of every station as a lazy query.
+
+    Parameters
+    ----------
+    lazy_trips : A LazyFrame of cleaned trips.
+
+    Returns
+    -------
+    A LazyFrame with from_station_id, start_day_of_year and number_daily_rides columns.
+    '''
+    import polars as pl # pylint: disable=import-outside-toplevel
+
+    return lazy_trips.group_by(['from_station_id', 'start_day_of_year']).agg(
+        pl.col('month').count().cast(pl.Int32).alias('number_daily_rides'))
+
+
+def to_pandas_trips(cleaned_trips):
+    '''
+    A helper function that converts cleaned Polars trips to a pandas dataframe with
+    compact dtypes, adding zip codes when the boundary file is available.
+
+    Parameters
+    ----------
+    cleaned_trips : A Polars DataFrame of cleaned trips.
+
+    Returns
+    -------
+    A pandas dataframe of cleaned trips.
+    '''
+    trip_data = schema.enforce_dtypes(cleaned_trips.to_pandas())
+    if os.path.exists(zip_boundaries.BOUNDARIES_PATH):
+        trip_data = zip_boundaries.assign_trip_zip_codes(trip_data)
+
+    return trip_data
+
+
+@instrumentation.instrumented('clean_out_of_core')
+def clean_out_of_core(sources, dedupe=False, snap_dockless=False, save_daily=True):
+    '''
+    A function that cleans every year of landed source rows with the lazy queries,
+    one year at a time on Polars' streaming engine, and saves the results to the store.
+
+    Parameters
+    ----------
+    sources : A dictionary of Parquet sources by year (files, glob patterns or lists
+    of files), newest year first, e.g. from extract_to_parquet.
+    dedupe : If True, drop repeated trips keyed on trip_id/ride_id within each year.
+    snap_dockless : Snapping dockless trips is not supported by this backend.
+    save_daily : If True, also count and save the daily rides.
+
+    Returns
+    -------
+    This saves the cleaned trips partitioned by year and month, a daily ride dataframe
+    and the memory report of every year.
+    '''
+    import polars as pl # pylint: disable=import-outside-toplevel
+
+    if snap_dockless:
+        raise ValueError('Dockless trips can only be snapped by the pandas backend')
+
+    memory_report = []
+    daily_counts = []
+    storage.remove_table(storage.TRIPS_TABLE)
+
+    for year, source in sources.items():
+        cleaned_trips = clean_year_lazy(pl.scan_parquet(source), dedupe).collect(
+            engine='streaming')
+        if save_daily:
+            daily_counts.append(daily_rides_lazy(cleaned_trips.lazy()).collect())
+
+        trip_data = to_pandas_trips(cleaned_trips)
+        del cleaned_trips
+        schema.record_memory(memory_report, 'cleaned_' + str(year), trip_data)
+        with instrumentation.stage('save_trips', len(trip_data)):
+            storage.save_trips(trip_data, append=True)
+
+    if save_daily:
+        daily_df_2017_to_2020 = schema.enforce_dtypes(pl.concat(daily_counts).sort(
+            ['from_station_id', 'start_day_of_year']).to_pandas())
+        schema.record_memory(memory_report, 'daily', daily_df_2017_to_2020)
+        storage.save_dataframe(daily_df_2017_to_2020, storage.DAILY_TABLE)
+
+    storage.save_dataframe(pd.DataFrame(memory_report), schema.MEMORY_REPORT_TABLE)
+
+
+@instrumentation.instrumented('daily_groupby_out_of_core')
+def stored_daily_rides(storage_dir=storage.STORAGE_DIR):
+    '''
+    A function that counts the rides of every station and day from the stored trips
+    with a lazy query, reading only the station and day columns.
+
+    Parameters
+    ----------
+    storage_dir : The directory holding every table.
+
+    Returns
+    -------
+    A daily ride dataframe with a number_daily_rides column.
+    '''
+    import polars as pl # pylint: disable=import-outside-toplevel
+
+    lazy_trips = pl.scan_parquet(
+        os.path.join(storage.table_path(storage.TRIPS_TABLE, storage_dir), '**', '*.parquet'),
+        hive_partitioning=True)
+    daily_df_2017_to_2020 = daily_rides_lazy(lazy_trips).sort(
+        ['from_station_id', 'start_day_of_year']).collect(engine='streaming')
+
+    return schema.enforce_dtypes(daily_df_2017_to_2020.to_pandas())
+
+
+def main(chunksize=100000, database_url=None):
+    '''
+    Lands the source tables as Parquet files and cleans them out of core, saving the
+    same tables as clean_data.main in 'full' mode.
+
+    Parameters
+    ----------
+    chunksize : The number of rows landed per chunk.
+    database_url : A SQLAlchemy database URL (see clean_data.database_engine).
+    '''
+    # Deduplicate like the UNION queries of the full extraction
+    sources = extract_to_parquet(clean_data.database_engine(database_url), chunksize=chunksize)
+    clean_out_of_core(sources, dedupe=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'''
+This module stores fitted Prophet models as versioned JSON documents. Models are
+serialized with Prophet's JSON serialization with their training history trimmed and
+saved under a content-addressed version together with the training data hash,
+hyperparameters and metrics. Loaded models are kept in an in-process LRU cache.
+'''
+import datetime
+import functools
+import hashlib
+import io
+import json
+import os
+import pandas as pd
+try:
+    from prophet.serialize import model_from_json
+    from prophet.serialize import model_to_json
+except ImportError: # Prophet was published as fbprophet before version 1.0
+    from fbprophet.serialize import model_from_json
+    from fbprophet.serialize import model_to_json
+
+# Directory holding every registered model
+REGISTRY_DIR = 'model_registry'
+
+# Name of the file listing the versions of a model
+INDEX_FILE = 'index.json'
+
+
+def data_hash(dataframe):
+    '''
+    A helper function that fingerprints the contents of a dataframe.
+
+    Parameters
+    ----------
+    dataframe : The dataframe to fingerprint.
+
+    Returns
+    -------
+    The hex digest of the dataframe's row hashes.
+    '''
+    row_hashes = pd.util.hash_pandas_object(dataframe, index=False).values
+
+    return hashlib.sha256(row_hashes.tobytes()).hexdigest()
+
+
+def serialize_model(prophet, include_history=False):
+    '''
+    A function that serializes a fitted Prophet model to JSON. By default only the
+    last row and date of the training history are kept (Prophet checks them to tell
+    a fitted model apart and to extend the history) and the fitted trend is dropped,
+    since predicting on a given dataframe recomputes both from the parameters. The
+    table mapping feature columns to components is written as a compact matrix
+    instead of one record per column, which made up half of the document.
+
+    Parameters
+    ----------
+    prophet : A fitted Prophet model.
+    include_history : If True, keep the training history in the document.
+
+    Returns
+    -------
+    The JSON string of the model.
+    '''
+    model_json = model_to_json(prophet)
+    if include_history:
+        return model_json
+
+    model_dict = json.loads(model_json)
+    history = pd.read_json(io.StringIO(model_dict['history']), typ='frame', orient='table')
+    model_dict['history'] = history.tail(1).to_json(orient='table', index=False)
+    history_dates = pd.read_json(io.StringIO(model_dict['history_dates']), typ='series',
+                                 orient='split')
+    model_dict['history_dates'] = history_dates.tail(1).to_json(orient='split',
+                                                                 date_format='iso')
+    model_dict['params'].pop('trend', None)
+    component_columns = pd.read_json(io.StringIO(model_dict['train_component_cols']),
+                                     typ='frame', orient='table')
+    model_dict['train_component_cols'] = component_columns.to_json(orient='split',
+                                                                   index=False)
+
+    return json.dumps(model_dict, separators=(',', ':'))
+
+
+def load_index(name, registry_dir=REGISTRY_DIR):
+    '''
+    A helper function that reads the list of registered versions of a model.
+
+    Parameters
+    ----------
+    name : The name of the model.
+    registry_dir : The directory holding every registered model.
+
+    Returns
+    -------
+    A list of version metadata dictionaries, oldest first.
+    '''
+    path = os.path.join(registry_dir, name, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def register_model(prophet, name, training_data, hyperparameters=None, metrics=None,
+                   registry_dir=REGISTRY_DIR):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that saves a fitted model under a version derived from its content.
+    Registering an identical model again returns the existing version.
+
+    Parameters
+    ----------
+    prophet : A fitted Prophet model.
+    name : The name of the model, e.g. 'city' or 'station_35'.
+    training_data : The dataframe the model was trained on.
+    hyperparameters : The hyperparameter dictionary used to build the model.
+    metrics : A dictionary of evaluation metrics.
+    registry_dir : The directory holding every registered model.
+
+    Returns
+    -------
+    The version of the registered model.
+    '''
+    model_json = serialize_model(prophet)
+    version = hashlib.sha256(model_json.encode()).hexdigest()[:16]
+
+    model_dir = os.path.join(registry_dir, name)
+    os.makedirs(model_dir, exist_ok=True)
+
+    index = load_index(name, registry_dir)
+    if any(entry['version'] == version for entry in index):
+        return version
+
+    with open(os.path.join(model_dir, version + '.json'), 'w', encoding='utf-8') as file:
+        file.write(model_json)
+
+    index.append({'version': version,
+                  'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'data_hash': data_hash(training_data),
+                  'hyperparameters': hyperparameters or {},
+                  'metrics': {metric: float(value) for metric, value in (metrics or {}).items()}})
+    with open(os.path.join(model_dir, INDEX_FILE), 'w', encoding='utf-8') as file:
+        json.dump(index, file, indent=2)
+
+    return version
+
+
+def list_versions(name, registry_dir=REGISTRY_DIR):
+    '''
+    A function that lists the registered versions of a model.
+
+    Parameters
+    ----------
+    name : The name of the model.
+    registry_dir : The directory holding every registered model.
+
+    Returns
+    -------
+    A dataframe with one row of metadata per version, oldest first.
+    '''
+    return pd.DataFrame(load_index(name, registry_dir))
+
+
+def load_metadata(name, version=None, registry_dir=REGISTRY_DIR):
+    '''
+    A function that returns the metadata of one registered version.
+
+    Parameters
+    ----------
+    name : The name of the model.
+    version : The version to describe (defaults to the latest).
+    registry_dir : The directory holding every registered model.
+
+    Returns
+    -------
+    The version's metadata dictionary.
+    '''
+    index = load_index(name, registry_dir)
+    if not index:
+        raise KeyError('No registered versions of model ' + name)
+    if version is None:
+        return index[-1]
+
+    for entry in index:
+        if entry['version'] == version:
+            return entry
+    raise KeyError('Model ' + name + ' has no version ' + version)
+
+
+def deserialize_model(model_json):
+    '''
+    A function that rebuilds a Prophet model from a document of serialize_model,
+    or from Prophet's own JSON serialization.
+
+    Parameters
+    ----------
+    model_json : The JSON string of the model.
+
+    Returns
+    -------
+    A fitted Prophet model.
+    '''
+    model_dict = json.loads(model_json)
+    component_columns = json.loads(model_dict['train_component_cols'])
+    if 'schema' not in component_columns:
+        # Prophet reads the table of components with its schema
+        model_dict['train_component_cols'] = pd.DataFrame(
+            component_columns['data'], columns=component_columns['columns']).to_json(
+                orient='table', index=False)
+
+    return model_from_json(json.dumps(model_dict))
+
+
+@functools.lru_cache(maxsize=256)
+def cached_model(path):
+    '''
+    A helper function that deserializes a model file, caching the result in-process.
+
+    Parameters
+    ----------
+    path : The path of the model's JSON document.
+
+    Returns
+    -------
+    A fitted Prophet model.
+    '''
+    with open(path, encoding='utf-8') as file:
+        return deserialize_model(file.read())
+
+
+def load_model(name, version=None, registry_dir=REGISTRY_DIR):
+    '''
+    A function that loads a registered model, reading it from disk only the first
+    time it is requested.
+
+    Parameters
+    ----------
+    name : The name of the model.
+    version : The version to load (defaults to the latest).
+    registry_dir : The directory holding every registered model.
+
+    Returns
+    -------
+    A fitted Prophet model.
+    '''
+    version = load_metadata(name, version, registry_dir)['version']
+
+    return cached_model(os.path.join(registry_dir, name, version + '.json'))
@@ -0,0 +1,587 @@
+'''
+This module runs the Divvy workflow as a graph of stages: extract, clean, daily
+aggregate, phase comparison, geocode, Tableau export, fit, cross-validation and
+predict. Stages exchange data through the Parquet store instead of files dropped
+in the current directory. Every stage is fingerprinted from its code, its config
+values, its input files and the outputs of the stages it reads, and a stage whose
+fingerprint matches the last successful run is skipped. Independent branches, such
+as forecasting and the Tableau export, run concurrently.
+'''
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+import backtesting
+import clean_data
+import data_visualizations
+import geocoding
+import lazy_cleaning
+import model_registry
+import phase_calendar
+import prophet_model
+import schema
+import station_snapping
+import storage
+import zip_boundaries
+
+# File recording the fingerprint and output digest of every completed stage
+STATE_PATH = 'pipeline_state.json'
+
+# Settings read by the stages; a stage only reruns when the keys it reads change
+DEFAULT_CONFIG = {'city': phase_calendar.DEFAULT_CITY,
+                  'snap_dockless': False,
+                  'backend': 'pandas',
+                  'hyperparameters': prophet_model.DEFAULT_HYPERPARAMETERS,
+                  'backtest': {'initial': '730 days', 'period': '180 days',
+                               'horizon': '122 days'}}
+
+# Tables holding the extracted source rows of every year, the phase comparison and
+# the zip code of every station
+RAW_TABLES = {year: 'raw_' + str(year) for year in clean_data.SOURCE_TABLES}
+PHASE_CHANGES_TABLE = 'phase_changes'
+STATION_ZIP_CODES_TABLE = 'station_zip_codes'
+
+# Files written by the forecasting stages
+FORECAST_PATH = 'forecast.pkl'
+PERFORMANCE_PATH = 'performance_results.pkl'
+
+
+class Stage: # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    '''
+    A step of the pipeline and everything its fingerprint is built from.
+
+    Parameters
+    ----------
+    name : The name of the stage.
+    run : A callable taking the config that produces the stage's outputs.
+    upstream : The names of the stages whose outputs it reads.
+    modules : The modules whose source code it depends on.
+    files : Input files outside the pipeline, e.g. the phase calendar.
+    config_keys : The config keys it reads.
+    outputs : The files and directories it writes.
+    inputs : An optional callable taking the config and returning a JSON-serializable
+    description of external inputs, e.g. database watermarks.
+    '''
+    def __init__(self, name, run, upstream=(), modules=(), files=(), config_keys=(),
+                 outputs=(), inputs=None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.name = name
+        self.run = run
+        self.upstream = list(upstream)
+        self.modules = list(modules)
+        self.files = list(files)
+        self.config_keys = list(config_keys)
+        self.outputs = list(outputs)
+        self.inputs = inputs
+
+
+def path_digest(paths):
+    '''
+    A helper function that fingerprints the contents of files and directories.
+    Missing paths are part of the fingerprint, so creating one changes it.
+
+    Parameters
+    ----------
+    paths : A list of file or directory paths.
+
+    Returns
+    -------
+    The hex digest of every file's relative path and contents.
+    '''
+    digest = hashlib.sha256()
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(directory, name)
+                           for directory, _, names in os.walk(path) for name in names)
+        else:
+            files = [path]
+
+        for file_path in files:
+            digest.update(file_path.encode())
+            if not os.path.exists(file_path):
+                digest.update(b'missing')
+                continue
+            with open(file_path, 'rb') as file:
+                for block in iter(functools.partial(file.read, 2 ** 20), b''):
+                    digest.update(block)
+
+    return digest.hexdigest()
+
+
+def stage_fingerprint(stage, config, upstream_digests, inputs=None):
+    '''
+    A function that fingerprints everything a stage's outputs depend on.
+
+    Parameters
+    ----------
+    stage : The Stage.
+    config : The pipeline config.
+    upstream_digests : A dictionary of output digests by upstream stage name.
+    inputs : The description of the stage's external inputs (see stage_inputs).
+
+    Returns
+    -------
+    The hex digest of the stage's code, config values, input files, external inputs
+    and upstream outputs. The code covers the source of the stage's modules and of its
+    run function.
+    '''
+    fingerprint = {'code': path_digest([inspect.getfile(module) for module in stage.modules]),
+                   'run': inspect.getsource(stage.run),
+                   'config': {key: config.get(key) for key in stage.config_keys},
+                   'files': path_digest(stage.files),
+                   'inputs': inputs,
+                   'upstream': {name: upstream_digests[name] for name in stage.upstream}}
+
+    fingerprint = json.dumps(fingerprint, sort_keys=True, default=str)
+
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def load_state(state_path=STATE_PATH):
+    '''
+    A helper function that reads the recorded stage fingerprints.
+
+    Parameters
+    ----------
+    state_path : The state file (missing on the first run).
+
+    Returns
+    -------
+    A dictionary of stage records by stage name.
+    '''
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_state(state, state_path=STATE_PATH):
+    '''
+    A helper function that writes the stage fingerprints, replacing the file atomically.
+
+    Parameters
+    ----------
+    state : A dictionary of stage records by stage name.
+    state_path : The state file.
+    '''
+    temporary_path = state_path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+    os.replace(temporary_path, state_path)
+
+
+def source_watermarks(config): # pylint: disable=unused-argument
+    '''
+    A function that reads the row count and latest start time of every source table,
+    which is much cheaper than extracting the tables.
+
+    Parameters
+    ----------
+    config : The pipeline config.
+
+    Returns
+    -------
+    A dictionary of row counts and latest start times by source table.
+    '''
+    cnx = clean_data.database_engine(pool_size=1)
+    watermarks = {}
+    for year, tables in clean_data.SOURCE_TABLES.items():
+        start_column = 'started_at' if year == 2020 else 'start_time'
+        for table in tables:
+            watermark = pd.read_sql_query('SELECT COUNT(*) AS row_count, MAX(' + start_column +
+                                          ') AS max_start_time FROM ' + table, cnx).iloc[0]
+            watermarks[table] = [int(watermark['row_count']), str(watermark['max_start_time'])]
+
+    return watermarks
+
+
+def run_extract(config): # pylint: disable=unused-argument
+    '''
+    Extracts every year of source rows from PostgreSQL into the store.
+    '''
+    for year, yearly_data in zip(clean_data.SOURCE_TABLES, clean_data.sql_to_dataframe()):
+        storage.save_dataframe(yearly_data, RAW_TABLES[year])
+
+
+def run_clean(config):
+    '''
+    Cleans the extracted rows and stores the trips and their memory report.
+    '''
+    if config['backend'] == 'polars':
+        lazy_cleaning.clean_out_of_core(
+            {year: storage.table_path(RAW_TABLES[year]) for year in clean_data.SOURCE_TABLES},
+            snap_dockless=config['snap_dockless'], save_daily=False)
+        return
+
+    memory_report = []
+    all_data_2017_to_2020 = clean_data.clean_trips(
+        *(storage.load_dataframe(RAW_TABLES[year]) for year in clean_data.SOURCE_TABLES),
+        snap_dockless=config['snap_dockless'], memory_report=memory_report)
+    storage.save_trips(all_data_2017_to_2020)
+    storage.save_dataframe(pd.DataFrame(memory_report), schema.MEMORY_REPORT_TABLE)
+
+
+def run_daily_aggregate(config):
+    '''
+    Counts the stored trips per station and day.
+    '''
+    if config['backend'] == 'polars':
+        storage.save_dataframe(lazy_cleaning.stored_daily_rides(), storage.DAILY_TABLE)
+        return
+
+    trip_data = storage.load_dataframe(
+        storage.TRIPS_TABLE, columns=['from_station_id', 'start_day_of_year', 'month'])
+    storage.save_dataframe(clean_data.aggregate_daily_rides(trip_data), storage.DAILY_TABLE)
+
+
+def run_phase_comparison(config):
+    '''
+    Compares every station's rides in each 2020 phase with the comparison year.
+    '''
+    calendar = phase_calendar.load_phase_calendar(config['city'])
+    all_data_2020, all_data_2019 = data_visualizations.load_phase_trips(calendar)
+    storage.save_dataframe(
+        data_visualizations.phase_percent_change(all_data_2020, all_data_2019, calendar),
+        PHASE_CHANGES_TABLE)
+
+
+def stations_with_phase_changes():
+    '''
+    A helper function that merges the stored phase comparison with the station list.
+
+    Returns
+    -------
+    A dataframe with the phase changes and location of every compared station.
+    '''
+    phase_changes = storage.load_dataframe(PHASE_CHANGES_TABLE)
+    phase_changes['from_station_id'] = np.asarray(phase_changes['from_station_id'])
+
+    return data_visualizations.divvy_data_with_lat_lng(
+        phase_changes, pd.read_csv(data_visualizations.STATIONS_PATH))
+
+
+def run_geocode(config): # pylint: disable=unused-argument
+    '''
+    Assigns every compared station to its zip code.
+    '''
+    storage.save_dataframe(
+        data_visualizations.get_zip_codes_from_google_api(stations_with_phase_changes()),
+        STATION_ZIP_CODES_TABLE)
+
+
+def run_tableau_export(config):
+    '''
+    Writes the csv file uploaded into Tableau.
+    '''
+    data_visualizations.dataframe_for_tableau(
+        storage.load_dataframe(STATION_ZIP_CODES_TABLE), stations_with_phase_changes(),
+        pd.read_csv(data_visualizations.POPULATION_PATH),
+        phase_calendar.load_phase_calendar(config['city']))
+
+
+def run_fit(config):
+    '''
+    Fits and registers the city model.
+    '''
+    daily_df_2017_to_2020 = storage.load_dataframe(storage.DAILY_TABLE)
+    prophet = prophet_model.fit_model(daily_df_2017_to_2020,
+                                    phase_calendar.load_phase_calendar(config['city']),
+                                    config['hyperparameters'])
+    model_registry.register_model(
+        prophet, 'city', daily_df_2017_to_2020,
+        hyperparameters=dict(prophet_model.DEFAULT_HYPERPARAMETERS, **config['hyperparameters']))
+
+
+def run_cross_validation(config):
+    '''
+    Backtests the city model and pickles its performance metrics.
+    '''
+    _, performance_results, _ = backtesting.backtest(
+        storage.load_dataframe(storage.DAILY_TABLE),
+        calendar=phase_calendar.load_phase_calendar(config['city']),
+        hyperparameters=config['hyperparameters'], **config['backtest'])
+    performance_results.to_pickle(PERFORMANCE_PATH)
+
+
+def run_predict(config):
+    '''
+    Forecasts the rest of the year with the latest registered city model.
+    '''
+    prophet = model_registry.load_model('city')
+    forecast = prophet.predict(
+        prophet_model.forecast_dataframe(phase_calendar.load_phase_calendar(config['city'])))
+    forecast.to_pickle(FORECAST_PATH)
+
+
+def build_stages():
+    '''
+    A function that declares the stages of the Divvy workflow.
+
+    Returns
+    -------
+    A list of Stages.
+    '''
+    calendar_files = [phase_calendar.DEFAULT_CALENDAR_PATH]
+    forecast_modules = [phase_calendar, prophet_model, storage]
+
+    return [
+        Stage('extract', run_extract, modules=[clean_data, storage, schema],
+              outputs=[storage.table_path(table) for table in RAW_TABLES.values()],
+              inputs=source_watermarks),
+        Stage('clean', run_clean, upstream=['extract'],
+              modules=[clean_data, lazy_cleaning, schema, station_snapping, storage,
+                       zip_boundaries],
+              files=[station_snapping.STATIONS_PATH, zip_boundaries.BOUNDARIES_PATH],
+              config_keys=['snap_dockless', 'backend'],
+              outputs=[storage.table_path(storage.TRIPS_TABLE),
+                       storage.table_path(schema.MEMORY_REPORT_TABLE)]),
+        Stage('daily_aggregate', run_daily_aggregate, upstream=['clean'],
+              modules=[clean_data, lazy_cleaning, schema, storage], config_keys=['backend'],
+              outputs=[storage.table_path(storage.DAILY_TABLE)]),
+        Stage('phase_comparison', run_phase_comparison, upstream=['clean'],
+              modules=[data_visualizations, phase_calendar, storage], files=calendar_files,
+              config_keys=['city'], outputs=[storage.table_path(PHASE_CHANGES_TABLE)]),
+        Stage('geocode', run_geocode, upstream=['phase_comparison'],
+              modules=[data_visualizations, geocoding, storage, zip_boundaries],
+              files=[data_visualizations.STATIONS_PATH, geocoding.SEED_PATH,
+                     zip_boundaries.BOUNDARIES_PATH],
+              outputs=[storage.table_path(STATION_ZIP_CODES_TABLE)]),
+        Stage('tableau_export', run_tableau_export, upstream=['phase_comparison', 'geocode'],
+              modules=[data_visualizations, storage],
+              files=calendar_files + [data_visualizations.STATIONS_PATH,
+                                      data_visualizations.POPULATION_PATH],
+              config_keys=['city'], outputs=[data_visualizations.TABLEAU_PATH]),
+        Stage('fit', run_fit, upstream=['daily_aggregate'],
+              modules=forecast_modules + [model_registry], files=calendar_files,
+              config_keys=['city', 'hyperparameters'],
+              outputs=[os.path.join(model_registry.REGISTRY_DIR, 'city')]),
+        Stage('cross_validation', run_cross_validation, upstream=['daily_aggregate'],
+              modules=forecast_modules + [backtesting], files=calendar_files,
+              config_keys=['city', 'hyperparameters', 'backtest'], outputs=[PERFORMANCE_PATH]),
+        Stage('predict', run_predict, upstream=['fit'],
+              modules=forecast_modules + [model_registry], files=calendar_files,
+              config_keys=['city'], outputs=[FORECAST_PATH]),
+    ]
+
+
+def select_stages(stages, targets=None):
+    '''
+    A helper function that checks the stage graph and keeps the targets and every
+    stage they depend on.
+
+    Parameters
+    ----------
+    stages : A list of Stages.
+    targets : The names of the stages to bring up to date (defaults to every stage).
+
+    Returns
+    -------
+    A dictionary of the selected Stages by name, in declaration order.
+    '''
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for name in stage.upstream:
+            if name not in by_name:
+                raise ValueError('Stage ' + stage.name + ' depends on unknown stage ' + name)
+
+    # Reject cycles with a depth-first search
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visiting:
+            raise ValueError('Stage ' + name + ' is part of a cycle')
+        if name not in visited:
+            visiting.add(name)
+            for upstream in by_name[name].upstream:
+                visit(upstream)
+            visiting.remove(name)
+            visited.add(name)
+
+    for name in targets or by_name:
+        if name not in by_name:
+            raise ValueError('Unknown stage ' + name)
+        visit(name)
+
+    return {stage.name: stage for stage in stages if stage.name in visited}
+
+
+def stage_inputs(stage, config, recorded):
+    '''
+    A function that describes a stage's external inputs, e.g. the watermarks of the
+    source tables, read on every run so new source rows make the stage stale. When
+    they cannot be read, e.g. without a live database, the recorded inputs are used
+    so the stages downstream of the sources can still be checked.
+
+    Parameters
+    ----------
+    stage : The Stage.
+    config : The pipeline config.
+    recorded : The stage's record from the last successful run, or None.
+
+    Returns
+    -------
+    The description of the external inputs, or None if the stage has none.
+    '''
+    if stage.inputs is None:
+        return None
+    recorded_inputs = (recorded or {}).get('inputs')
+
+    try:
+        return stage.inputs(config)
+    except Exception as error: # pylint: disable=broad-except
+        if recorded_inputs is None:
+            raise
+        logging.warning('Reading the inputs of stage %s failed, using the recorded ones: %s',
+                        stage.name, error)
+        return recorded_inputs
+
+
+def is_current(stage, fingerprint, recorded):
+    '''
+    A helper function that checks whether a stage can be skipped: its fingerprint
+    matches the last successful run and its outputs still exist.
+
+    Parameters
+    ----------
+    stage : The Stage.
+    fingerprint : The stage's current fingerprint.
+    recorded : The stage's record from the last successful run, or None.
+
+    Returns
+    -------
+    True if the stage is up to date.
+    '''
+    return (recorded is not None and recorded['fingerprint'] == fingerprint
+            and all(os.path.exists(path) for path in stage.outputs))
+
+
+def run_stage(run, config, outputs):
+    '''
+    A function that runs a stage in a worker process and fingerprints its outputs.
+
+    Parameters
+    ----------
+    run : The stage's run function.
+    config : The pipeline config.
+    outputs : The files and directories the stage writes.
+
+    Returns
+    -------
+    The output digest and the seconds taken.
+    '''
+    started = time.perf_counter()
+    run(config)
+
+    return path_digest(outputs), time.perf_counter() - started
+
+
+def run_pipeline(config=None, targets=None, force=(), max_workers=4, stages=None,
+                 state_path=STATE_PATH, refresh_sources=False):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    '''
+    A function that brings the targets up to date. Each stage is fingerprinted as
+    soon as the stages it reads have finished; stale stages start right away in a
+    process pool, so independent branches run concurrently (and the forecasting
+    stages can start process pools of their own). Failures are recorded instead of
+    raised: stages downstream of a failure are blocked and the others still run.
+
+    Parameters
+    ----------
+    config : A dictionary overriding DEFAULT_CONFIG.
+    targets : The names of the stages to bring up to date (defaults to every stage).
+    force : The names of stages to run even if their fingerprints are unchanged.
+    max_workers : The number of stages run at the same time.
+    stages : A list of Stages (defaults to build_stages()).
+    state_path : The file recording the fingerprints of completed stages.
+    refresh_sources : If True, run the stages reading external inputs, such as the
+    extraction of the source tables, even if their watermarks are unchanged.
+
+    Returns
+    -------
+    A dataframe with one record per selected stage: its status ('ran', 'skipped',
+    'failed' or 'blocked'), fingerprint, output digest, seconds taken and error.
+    '''
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    selected = select_stages(stages or build_stages(), targets)
+    state = load_state(state_path)
+    if refresh_sources:
+        force = set(force) | {name for name, stage in selected.items()
+                              if stage.inputs is not None}
+
+    records = {}
+    running = {}
+    pending = {}
+    inputs = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while len(records) < len(selected):
+            for name, stage in selected.items():
+                upstream = [records.get(upstream_name) for upstream_name in stage.upstream]
+                if name in records or name in running.values() or None in upstream:
+                    continue
+
+                record = {'stage': name, 'status': 'blocked', 'fingerprint': None,
+                          'output_digest': None, 'seconds': 0.0, 'error': None}
+                if any(upstream_record['status'] in ['failed', 'blocked']
+                       for upstream_record in upstream):
+                    records[name] = record
+                    continue
+                try:
+                    inputs[name] = stage_inputs(stage, config, state.get(name))
+                    record['fingerprint'] = stage_fingerprint(
+                        stage, config, {upstream_record['stage']: upstream_record['output_digest']
+                                        for upstream_record in upstream}, inputs[name])
+                except Exception as error: # pylint: disable=broad-except
+                    record.update(status='failed', error=repr(error))
+                    records[name] = record
+                    continue
+
+                if name not in force and is_current(stage, record['fingerprint'], state.get(name)):
+                    record.update(status='skipped', output_digest=state[name]['output_digest'])
+                    records[name] = record
+                else:
+                    logging.info('Running stage %s', name)
+                    pending[name] = record
+                    running[executor.submit(run_stage, stage.run, config, stage.outputs)] = name
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                record = records[name] = pending.pop(name)
+                try:
+                    record['output_digest'], record['seconds'] = future.result()
+                except Exception as error: # pylint: disable=broad-except
+                    record.update(status='failed', error=repr(error))
+                    logging.warning('Stage %s failed: %s', name, record['error'])
+                    continue
+
+                record['status'] = 'ran'
+                state[name] = {'fingerprint': record['fingerprint'],
+                               'output_digest': record['output_digest'],
+                               'seconds': record['seconds'],
+                               'inputs': inputs[name],
+                               'completed': datetime.datetime.now().isoformat(timespec='seconds')}
+                save_state(state, state_path)
+
+    return pd.DataFrame([records[name] for name in selected])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bring the Divvy pipeline up to date.')
+    parser.add_argument('--refresh-sources', action='store_true',
+                        help='extract the source tables again even if their watermarks '
+                             'are unchanged')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(run_pipeline(refresh_sources=arguments.refresh_sources)[
+        ['stage', 'status', 'seconds', 'error']])
@@ -0,0 +1,252 @@
+'''
+This module builds, fits and predicts the Facebook Prophet model of daily Divvy
+rides: the Covid and phase seasonality conditions, the model with its conditional
+seasonalities and holidays, and the training and forecast frames. The forecasting
+script, backtesting, tuning and the other model consumers all build on it.
+'''
+import logging
+import multiprocessing
+import pandas as pd
+try:
+    from prophet import Prophet
+except ImportError: # Prophet was published as fbprophet before version 1.0
+    from fbprophet import Prophet
+import instrumentation
+import phase_calendar
+
+# Prophet priors and Fourier orders of the conditional seasonalities
+DEFAULT_HYPERPARAMETERS = {'seasonality_prior_scale': 20,
+                           'changepoint_prior_scale': 0.2,
+                           'covid_fourier_order': 10,
+                           'precovid_fourier_order': 3,
+                           'phase_fourier_order': 5}
+
+# Models are trained before the forecast start and predict through the end of the year
+FORECAST_START = pd.Timestamp(2020, 8, 1)
+FORECAST_END = pd.Timestamp(2020, 12, 31)
+FORECAST_PERIODS = 153
+
+# Start method of the forecasting worker processes. Workers forked from a process that
+# already fitted a model deadlock in cmdstanpy's multithreaded CSV reader, so they are
+# forked from a clean server process where the platform has one
+WORKER_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+def phase_conditions(calendar=None):
+    '''
+    A helper function that lists the Prophet seasonality conditions of a phase calendar:
+    covid and precovid plus every phase modelled with its own seasonality and its
+    complement.
+
+    Parameters
+    ----------
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    A list of condition column names.
+    '''
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+
+    conditions = ['covid', 'precovid']
+    for name in calendar['seasonality_phases']:
+        conditions += [name, 'not_' + name]
+
+    return conditions
+
+
+def add_phase_regressors(dataframe, calendar=None):
+    '''
+    A helper function that adds the Covid and phase condition columns (and their
+    complements) to a dataframe with a ds column in one vectorized pass.
+
+    Parameters
+    ----------
+    dataframe : A dataframe with a ds date column.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    The dataframe with one boolean column per Prophet seasonality condition.
+    '''
+    indicators = phase_calendar.phase_indicators(dataframe['ds'], calendar)
+    for condition in phase_conditions(calendar):
+        dataframe[condition] = indicators[condition].values
+
+    return dataframe
+
+
+def add_phase_seasonalities(prophet, calendar=None, hyperparameters=None):
+    '''
+    A helper function that adds a before/during Covid weekly seasonality and an
+    in/out of phase yearly seasonality for every modelled phase to a Prophet model.
+
+    Parameters
+    ----------
+    prophet : An unfitted Prophet model.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of Fourier orders (defaults to DEFAULT_HYPERPARAMETERS).
+
+    Returns
+    -------
+    The Prophet model with the conditional seasonalities added.
+    '''
+    hyperparameters = dict(DEFAULT_HYPERPARAMETERS, **(hyperparameters or {}))
+
+    prophet.add_seasonality(name='covid', period=7,
+                            fourier_order=hyperparameters['covid_fourier_order'],
+                            condition_name='covid')
+    prophet.add_seasonality(name='precovid', period=7,
+                            fourier_order=hyperparameters['precovid_fourier_order'],
+                            condition_name='precovid')
+    for condition in phase_conditions(calendar)[2:]:
+        prophet.add_seasonality(
+            name=condition, period=365.25,
+            fourier_order=hyperparameters['phase_fourier_order'], condition_name=condition)
+
+    return prophet
+
+
+def build_prophet_model(calendar=None, hyperparameters=None):
+    '''
+    A function that creates an unfitted Prophet model with the Covid and phase
+    seasonalities and US holidays.
+
+    Parameters
+    ----------
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    DEFAULT_HYPERPARAMETERS).
+
+    Returns
+    -------
+    An unfitted Prophet model.
+    '''
+    hyperparameters = dict(DEFAULT_HYPERPARAMETERS, **(hyperparameters or {}))
+
+    prophet = Prophet(daily_seasonality=False, weekly_seasonality=False, yearly_seasonality=False,
+                      seasonality_prior_scale=hyperparameters['seasonality_prior_scale'],
+                      changepoint_prior_scale=hyperparameters['changepoint_prior_scale'])
+    prophet = add_phase_seasonalities(prophet, calendar, hyperparameters)
+    prophet.add_country_holidays(country_name='US')
+
+    return prophet
+
+
+def prepare_training_data(dataframe, calendar=None):
+    '''
+    A helper function that renames the daily ride columns to Prophet's ds and y and
+    adds the seasonality condition columns.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    A dataframe with ds, y and condition columns.
+    '''
+    # Rename columns to match requirement for Prophet
+    dataframe = dataframe.rename(columns={'number_daily_rides': 'y', 'start_day_of_year': 'ds'})
+
+    # Drop all other columns
+    dataframe = dataframe[['ds', 'y']].copy()
+
+    # Add columns for Covid and phase seasonality
+    return add_phase_regressors(dataframe, calendar)
+
+
+def fit_model(dataframe, calendar=None, hyperparameters=None):
+    '''
+    A function that fits a Prophet model on the daily rides before FORECAST_START.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    DEFAULT_HYPERPARAMETERS).
+
+    Returns
+    -------
+    The fitted Prophet model.
+    '''
+    dataframe = prepare_training_data(dataframe, calendar)
+    cross_val_data = dataframe[(dataframe.ds < FORECAST_START)]
+
+    # Run model
+    prophet = build_prophet_model(calendar, hyperparameters)
+    with instrumentation.stage('prophet_fit', len(cross_val_data)):
+        prophet.fit(cross_val_data)
+
+    return prophet
+
+
+def forecast_dataframe(calendar=None):
+    '''
+    A helper function that builds the days from FORECAST_START through FORECAST_END
+    with their seasonality condition columns.
+
+    Parameters
+    ----------
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    A dataframe with ds and condition columns.
+    '''
+    future = pd.DataFrame({'ds': pd.date_range(FORECAST_START, FORECAST_END)})
+
+    return add_phase_regressors(future, calendar)
+
+
+def fit_and_forecast(dataframe, calendar=None, hyperparameters=None):
+    '''
+    A function that fits a Prophet model on the daily rides before FORECAST_START and
+    predicts through FORECAST_END.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+    hyperparameters : A dictionary of priors and Fourier orders (defaults to
+    DEFAULT_HYPERPARAMETERS).
+
+    Returns
+    -------
+    The fitted Prophet model and its forecast dataframe.
+    '''
+    prophet = fit_model(dataframe, calendar, hyperparameters)
+
+    future = prophet.make_future_dataframe(periods=FORECAST_PERIODS)
+    future = add_phase_regressors(future, calendar)
+
+    test_data = future[(future.ds >= FORECAST_START) & (future.ds <= FORECAST_END)]
+    with instrumentation.stage('prophet_predict', len(test_data)) as record:
+        forecast = prophet.predict(test_data)
+        record['rows_out'] = len(forecast)
+
+    return prophet, forecast
+
+
+def init_forecasting_worker():
+    '''
+    Initializes a forecasting worker process: quiets Prophet's logging and, under
+    fbprophet, loads the compiled Stan model once so every model fitted in the worker
+    reuses it instead of loading it again.
+    '''
+    logging.getLogger(Prophet.__module__.split('.')[0]).setLevel(logging.WARNING)
+    logging.getLogger('cmdstanpy').setLevel(logging.WARNING)
+
+    # Prophet 1.x only points cmdstanpy at its compiled executable, in well under a
+    # millisecond, so its backend is left alone. fbprophet unpickles the PyStan model
+    # in every Prophet() and takes no loaded model or backend instance, so there the
+    # backend class is patched, in this worker process only, to hand back the model
+    # loaded here
+    if Prophet.__module__.startswith('fbprophet'):
+        stan_backend = Prophet().stan_backend
+        stan_model = stan_backend.model
+        type(stan_backend).load_model = lambda self: stan_model
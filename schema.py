@@ -0,0 +1,173 @@
+'''
+This module defines the compact dtypes of the Divvy tables and enforces them
+wherever frames are read, from SQL or from the Parquet store. Days are datetime64
+rather than Python date objects, station ids are categories over the smallest
+integer ids that hold them (int16 for the Divvy docks), months and phase flags are
+int8, and coordinates are float32. A memory report records the size of the frames
+at every stage of a run.
+'''
+import timeit
+import numpy as np
+import pandas as pd
+
+# Compact dtype of every known Divvy column
+COLUMN_DTYPES = {'start_time': 'datetime64[ns]',
+                 'start_day_of_year': 'datetime64[ns]',
+                 'from_station_id': 'category',
+                 'year': 'int16',
+                 'month': 'int8',
+                 'start_lat': 'float32',
+                 'start_lng': 'float32',
+                 'start_zip_code': 'float32',
+                 'number_daily_rides': 'int32'}
+
+# Integer dtypes of station ids, smallest first; the smallest holding every id is used
+STATION_ID_DTYPES = ['int16', 'int32', 'int64']
+
+# Dtype of 0/1 phase indicator columns
+PHASE_FLAG_DTYPE = 'int8'
+
+# Table holding the memory report of the latest cleaning run
+MEMORY_REPORT_TABLE = 'memory_report'
+
+
+def station_id_dtype(station_ids):
+    '''
+    A helper function that finds the smallest integer dtype holding every station id.
+
+    Parameters
+    ----------
+    station_ids : An array or series of numeric station ids without missing values.
+
+    Returns
+    -------
+    The name of the dtype.
+    '''
+    if len(station_ids) == 0:
+        return STATION_ID_DTYPES[0]
+    for dtype in STATION_ID_DTYPES:
+        if np.iinfo(dtype).min <= station_ids.min() and station_ids.max() <= np.iinfo(dtype).max:
+            return dtype
+
+    raise ValueError('Station ids between ' + str(station_ids.min()) + ' and ' +
+                     str(station_ids.max()) + ' do not fit in ' + STATION_ID_DTYPES[-1])
+
+
+def compact_station_ids(station_ids):
+    '''
+    A helper function that converts station ids to a category over int16 ids, or
+    over int32 or int64 ids when some ids are out of the int16 range, or over
+    floats when some ids are missing.
+
+    Parameters
+    ----------
+    station_ids : A series of station ids of any dtype.
+
+    Returns
+    -------
+    A categorical series.
+    '''
+    if isinstance(station_ids.dtype, pd.CategoricalDtype):
+        categories = station_ids.cat.categories
+        if categories.dtype.kind == 'i' and categories.dtype == station_id_dtype(categories):
+            return station_ids
+        station_ids = station_ids.astype(categories.dtype)
+
+    station_ids = pd.to_numeric(station_ids)
+    if not station_ids.isna().any():
+        station_ids = station_ids.astype(station_id_dtype(station_ids))
+
+    return station_ids.astype('category')
+
+
+def enforce_dtypes(dataframe):
+    '''
+    A function that converts the known Divvy columns of a dataframe to their compact
+    dtypes. Other columns are left as they are.
+
+    Parameters
+    ----------
+    dataframe : A dataframe with any of the known Divvy columns.
+
+    Returns
+    -------
+    A copy of the dataframe with compact dtypes.
+    '''
+    dataframe = dataframe.copy()
+
+    for column, dtype in COLUMN_DTYPES.items():
+        if column not in dataframe.columns or dataframe[column].dtype == dtype:
+            continue
+        if column == 'from_station_id':
+            dataframe[column] = compact_station_ids(dataframe[column])
+        elif dtype.startswith('datetime64'):
+            # Any datetime64 resolution read back from Parquet is kept
+            if not pd.api.types.is_datetime64_dtype(dataframe[column]):
+                dataframe[column] = pd.to_datetime(dataframe[column])
+        else:
+            # Partition columns are read back as categories
+            dataframe[column] = np.asarray(dataframe[column]).astype(dtype)
+
+    return dataframe
+
+
+def record_memory(report, stage, dataframe):
+    '''
+    A function that adds the size of a frame at one stage to a memory report.
+
+    Parameters
+    ----------
+    report : A list of stage records (updated in place).
+    stage : The name of the stage.
+    dataframe : The frame at that stage.
+    '''
+    memory = dataframe.memory_usage(deep=True).sum()
+    report.append({'stage': stage,
+                   'rows': len(dataframe),
+                   'megabytes': memory / 2 ** 20,
+                   'bytes_per_row': memory / max(len(dataframe), 1)})
+
+
+def benchmark_dtypes(number_of_rows=1000000, number_of_stations=600):
+    '''
+    A micro-benchmark comparing cleaned trips with the dtypes the pipeline used to
+    produce (date objects, int64 station ids and months) and with compact dtypes.
+
+    Parameters
+    ----------
+    number_of_rows : The number of synthetic trips.
+    number_of_stations : The number of distinct stations.
+
+    Returns
+    -------
+    A dictionary with the memory of both frames, the shrink factor and the timings
+    of a daily per-station groupby.
+    '''
+    rng = np.random.default_rng(0)
+    start_time = pd.Series(pd.Timestamp('2017-01-01') + pd.to_timedelta(
+        rng.integers(0, 4 * 365 * 86400, number_of_rows), unit='s'))
+    original = pd.DataFrame({'start_time': start_time,
+                             'from_station_id': rng.integers(1, number_of_stations + 1,
+                                                             number_of_rows),
+                             'start_day_of_year': start_time.dt.date,
+                             'month': start_time.dt.month.astype('int64')})
+    compact = enforce_dtypes(original)
+
+    def daily_counts(trips):
+        return trips.groupby(['from_station_id', 'start_day_of_year'], observed=True).size()
+
+    original_bytes = original.memory_usage(deep=True).sum()
+    compact_bytes = compact.memory_usage(deep=True).sum()
+
+    return {'number_of_rows': number_of_rows,
+            'original_megabytes': original_bytes / 2 ** 20,
+            'compact_megabytes': compact_bytes / 2 ** 20,
+            'shrink_factor': original_bytes / compact_bytes,
+            'original_groupby_seconds': min(timeit.repeat(lambda: daily_counts(original),
+                                                          number=1, repeat=3)),
+            'compact_groupby_seconds': min(timeit.repeat(lambda: daily_counts(compact),
+                                                         number=1, repeat=3))}
+
+
+if __name__ == '__main__':
+    print(benchmark_dtypes())
@@ -0,0 +1,152 @@
+'''
+This module snaps trips without a start station, such as dockless electric bike
+trips, to the nearest Divvy station. Station coordinates are projected to meters
+and indexed once in a KD-tree, and trip coordinates are matched in vectorized
+batches; trips farther than a cutoff from every station are left unassigned.
+'''
+import functools
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import schema
+
+# Divvy station list with ID, Latitude and Longitude columns
+STATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data',
+                             'Divvy_Bicycle_Stations.csv')
+
+# Largest station id of the trip tables. The station list also holds a few entries
+# with 19-digit ids that no trip uses; snapping to them would store ids that do not
+# join with the trips and lose precision as floats, so they are left out
+MAX_STATION_ID = np.iinfo(schema.STATION_ID_DTYPES[0]).max
+
+# Trips starting farther than this many meters from every station stay unassigned
+MAX_SNAP_DISTANCE = 150
+
+# Number of trip coordinates matched per batch
+BATCH_SIZE = 1000000
+
+# Mean Earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+
+def project(latitudes, longitudes, reference_latitude):
+    '''
+    A helper function that projects coordinates to meters with an equirectangular
+    projection, which is accurate to well under a meter at city scale.
+
+    Parameters
+    ----------
+    latitudes, longitudes : Arrays of coordinates in degrees.
+    reference_latitude : The latitude where the projection is true to scale.
+
+    Returns
+    -------
+    An array of x and y coordinates in meters with one row per coordinate.
+    '''
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+
+    return np.column_stack([EARTH_RADIUS * longitudes * np.cos(np.radians(reference_latitude)),
+                            EARTH_RADIUS * latitudes])
+
+
+class StationSnapper: # pylint: disable=too-few-public-methods
+    '''
+    Finds the nearest station within a distance cutoff for many coordinates.
+
+    Parameters
+    ----------
+    station_ids : The id of every station.
+    latitudes, longitudes : The coordinates of every station.
+    max_distance : The cutoff in meters.
+    '''
+    def __init__(self, station_ids, latitudes, longitudes, max_distance=MAX_SNAP_DISTANCE):
+        self.station_ids = np.asarray(station_ids, dtype=float)
+        self.reference_latitude = float(np.mean(latitudes))
+        self.tree = cKDTree(project(latitudes, longitudes, self.reference_latitude))
+        self.max_distance = max_distance
+
+    def snap(self, latitudes, longitudes, batch_size=BATCH_SIZE):
+        '''
+        Returns the nearest station of every coordinate.
+
+        Parameters
+        ----------
+        latitudes, longitudes : Arrays of coordinates.
+        batch_size : The number of coordinates matched per batch.
+
+        Returns
+        -------
+        A float array of station ids and an array of distances in meters, NaN for
+        missing coordinates and coordinates beyond the cutoff.
+        '''
+        points = project(latitudes, longitudes, self.reference_latitude)
+        station_ids = np.full(len(points), np.nan)
+        distances = np.full(len(points), np.nan)
+
+        for start in range(0, len(points), batch_size):
+            batch = points[start:start + batch_size]
+            valid = ~np.isnan(batch).any(axis=1)
+            batch_distances, batch_indexes = self.tree.query(
+                batch[valid], distance_upper_bound=self.max_distance)
+
+            # Points without a station inside the cutoff get an infinite distance
+            found = np.isfinite(batch_distances)
+            positions = start + np.flatnonzero(valid)[found]
+            station_ids[positions] = self.station_ids[batch_indexes[found]]
+            distances[positions] = batch_distances[found]
+
+        return station_ids, distances
+
+
+@functools.lru_cache(maxsize=None)
+def load_station_snapper(path=STATIONS_PATH, max_distance=MAX_SNAP_DISTANCE):
+    '''
+    A function that builds the station KD-tree once per process, over the stations
+    whose ids fit the trip tables.
+
+    Parameters
+    ----------
+    path : The Divvy station list.
+    max_distance : The cutoff in meters.
+
+    Returns
+    -------
+    A StationSnapper.
+    '''
+    stations = pd.read_csv(path, usecols=['ID', 'Latitude', 'Longitude'])
+    stations = stations[stations['ID'].between(0, MAX_STATION_ID)]
+
+    return StationSnapper(stations['ID'], stations['Latitude'], stations['Longitude'],
+                          max_distance)
+
+
+def snap_trips(trip_data, snapper=None, station_column='start_station_id',
+               latitude_column='start_lat', longitude_column='start_lng'):
+    '''
+    A function that fills missing start stations with the nearest station to the
+    trip's start coordinate.
+
+    Parameters
+    ----------
+    trip_data : Trip data with station id and start coordinate columns.
+    snapper : A StationSnapper (defaults to load_station_snapper()).
+    station_column : The start station id column.
+    latitude_column, longitude_column : The start coordinate columns.
+
+    Returns
+    -------
+    The trip data with snapped station ids; trips beyond the cutoff keep a null
+    station.
+    '''
+    snapper = snapper or load_station_snapper()
+    trip_data = trip_data.copy()
+    missing = trip_data[station_column].isna().values
+    if missing.any():
+        station_ids, _ = snapper.snap(trip_data[latitude_column].values[missing],
+                                      trip_data[longitude_column].values[missing])
+        trip_data[station_column] = trip_data[station_column].astype(float)
+        trip_data.loc[missing, station_column] = station_ids
+
+    return trip_data
@@ -0,0 +1,149 @@
+'''
+This module saves and loads the intermediate Divvy tables. Tables are stored as
+Parquet datasets with real timestamp and categorical station id dtypes, trip
+tables are partitioned by year and month, and csv is kept as an export format only.
+'''
+import os
+import shutil
+import pandas as pd
+import schema
+
+# Directory holding every intermediate table
+STORAGE_DIR = 'divvy_store'
+
+# Name of the cleaned trip table and the columns it is partitioned by
+TRIPS_TABLE = 'trips'
+TRIP_PARTITION_COLUMNS = ['year', 'month']
+
+# Name of the per-station daily ride table
+DAILY_TABLE = 'daily_df_2017_to_2020'
+
+# Name of the consolidated per-station forecast table
+STATION_FORECAST_TABLE = 'station_forecasts'
+
+
+def table_path(name, storage_dir=STORAGE_DIR):
+    '''
+    A helper function that returns the path of a stored table.
+
+    Parameters
+    ----------
+    name : The name of the table.
+    storage_dir : The directory holding every table.
+
+    Returns
+    -------
+    The path of the table's Parquet dataset.
+    '''
+    return os.path.join(storage_dir, name + '.parquet')
+
+
+def remove_table(name, storage_dir=STORAGE_DIR):
+    '''
+    A function that deletes a stored table if it exists.
+
+    Parameters
+    ----------
+    name : The name of the table.
+    storage_dir : The directory holding every table.
+    '''
+    path = table_path(name, storage_dir)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def save_dataframe(dataframe, name, partition_cols=None, append=False, storage_dir=STORAGE_DIR):
+    '''
+    A function that saves a dataframe as a Parquet dataset.
+
+    Parameters
+    ----------
+    dataframe : The dataframe to save.
+    name : The name of the table.
+    partition_cols : Columns to partition the dataset by.
+    append : If True, add files to an existing partitioned dataset instead of
+    replacing it.
+    storage_dir : The directory holding every table.
+    '''
+    if not append:
+        remove_table(name, storage_dir)
+    os.makedirs(storage_dir, exist_ok=True)
+
+    schema.enforce_dtypes(dataframe).to_parquet(
+        table_path(name, storage_dir), partition_cols=partition_cols, index=False)
+
+
+def load_dataframe(name, columns=None, filters=None, storage_dir=STORAGE_DIR):
+    '''
+    A function that loads a stored table, reading only the requested columns and
+    skipping partitions and row groups excluded by the filters.
+
+    Parameters
+    ----------
+    name : The name of the table.
+    columns : The columns to read (defaults to every column).
+    filters : Predicates in pyarrow's filter format, e.g. [('year', '=', 2019)].
+    storage_dir : The directory holding every table.
+
+    Returns
+    -------
+    A dataframe with stored dtypes.
+    '''
+    dataframe = pd.read_parquet(table_path(name, storage_dir), columns=columns, filters=filters)
+
+    return schema.enforce_dtypes(dataframe)
+
+
+def save_trips(trip_data, append=False, storage_dir=STORAGE_DIR):
+    '''
+    A function that saves cleaned trip data partitioned by year and month.
+
+    Parameters
+    ----------
+    trip_data : Cleaned Divvy trip data with start_time and month columns.
+    append : If True, add the trips to the stored ones instead of replacing them.
+    storage_dir : The directory holding every table.
+    '''
+    trip_data = trip_data.assign(year=pd.to_datetime(trip_data['start_time']).dt.year)
+    save_dataframe(trip_data, TRIPS_TABLE, partition_cols=TRIP_PARTITION_COLUMNS,
+                   append=append, storage_dir=storage_dir)
+
+
+def load_trips(year, columns=None, filters=None, storage_dir=STORAGE_DIR):
+    '''
+    A function that loads one year of cleaned trip data.
+
+    Parameters
+    ----------
+    year : The year of trips to load.
+    columns : The columns to read (defaults to every cleaned column).
+    filters : Additional predicates in pyarrow's filter format, e.g. [('month', '>=', 3)].
+    storage_dir : The directory holding every table.
+
+    Returns
+    -------
+    A dataframe of cleaned trips for the year.
+    '''
+    trip_data = load_dataframe(TRIPS_TABLE, columns=columns,
+                               filters=[('year', '=', year)] + list(filters or []),
+                               storage_dir=storage_dir)
+    if columns is None or 'year' not in columns:
+        trip_data = trip_data.drop(['year'], axis=1, errors='ignore')
+
+    return trip_data
+
+
+def export_csv(dataframe, path):
+    '''
+    A function that exports a stored or in-memory table as a csv file.
+
+    Parameters
+    ----------
+    dataframe : The dataframe to export, or the name of a stored table.
+    path : The path of the csv file.
+    '''
+    if isinstance(dataframe, str):
+        dataframe = load_dataframe(dataframe)
+    dataframe.to_csv(path, index=False)
@@ -0,0 +1,307 @@
+'''
+This module generates synthetic Divvy trips so the pipeline can be run and
+benchmarked without the private PostgreSQL database. Trips follow the 2017-2019
+schema (trip_id, start_time, from_station_id, ...) or the 2020 schema (ride_id,
+started_at, rideable_type, ...), start at the real Divvy stations weighted by a
+fixed popularity, and follow a yearly seasonality with the 2020 Covid drop. Trips
+are generated in chunks, so any number of rows can be streamed, and every chunk
+is derived from the seed, the year and the chunk number, so output is
+deterministic.
+'''
+import numpy as np
+import pandas as pd
+import clean_data
+import phase_calendar
+import station_snapping
+
+# Divvy station list with ID, Station Name, Latitude and Longitude columns
+STATIONS_PATH = station_snapping.STATIONS_PATH
+
+# Share of rides in each year (about 3.8M, 3.6M, 3.8M and, through August, 2M trips)
+YEAR_SHARES = {2020: 0.15, 2019: 0.29, 2018: 0.27, 2017: 0.29}
+
+# Last day of data of every year
+LAST_DAYS = {2020: '2020-08-31', 2019: '2019-12-31', 2018: '2018-12-31', 2017: '2017-12-31'}
+
+# Number of trips generated per chunk
+CHUNK_ROWS = 1000000
+
+# Demand relative to the same day before Covid, during the shutdown and afterwards
+SHUTDOWN_DEMAND = 0.3
+COVID_DEMAND = 0.7
+
+# Share of 2020 rides on electric bikes from their launch, and of those without a station
+ELECTRIC_LAUNCH = '2020-07-15'
+ELECTRIC_SHARE = 0.15
+DOCKLESS_SHARE = 0.4
+
+# Share of 2020 rides missing an end station
+MISSING_END_SHARE = 0.01
+
+
+def load_stations(path=STATIONS_PATH, seed=0):
+    '''
+    A function that reads the station list and gives every station a fixed
+    popularity drawn from a heavy-tailed distribution. Only stations with ids of the
+    2017-2020 trip data are kept.
+
+    Parameters
+    ----------
+    path : The Divvy station list.
+    seed : The seed of the popularity weights.
+
+    Returns
+    -------
+    A dataframe with ID, Station Name, Latitude, Longitude and weight columns.
+    '''
+    stations = pd.read_csv(path, usecols=['ID', 'Station Name', 'Latitude', 'Longitude'])
+
+    # Stations opened after 2020 have long ids that never appear in the trip data
+    stations = stations[stations['ID'] < 2 ** 15].reset_index(drop=True)
+    weights = np.random.default_rng(seed).pareto(1.5, len(stations)) + 0.1
+    stations['weight'] = weights / weights.sum()
+
+    return stations
+
+
+def day_weights(year, calendar=None):
+    '''
+    A function that returns the share of a year's trips starting on each day: a
+    summer peak, a weekday/weekend pattern, and lower demand during Covid.
+
+    Parameters
+    ----------
+    year : The year of data.
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    A DatetimeIndex of days and an array of weights adding up to one.
+    '''
+    if calendar is None:
+        calendar = phase_calendar.load_phase_calendar()
+
+    days = pd.date_range(str(year) + '-01-01', LAST_DAYS[year])
+    # pylint: disable=no-member
+    weights = np.exp(1.2 * np.cos(2 * np.pi * (days.dayofyear.values - 200) / 365.25))
+    weekend = days.dayofweek.values >= 5
+    # pylint: enable=no-member
+
+    covid = days.values.astype('datetime64[D]') >= calendar['covid_start']
+    weights = np.where(weekend, np.where(covid, 1.1, 0.8), 1.0) * weights
+    weights = np.where(covid, COVID_DEMAND, 1.0) * weights
+    shutdown = phase_calendar.phase_numbers(days, calendar) == 1
+    weights = np.where(shutdown, SHUTDOWN_DEMAND / COVID_DEMAND, 1.0) * weights
+
+    return days, weights / weights.sum()
+
+
+def rows_per_year(number_of_rows):
+    '''
+    A helper function that splits a number of trips across the years of data.
+
+    Parameters
+    ----------
+    number_of_rows : The total number of trips.
+
+    Returns
+    -------
+    A dictionary of trips by year, newest year first.
+    '''
+    rows = {year: int(number_of_rows * share) for year, share in YEAR_SHARES.items()}
+    rows[2019] += number_of_rows - sum(rows.values())
+
+    return rows
+
+
+def trip_chunk(year, number_of_rows, rng, stations, days, weights, first_id):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    '''
+    A function that generates one chunk of trips in the schema of the year.
+
+    Parameters
+    ----------
+    year : The year of data.
+    number_of_rows : The number of trips in the chunk.
+    rng : A numpy random generator.
+    stations : Stations from load_stations.
+    days, weights : Days and their shares of trips from day_weights.
+    first_id : The trip_id of the first trip (2017-2019).
+
+    Returns
+    -------
+    A dataframe of trips with the year's source columns.
+    '''
+    start_time = (days.values[rng.choice(len(days), number_of_rows, p=weights)] +
+                  rng.integers(0, 86400, number_of_rows).astype('timedelta64[s]'))
+    duration = np.minimum(rng.lognormal(np.log(720), 0.7, number_of_rows), 86400).astype(int)
+    end_time = start_time + duration.astype('timedelta64[s]')
+    start = rng.choice(len(stations), number_of_rows, p=stations['weight'].values)
+    end = rng.choice(len(stations), number_of_rows, p=stations['weight'].values)
+
+    station_ids = stations['ID'].values
+    station_names = stations['Station Name'].values
+    if year != 2020:
+        return pd.DataFrame({
+            'trip_id': np.arange(first_id, first_id + number_of_rows),
+            'start_time': start_time,
+            'end_time': end_time,
+            'bikeid': rng.integers(1, 6500, number_of_rows),
+            'tripduration': duration.astype(float),
+            'from_station_id': station_ids[start],
+            'from_station_name': station_names[start],
+            'to_station_id': station_ids[end],
+            'to_station_name': station_names[end],
+            'usertype': np.where(rng.random(number_of_rows) < 0.75, 'Subscriber', 'Customer'),
+            'gender': rng.choice(np.array(['Male', 'Female', None], dtype=object),
+                                 number_of_rows, p=[0.6, 0.25, 0.15]),
+            'birthyear': np.where(rng.random(number_of_rows) < 0.1, np.nan,
+                                  rng.integers(1950, 2003, number_of_rows))})
+
+    electric = ((start_time >= np.datetime64(ELECTRIC_LAUNCH)) &
+                (rng.random(number_of_rows) < ELECTRIC_SHARE))
+    dockless = electric & (rng.random(number_of_rows) < DOCKLESS_SHARE)
+    missing_end = rng.random(number_of_rows) < MISSING_END_SHARE
+
+    # Electric bikes report GPS coordinates a few meters off the station
+    jitter = np.where(electric, 0.0003, 0.0)
+    start_lat = stations['Latitude'].values[start] + jitter * rng.standard_normal(number_of_rows)
+    start_lng = stations['Longitude'].values[start] + jitter * rng.standard_normal(number_of_rows)
+
+    ride_ids = [f'{ride_id:016X}' for ride_id in rng.integers(0, 2 ** 63, number_of_rows)]
+
+    return pd.DataFrame({
+        'ride_id': ride_ids,
+        'rideable_type': np.where(electric, 'electric_bike', 'docked_bike'),
+        'started_at': start_time,
+        'ended_at': end_time,
+        'start_station_name': np.where(dockless, None, station_names[start]),
+        'start_station_id': np.where(dockless, np.nan, station_ids[start]),
+        'end_station_name': np.where(missing_end, None, station_names[end]),
+        'end_station_id': np.where(missing_end, np.nan, station_ids[end]),
+        'start_lat': start_lat,
+        'start_lng': start_lng,
+        'end_lat': stations['Latitude'].values[end],
+        'end_lng': stations['Longitude'].values[end],
+        'member_casual': np.where(rng.random(number_of_rows) < 0.6, 'member', 'casual')})
+
+
+def generate_trips(year, number_of_rows, seed=0, chunk_rows=CHUNK_ROWS, stations=None,
+                   calendar=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A generator that yields a year of synthetic trips in chunks. The same seed always
+    produces the same trips, whatever is generated before or after.
+
+    Parameters
+    ----------
+    year : The year of data (2017-2020).
+    number_of_rows : The number of trips in the year.
+    seed : The seed of the trips.
+    chunk_rows : The number of trips per chunk.
+    stations : Stations from load_stations (defaults to load_stations(seed=seed)).
+    calendar : A compiled phase calendar (defaults to Chicago's).
+
+    Returns
+    -------
+    Yields dataframes of at most chunk_rows trips in the year's source schema.
+    '''
+    if stations is None:
+        stations = load_stations(seed=seed)
+    days, weights = day_weights(year, calendar)
+
+    for chunk, first_row in enumerate(range(0, number_of_rows, chunk_rows)):
+        rng = np.random.default_rng([seed, year, chunk])
+        yield trip_chunk(year, min(chunk_rows, number_of_rows - first_row), rng, stations,
+                         days, weights, year * 10 ** 9 + first_row)
+
+
+def synthetic_year(year, number_of_rows, seed=0, chunk_rows=CHUNK_ROWS, stations=None):
+    '''
+    A function that generates a year of synthetic trips in memory.
+
+    Parameters
+    ----------
+    year : The year of data (2017-2020).
+    number_of_rows : The number of trips in the year.
+    seed : The seed of the trips.
+    chunk_rows : The number of trips generated at a time.
+    stations : Stations from load_stations (defaults to load_stations(seed=seed)).
+
+    Returns
+    -------
+    A dataframe of trips in the year's source schema.
+    '''
+    return pd.concat(list(generate_trips(year, number_of_rows, seed, chunk_rows, stations)),
+                     ignore_index=True)
+
+
+def synthetic_source_data(number_of_rows, seed=0, chunk_rows=CHUNK_ROWS):
+    '''
+    A function that generates every year of synthetic trips in memory, in the form
+    clean_data.sql_to_dataframe returns them.
+
+    Parameters
+    ----------
+    number_of_rows : The total number of trips across the years.
+    seed : The seed of the trips.
+    chunk_rows : The number of trips generated at a time.
+
+    Returns
+    -------
+    A dataframe for each year of Divvy data (2020, 2019, 2018 and 2017).
+    '''
+    stations = load_stations(seed=seed)
+
+    return tuple(synthetic_year(year, rows, seed, chunk_rows, stations)
+                 for year, rows in rows_per_year(number_of_rows).items())
+
+
+def table_months(year):
+    '''
+    A helper function that returns the months stored in each source table of a year:
+    quarterly tables for 2017-2019, and January-March then monthly tables for 2020.
+
+    Parameters
+    ----------
+    year : The year of data.
+
+    Returns
+    -------
+    A dictionary of month lists by source table.
+    '''
+    tables = clean_data.SOURCE_TABLES[year]
+    if year == 2020:
+        months = [[1, 2, 3]] + [[month] for month in range(4, 4 + len(tables) - 1)]
+    else:
+        months = [list(range(month, month + 3)) for month in range(1, 13, 3)]
+
+    return dict(zip(tables, months))
+
+
+def load_source_tables(cnx, number_of_rows, seed=0, chunk_rows=CHUNK_ROWS):
+    '''
+    A function that writes synthetic trips into the source tables of a database one
+    chunk at a time, so sizes far beyond memory can be loaded and every extraction
+    mode of clean_data can be run against them.
+
+    Parameters
+    ----------
+    cnx : A SQLAlchemy engine.
+    number_of_rows : The total number of trips across the years.
+    seed : The seed of the trips.
+    chunk_rows : The number of trips generated and written at a time.
+    '''
+    stations = load_stations(seed=seed)
+    for year, rows in rows_per_year(number_of_rows).items():
+        start_column = 'started_at' if year == 2020 else 'start_time'
+        months = table_months(year)
+        created = set()
+
+        for chunk in generate_trips(year, rows, seed, chunk_rows, stations):
+            chunk_months = chunk[start_column].dt.month
+            for table, table_month_list in months.items():
+                table_chunk = chunk[chunk_months.isin(table_month_list)]
+                table_chunk.to_sql(table, cnx, index=False, chunksize=100000,
+                                   if_exists='append' if table in created else 'replace')
+                created.add(table)
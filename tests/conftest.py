@@ -0,0 +1,124 @@
+'''
+Shared fixtures: a SQLite stand-in for the Divvy database loaded with synthetic
+trips, synthetic daily rides with a Prophet model fitted on them and a refitted
+copy, an empty model registry, and a scratch working directory for the Parquet store.
+'''
+import copy
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import phase_calendar # pylint: disable=wrong-import-position
+import prophet_model # pylint: disable=wrong-import-position
+import synthetic_trips # pylint: disable=wrong-import-position
+
+# Number of synthetic trips loaded into the stand-in database
+NUMBER_OF_ROWS = 20000
+
+# Rows repeated within and across the source tables of a year, as the UNION
+# queries of the full extraction drop them
+REPEATED_ROWS = {'april_may_june2019': ('jan_feb_march2019', 50),
+                 'may2020': ('may2020', 20)}
+
+# Number of stations with synthetic daily rides
+NUMBER_OF_STATIONS = 3
+
+
+@pytest.fixture(scope='session')
+def source_database(tmp_path_factory):
+    '''
+    A SQLite file with the source tables of every year, some rows repeated.
+
+    Returns
+    -------
+    The database URL.
+    '''
+    database_url = 'sqlite:///' + str(tmp_path_factory.mktemp('source') / 'divvy.db')
+    cnx = create_engine(database_url)
+    synthetic_trips.load_source_tables(cnx, NUMBER_OF_ROWS, seed=0, chunk_rows=5000)
+    with cnx.begin() as connection:
+        for table, (source_table, number_of_rows) in REPEATED_ROWS.items():
+            connection.exec_driver_sql('INSERT INTO ' + table + ' SELECT * FROM ' +
+                                       source_table + ' LIMIT ' + str(number_of_rows))
+    cnx.dispose()
+
+    return database_url
+
+
+@pytest.fixture
+def scratch_store(tmp_path, monkeypatch):
+    '''
+    Runs the test in an empty working directory, so the Parquet store is fresh.
+    '''
+    monkeypatch.chdir(tmp_path)
+
+    return tmp_path
+
+
+def synthetic_daily_rides(number_of_stations=NUMBER_OF_STATIONS, seed=0):
+    '''
+    Poisson daily rides of every station with yearly and weekly seasonality and a
+    drop during the 2020 shutdown.
+    '''
+    rng = np.random.default_rng(seed)
+    days = pd.date_range('2017-01-01', prophet_model.FORECAST_END)
+    shutdown = (days >= '2020-03-17') & (days <= '2020-04-30')
+    daily_rides = []
+    for station_id in range(1, number_of_stations + 1):
+        demand = (20 + 15 * np.sin(2 * np.pi * (days.dayofyear.values - 100) / 365.25) +
+                  5 * (days.dayofweek.values >= 5) + station_id)
+        demand = np.where(shutdown, 0.3 * demand, demand)
+        daily_rides.append(pd.DataFrame({'from_station_id': station_id,
+                                         'start_day_of_year': days,
+                                         'number_daily_rides': rng.poisson(demand)}))
+
+    return pd.concat(daily_rides, ignore_index=True)
+
+
+@pytest.fixture
+def registry_dir(tmp_path):
+    '''
+    An empty model registry.
+    '''
+    return str(tmp_path / 'models')
+
+
+@pytest.fixture(scope='session')
+def daily_rides():
+    '''
+    Synthetic daily rides of every station.
+    '''
+    return synthetic_daily_rides()
+
+
+@pytest.fixture(scope='session')
+def calendar():
+    '''
+    Chicago's compiled phase calendar.
+    '''
+    return phase_calendar.load_phase_calendar()
+
+
+@pytest.fixture(scope='session')
+def station_model(daily_rides, calendar): # pylint: disable=redefined-outer-name
+    '''
+    A Prophet model fitted on the first station's daily rides.
+    '''
+    return prophet_model.fit_model(daily_rides[daily_rides['from_station_id'] == 1], calendar)
+
+
+@pytest.fixture(scope='session')
+def refitted_station_model(station_model): # pylint: disable=redefined-outer-name
+    '''
+    A copy of the station model with its trend offset raised, standing in for a refit
+    that registers as a new version.
+    '''
+    refitted = copy.deepcopy(station_model)
+    refitted.params = dict(refitted.params, m=refitted.params['m'] + 0.5)
+
+    return refitted
@@ -0,0 +1,53 @@
+'''
+Tests of the parallel, cached backtest.
+'''
+import os
+import pandas as pd
+import backtesting
+
+# A short backtest of the seasonal naive baseline
+WINDOWS = {'initial': '730 days', 'period': '180 days', 'horizon': '60 days'}
+
+
+def station_rides(daily_rides, station_id=1):
+    '''
+    The daily rides of one station.
+    '''
+    return daily_rides[daily_rides['from_station_id'] == station_id]
+
+
+def test_folds_are_cached_and_reused(daily_rides, calendar, tmp_path):
+    cache_dir = str(tmp_path / 'cv_cache')
+    dataframe = station_rides(daily_rides)
+
+    cv_results, _, progress = backtesting.backtest(
+        dataframe, calendar=calendar, max_workers=1, cache_dir=cache_dir,
+        engine='seasonal_naive', **WINDOWS)
+    number_of_folds = cv_results['cutoff'].nunique()
+    assert number_of_folds > 1
+    assert not progress['cached'].any()
+    assert len(os.listdir(cache_dir)) == number_of_folds
+
+    cached_results, _, cached_progress = backtesting.backtest(
+        dataframe, calendar=calendar, max_workers=1, cache_dir=cache_dir,
+        engine='seasonal_naive', **WINDOWS)
+    assert cached_progress['cached'].all()
+    pd.testing.assert_frame_equal(cached_results, cv_results)
+
+
+def test_changed_inputs_miss_the_cache(daily_rides, calendar, tmp_path):
+    cache_dir = str(tmp_path / 'cv_cache')
+    backtesting.backtest(station_rides(daily_rides), calendar=calendar, max_workers=1,
+                         cache_dir=cache_dir, engine='seasonal_naive', **WINDOWS)
+    number_of_files = len(os.listdir(cache_dir))
+
+    _, _, progress = backtesting.backtest(
+        station_rides(daily_rides, station_id=2), calendar=calendar, max_workers=1,
+        cache_dir=cache_dir, engine='seasonal_naive', **WINDOWS)
+    assert not progress['cached'].any()
+
+    _, _, progress = backtesting.backtest(
+        station_rides(daily_rides), calendar=calendar, max_workers=1, cache_dir=cache_dir,
+        engine='seasonal_naive', hyperparameters={'season_length': 14}, **WINDOWS)
+    assert not progress['cached'].any()
+    assert len(os.listdir(cache_dir)) == 3 * number_of_files
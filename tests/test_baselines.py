@@ -0,0 +1,54 @@
+'''
+Tests of the vectorized baseline forecasting engines.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import baselines
+import hierarchy
+import prophet_model
+
+# Share of in-sample rides the 80% intervals should cover
+COVERAGE_RANGE = (0.75, 0.85)
+
+# Days forecast after the training data
+FUTURE_DAYS = pd.date_range(prophet_model.FORECAST_START, periods=30)
+
+
+@pytest.fixture(scope='module')
+def rides(daily_rides):
+    '''
+    The daily rides of every station before the forecast window, one column per station.
+    '''
+    return hierarchy.station_matrix(
+        daily_rides[daily_rides['start_day_of_year'] < prophet_model.FORECAST_START])
+
+
+@pytest.mark.parametrize('method', list(baselines.ENGINES))
+def test_matrix_intervals_cover_in_sample_rides(rides, calendar,
+                                                method): # pylint: disable=redefined-outer-name
+    _, fitted = baselines.fit_matrix(rides, FUTURE_DAYS, method, calendar)
+    yhat, yhat_lower, yhat_upper = baselines.forecast_matrix(rides, FUTURE_DAYS, method,
+                                                             calendar)
+
+    assert yhat.shape == (len(FUTURE_DAYS), rides.shape[1])
+    assert (yhat_lower <= yhat).all() and (yhat <= yhat_upper).all()
+    half_width = (yhat_upper - yhat_lower)[0] / 2
+    coverage = (np.abs(rides.values - fitted) <= half_width).mean(axis=0)
+    assert ((COVERAGE_RANGE[0] < coverage) & (coverage < COVERAGE_RANGE[1])).all()
+
+
+def test_row_intervals_cover_in_sample_rows(daily_rides, calendar):
+    history = prophet_model.prepare_training_data(daily_rides, calendar)
+    history = history[history.ds < prophet_model.FORECAST_START]
+
+    forecast = baselines.forecast_rows(history, history[['ds']], 'ridge', calendar)
+
+    covered = ((forecast['yhat_lower'].values <= history['y'].values) &
+               (history['y'].values <= forecast['yhat_upper'].values))
+    assert COVERAGE_RANGE[0] < covered.mean() < COVERAGE_RANGE[1]
+
+
+def test_unknown_engine_raises(rides, calendar): # pylint: disable=redefined-outer-name
+    with pytest.raises(ValueError, match='Unknown baseline engine'):
+        baselines.fit_matrix(rides, FUTURE_DAYS, 'arima', calendar)
@@ -0,0 +1,261 @@
+'''
+Parity tests of the extraction modes of clean_data against the full path, on a
+SQLite stand-in for the Divvy database.
+'''
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+import clean_data
+import storage
+import zip_boundaries
+
+
+def stored_daily_rides():
+    '''
+    Loads the stored daily ride table in a canonical order.
+    '''
+    daily_df_2017_to_2020 = storage.load_dataframe(storage.DAILY_TABLE)
+    daily_df_2017_to_2020['from_station_id'] = np.asarray(
+        daily_df_2017_to_2020['from_station_id']).astype('int64')
+    daily_df_2017_to_2020['start_day_of_year'] = pd.to_datetime(
+        daily_df_2017_to_2020['start_day_of_year']).astype('datetime64[ns]')
+    daily_df_2017_to_2020['number_daily_rides'] = (
+        daily_df_2017_to_2020['number_daily_rides'].astype('int64'))
+
+    return daily_df_2017_to_2020.sort_values(
+        ['from_station_id', 'start_day_of_year']).reset_index(drop=True)
+
+
+@pytest.fixture
+def full_path_daily_rides(source_database, scratch_store): # pylint: disable=unused-argument
+    '''
+    The daily rides of the full extraction and cleaning path.
+    '''
+    clean_data.clean_and_engineer_dataframes(*clean_data.sql_to_dataframe(source_database))
+
+    return stored_daily_rides()
+
+
+def test_streaming_with_dedupe_matches_full_path(source_database, full_path_daily_rides):
+    cnx = create_engine(source_database)
+    clean_data.stream_clean_and_aggregate(cnx, chunksize=3000, dedupe=True)
+
+    pd.testing.assert_frame_equal(stored_daily_rides(), full_path_daily_rides)
+
+
+def test_streaming_without_dedupe_counts_repeated_rows(source_database, full_path_daily_rides):
+    cnx = create_engine(source_database)
+    clean_data.stream_clean_and_aggregate(cnx, chunksize=3000, dedupe=False)
+    daily_df_2017_to_2020 = stored_daily_rides()
+
+    assert (daily_df_2017_to_2020['number_daily_rides'].sum() >
+            full_path_daily_rides['number_daily_rides'].sum())
+
+
+def stored_trips():
+    '''
+    Loads the stored trips with plain dtypes in a canonical order.
+    '''
+    trip_data = storage.load_dataframe(storage.TRIPS_TABLE)
+    trip_data['from_station_id'] = np.asarray(trip_data['from_station_id']).astype('int64')
+
+    return trip_data.sort_values(list(trip_data.columns)).reset_index(drop=True)
+
+
+@pytest.mark.usefixtures('scratch_store')
+def test_streaming_keeps_snapped_coordinates(source_database):
+    clean_data.clean_and_engineer_dataframes(*clean_data.sql_to_dataframe(source_database),
+                                             snap_dockless=True)
+    full_path_trips = stored_trips()
+    clean_data.stream_clean_and_aggregate(create_engine(source_database), chunksize=3000,
+                                          dedupe=True, snap_dockless=True)
+    streamed_trips = stored_trips()
+
+    assert streamed_trips[clean_data.COORDINATE_COLUMNS].notna().any().all()
+    pd.testing.assert_frame_equal(streamed_trips, full_path_trips[streamed_trips.columns])
+
+
+@pytest.fixture
+def zip_code_grid(tmp_path, monkeypatch):
+    '''
+    A boundary file of square zip codes, a hundredth of a degree wide, covering Chicago.
+    '''
+    features = []
+    for row, latitude in enumerate(np.arange(41.6, 42.1, 0.01)):
+        for column, longitude in enumerate(np.arange(-87.9, -87.5, 0.01)):
+            square = [[longitude, latitude], [longitude + 0.01, latitude],
+                      [longitude + 0.01, latitude + 0.01], [longitude, latitude + 0.01],
+                      [longitude, latitude]]
+            zip_code = 60000 + 100 * row + column
+            features.append({'type': 'Feature',
+                             'properties': {zip_boundaries.ZIP_PROPERTY: zip_code},
+                             'geometry': {'type': 'Polygon', 'coordinates': [square]}})
+    path = tmp_path / 'zip_code_boundaries.geojson'
+    path.write_text(json.dumps({'type': 'FeatureCollection', 'features': features}))
+    monkeypatch.setattr(zip_boundaries, 'BOUNDARIES_PATH', str(path))
+
+    return path
+
+
+@pytest.mark.usefixtures('scratch_store', 'zip_code_grid')
+def test_streaming_assigns_zip_codes(source_database):
+    clean_data.clean_and_engineer_dataframes(*clean_data.sql_to_dataframe(source_database))
+    full_path_trips = stored_trips()
+    clean_data.stream_clean_and_aggregate(create_engine(source_database), chunksize=3000,
+                                          dedupe=True)
+    streamed_trips = stored_trips()
+
+    assert streamed_trips['start_zip_code'].notna().any()
+    pd.testing.assert_frame_equal(streamed_trips, full_path_trips)
+
+
+def test_dedupe_keeps_one_trip_per_id(tmp_path):
+    cnx = create_engine('sqlite:///' + str(tmp_path / 'trips.db'))
+    trips = pd.DataFrame({'trip_id': [1, 2, 2],
+                          'start_time': ['2019-01-01 08:00:00', '2019-01-01 09:00:00',
+                                         '2019-01-01 09:00:00'],
+                          'end_time': ['2019-01-01 08:10:00', '2019-01-01 09:10:00',
+                                       '2019-01-01 09:20:00'],
+                          'from_station_id': [5, 5, 5]})
+    tables = clean_data.SOURCE_TABLES[2019]
+    trips.iloc[:2].to_sql(tables[0], cnx, index=False)
+    for table in tables[1:]:
+        trips.iloc[2:].to_sql(table, cnx, index=False)
+
+    # Repeated ids are dropped even when their other columns differ
+    deduplicated = pd.read_sql_query(clean_data.deduplicated_year_query(2019), cnx)
+    daily_counts = pd.read_sql_query(clean_data.daily_counts_query(2019, dedupe=True), cnx)
+
+    assert sorted(deduplicated['trip_id']) == [1, 2]
+    assert list(deduplicated.columns) == clean_data.PROJECTED_COLUMNS_2017_TO_2019
+    assert daily_counts['number_daily_rides'].sum() == len(deduplicated)
+
+
+def test_pushdown_matches_full_path(source_database, full_path_daily_rides):
+    clean_data.pushdown_daily_counts(create_engine(source_database))
+
+    pd.testing.assert_frame_equal(stored_daily_rides(), full_path_daily_rides)
+
+
+def test_pushdown_with_dedupe_matches_full_path(source_database, full_path_daily_rides):
+    clean_data.pushdown_daily_counts(create_engine(source_database), dedupe=True)
+
+    pd.testing.assert_frame_equal(stored_daily_rides(), full_path_daily_rides)
+
+
+def test_pushdown_without_dedupe_counts_repeated_rows(source_database, full_path_daily_rides):
+    clean_data.pushdown_daily_counts(create_engine(source_database), dedupe=False)
+    daily_df_2017_to_2020 = stored_daily_rides()
+
+    # Only the days of the repeated rows differ from the full path
+    merged = full_path_daily_rides.merge(daily_df_2017_to_2020, how='outer',
+                                         on=['from_station_id', 'start_day_of_year'],
+                                         suffixes=('_full', '_pushdown'), indicator=True)
+    assert (merged['_merge'] == 'both').all()
+    extra_rides = merged['number_daily_rides_pushdown'] - merged['number_daily_rides_full']
+    assert (extra_rides >= 0).all()
+    assert 0 < extra_rides.sum() <= 70
+
+
+def test_incremental_refresh_with_dedupe_matches_full_path(source_database,
+                                                           full_path_daily_rides):
+    cnx = create_engine(source_database)
+    refreshed_tables = clean_data.incremental_refresh(cnx, dedupe=True)
+
+    assert len(refreshed_tables) == sum(map(len, clean_data.SOURCE_TABLES.values()))
+    pd.testing.assert_frame_equal(stored_daily_rides(), full_path_daily_rides)
+
+
+def test_incremental_refresh_recounts_later_tables_of_a_changed_year(source_database,
+                                                                     full_path_daily_rides):
+    cnx = create_engine(source_database)
+    clean_data.incremental_refresh(cnx, dedupe=True)
+
+    # A changed partition of a year is aggregated again with the tables after it
+    os.remove(os.path.join(clean_data.PARTITION_DIR, 'jan_feb_march2019.parquet'))
+    refreshed_tables = clean_data.incremental_refresh(cnx, dedupe=True,
+                                                      immutable_years=[])
+
+    assert refreshed_tables == clean_data.SOURCE_TABLES[2019]
+    pd.testing.assert_frame_equal(stored_daily_rides(), full_path_daily_rides)
+
+
+def test_incremental_refresh_without_dedupe_counts_repeated_rows(source_database,
+                                                                 full_path_daily_rides):
+    clean_data.incremental_refresh(create_engine(source_database))
+
+    assert (stored_daily_rides()['number_daily_rides'].sum() >
+            full_path_daily_rides['number_daily_rides'].sum())
+
+
+def canonical_rows(dataframe):
+    '''
+    Sorts a source dataframe on every column, since UNION order is not defined.
+    '''
+    return dataframe.sort_values(list(dataframe.columns)).reset_index(drop=True)
+
+
+def test_concurrent_extraction_matches_serial(source_database):
+    serial = clean_data.sql_to_dataframe(source_database, max_workers=1)
+    concurrent = clean_data.sql_to_dataframe(source_database, max_workers=4)
+
+    for serial_data, concurrent_data in zip(serial, concurrent):
+        pd.testing.assert_frame_equal(canonical_rows(concurrent_data),
+                                      canonical_rows(serial_data))
+
+
+def test_extraction_matches_union_queries(source_database):
+    cnx = create_engine(source_database)
+    for tables, yearly_data in zip(clean_data.SOURCE_TABLES.values(),
+                                   clean_data.sql_to_dataframe(source_database)):
+        union = pd.read_sql_query(' UNION '.join('SELECT * FROM ' + table for table in tables),
+                                  cnx)
+        pd.testing.assert_frame_equal(canonical_rows(yearly_data), canonical_rows(union))
+
+
+def test_read_source_table_retries_operational_errors(source_database):
+    cnx = create_engine(source_database)
+    failures = []
+
+    @event.listens_for(cnx, 'before_cursor_execute')
+    def drop_connection(conn, cursor, statement, *args): # pylint: disable=unused-argument
+        if len(failures) < 2:
+            failures.append(statement)
+            raise OperationalError(statement, {}, Exception('server closed the connection'))
+
+    table_data = clean_data.read_source_table(cnx, 'may2020', retry_seconds=0)
+
+    assert len(failures) == 2
+    pd.testing.assert_frame_equal(table_data, pd.read_sql_query('SELECT * FROM may2020', cnx))
+
+
+def test_read_source_table_gives_up_after_every_attempt(source_database):
+    cnx = create_engine(source_database)
+
+    @event.listens_for(cnx, 'before_cursor_execute')
+    def drop_connection(conn, cursor, statement, *args): # pylint: disable=unused-argument
+        raise OperationalError(statement, {}, Exception('server closed the connection'))
+
+    with pytest.raises(Exception) as error_info:
+        clean_data.read_source_table(cnx, 'may2020', max_attempts=2, retry_seconds=0)
+    assert isinstance(error_info.value, OperationalError) or isinstance(
+        error_info.value.__cause__, OperationalError)
+
+
+def test_database_url_from_environment(source_database, monkeypatch):
+    monkeypatch.setenv(clean_data.DATABASE_URL_VARIABLE, source_database)
+
+    assert clean_data.database_engine().url.render_as_string() == source_database
+    assert len(clean_data.sql_to_dataframe()[0]) > 0
+
+
+def test_database_url_argument_overrides_environment(source_database, monkeypatch):
+    monkeypatch.setenv(clean_data.DATABASE_URL_VARIABLE, 'sqlite:///missing/divvy.db')
+
+    assert clean_data.database_engine(source_database).url.render_as_string() == source_database
+    assert len(clean_data.sql_to_dataframe(source_database)[0]) > 0
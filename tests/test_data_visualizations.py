@@ -0,0 +1,110 @@
+'''
+Tests of the Tableau export built from the stored trips.
+'''
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import clean_data
+import data_visualizations
+import phase_calendar
+import zip_boundaries
+
+# Zip code returned by the stand-in geocoding provider
+STUB_ZIP_CODE = 60601
+
+# A zip code boundary around the first of two stations
+BOUNDARY_ZIP_CODE = 60614
+BOUNDARIES = {'type': 'FeatureCollection', 'features': [{
+    'type': 'Feature', 'properties': {'zip': str(BOUNDARY_ZIP_CODE)},
+    'geometry': {'type': 'Polygon', 'coordinates': [[[-87.7, 41.9], [-87.6, 41.9], [-87.6, 42.0],
+                                                     [-87.7, 42.0], [-87.7, 41.9]]]}}]}
+STATIONS = pd.DataFrame({'Location': ['(41.95, -87.65)', '(41.80, -87.60)'],
+                         'Latitude': [41.95, 41.80], 'Longitude': [-87.65, -87.60]})
+
+
+def stub_provider(latitude, longitude): # pylint: disable=unused-argument
+    '''
+    A geocoding provider that places every station in one zip code.
+    '''
+    return STUB_ZIP_CODE
+
+
+@pytest.fixture
+def stored_trips(source_database, scratch_store): # pylint: disable=unused-argument
+    '''
+    Cleans the stand-in database into the store.
+    '''
+    clean_data.clean_and_engineer_dataframes(*clean_data.sql_to_dataframe(source_database))
+
+
+@pytest.mark.usefixtures('stored_trips')
+def test_main_writes_tableau_file():
+    data_visualizations.main(provider=stub_provider)
+    all_data = pd.read_csv(data_visualizations.TABLEAU_PATH)
+
+    calendar = phase_calendar.load_phase_calendar()
+    assert all_data['from_station_id'].notna().sum() > 0
+    for name, _, _ in calendar['phases']:
+        assert name + '_percent_change_as_percent' in all_data.columns
+    assert 'zip_code_x' not in all_data.columns
+
+
+@pytest.mark.usefixtures('scratch_store')
+def test_zip_codes_leave_station_data_unchanged():
+    stations = pd.DataFrame({'Location': ['(41.9, -87.6)'], 'Latitude': [41.9],
+                             'Longitude': [-87.6]})
+    zip_codes = data_visualizations.get_zip_codes_from_google_api(
+        stations, stub_provider, boundaries_path=None)
+
+    assert list(stations.columns) == ['Location', 'Latitude', 'Longitude']
+    assert list(zip_codes.columns) == ['Location', 'zip_code']
+
+
+@pytest.fixture
+def boundaries_path(scratch_store):
+    '''
+    Downloads the stand-in zip code boundaries from a local file.
+    '''
+    source_path = scratch_store / 'source.geojson'
+    source_path.write_text(json.dumps(BOUNDARIES), encoding='utf-8')
+    path = str(scratch_store / 'boundaries.geojson')
+
+    assert zip_boundaries.download_boundaries(source_path.as_uri(), path) == 1
+
+    return path
+
+
+def test_unmatched_stations_are_geocoded_with_a_warning(boundaries_path, caplog):
+    geocoded = []
+    def provider(latitude, longitude):
+        geocoded.append((latitude, longitude))
+        return STUB_ZIP_CODE
+
+    zip_codes = data_visualizations.get_zip_codes_from_google_api(STATIONS, provider,
+                                                                  boundaries_path)
+
+    assert list(zip_codes['zip_code']) == [BOUNDARY_ZIP_CODE, STUB_ZIP_CODE]
+    assert len(geocoded) == 1
+    assert '1 of 2 stations are outside the zip code boundaries' in caplog.text
+
+
+def test_unmatched_stations_stay_missing_without_geocoding(boundaries_path, caplog):
+    def provider(latitude, longitude):
+        raise AssertionError('geocoded ({}, {})'.format(latitude, longitude))
+
+    zip_codes = data_visualizations.get_zip_codes_from_google_api(
+        STATIONS, provider, boundaries_path, geocode_unmatched=False)
+
+    assert zip_codes['zip_code'].iloc[0] == BOUNDARY_ZIP_CODE
+    assert np.isnan(zip_codes['zip_code'].iloc[1])
+    assert '1 of 2 stations' in caplog.text
+
+
+@pytest.mark.usefixtures('scratch_store')
+def test_missing_boundary_file_points_to_the_download(caplog):
+    data_visualizations.get_zip_codes_from_google_api(STATIONS, stub_provider,
+                                                      'missing.geojson')
+
+    assert 'zip_boundaries.py --download' in caplog.text
+    assert '2 of 2 stations' in caplog.text
@@ -0,0 +1,70 @@
+'''
+Tests of serving forecasts from registered models.
+'''
+from http.server import ThreadingHTTPServer
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import forecast_service
+import model_registry
+
+# Station the test model is registered for
+STATION_ID = 1
+
+
+@pytest.fixture
+def service(station_model, daily_rides, registry_dir):
+    '''
+    A forecast service over a registry holding the test station's model.
+    '''
+    model_registry.register_model(station_model, forecast_service.model_name(STATION_ID),
+                                  daily_rides, registry_dir=registry_dir)
+
+    return forecast_service.ForecastService(registry_dir)
+
+
+@pytest.fixture
+def base_url(service): # pylint: disable=redefined-outer-name
+    '''
+    Serves the forecast service on a free local port.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), forecast_service.make_handler(service))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/forecast'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def status(url):
+    '''
+    Returns the HTTP status of a GET request.
+    '''
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('?station=1', 200),
+    ('?station=1&start=2020-09-01&end=2020-09-07', 200),
+    ('?station=999', 404),
+    ('?station=1&start=not-a-date', 400),
+    ('?station=1&end=2020-13-45', 400)])
+def test_handler_status(base_url, query, expected): # pylint: disable=redefined-outer-name
+    assert status(base_url + query) == expected
+
+
+def test_new_version_replaces_cached_horizon(service, refitted_station_model, daily_rides,
+                                             registry_dir): # pylint: disable=redefined-outer-name
+    first = service.forecast(STATION_ID)
+    model_registry.register_model(refitted_station_model,
+                                  forecast_service.model_name(STATION_ID), daily_rides,
+                                  registry_dir=registry_dir)
+    second = service.forecast(STATION_ID)
+
+    assert (second['yhat'] > first['yhat']).all()
+    assert len(service.horizons) == 2
@@ -0,0 +1,46 @@
+'''
+Tests of fitting and forecasting the station models.
+'''
+import pandas as pd
+import pytest
+import forecasting
+import prophet_model
+import storage
+
+
+def test_worker_leaves_the_stan_backend_class_unpatched():
+    backend_class = type(prophet_model.Prophet().stan_backend)
+    load_model = backend_class.load_model
+
+    prophet_model.init_forecasting_worker()
+
+    assert backend_class.load_model is load_model
+
+
+@pytest.mark.usefixtures('scratch_store')
+def test_failed_stations_do_not_stop_the_others(daily_rides, calendar):
+    failing_rides = daily_rides[daily_rides['from_station_id'] == 2].head(1)
+    daily = pd.concat([daily_rides[daily_rides['from_station_id'] == 1], failing_rides])
+
+    station_forecasts, failures = forecasting.forecast_stations(daily, max_workers=1,
+                                                                calendar=calendar)
+
+    assert list(failures) == [2]
+    assert station_forecasts['from_station_id'].unique().tolist() == [1]
+    assert len(station_forecasts) == prophet_model.FORECAST_PERIODS
+
+
+@pytest.mark.usefixtures('scratch_store')
+def test_every_station_failing_returns_an_empty_frame(daily_rides, calendar):
+    failing_rides = daily_rides.groupby('from_station_id').head(1)
+
+    station_forecasts, failures = forecasting.forecast_stations(failing_rides, max_workers=1,
+                                                                calendar=calendar)
+
+    assert sorted(failures) == [1, 2, 3]
+    assert station_forecasts.empty
+    assert station_forecasts.dtypes.astype(str).to_dict() == (
+        forecasting.STATION_FORECAST_DTYPES)
+    saved = storage.load_dataframe(storage.STATION_FORECAST_TABLE)
+    assert saved.empty
+    assert list(saved.columns) == list(forecasting.STATION_FORECAST_DTYPES)
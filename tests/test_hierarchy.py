@@ -0,0 +1,86 @@
+'''
+Tests of the reconciled station, zip code and city forecasts.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import hierarchy
+
+# Stations and their zip codes; station 4 has no known zip code
+STATION_IDS = [1, 2, 3, 4]
+STATION_ZIP_CODES = pd.DataFrame({'from_station_id': [1, 2, 3],
+                                  'zip_code': ['60601', '60601', '60614']})
+
+# Number of forecast days
+NUMBER_OF_DAYS = 5
+
+
+@pytest.fixture
+def hierarchy_matrix():
+    '''
+    The summing matrix, node names and number of stations of the test hierarchy.
+    '''
+    return hierarchy.aggregation_matrix(STATION_IDS, STATION_ZIP_CODES)
+
+
+@pytest.fixture
+def base(hierarchy_matrix): # pylint: disable=redefined-outer-name
+    '''
+    Incoherent base forecasts of every node.
+    '''
+    summing_matrix = hierarchy_matrix[0]
+
+    return np.random.default_rng(0).uniform(10, 50, (summing_matrix.shape[0], NUMBER_OF_DAYS))
+
+
+def test_summing_matrix_nodes(hierarchy_matrix): # pylint: disable=redefined-outer-name
+    summing_matrix, nodes, number_of_stations = hierarchy_matrix
+
+    assert number_of_stations == len(STATION_IDS)
+    assert nodes['node'].tolist() == ['city', 'zip_60601', 'zip_60614', 'zip_unknown',
+                                      'station_1', 'station_2', 'station_3', 'station_4']
+    np.testing.assert_array_equal(summing_matrix.toarray()[:4],
+                                  [[1, 1, 1, 1], [1, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+    np.testing.assert_array_equal(summing_matrix.toarray()[4:], np.eye(len(STATION_IDS)))
+
+
+@pytest.mark.parametrize('method', hierarchy.RECONCILIATION_METHODS)
+def test_reconciled_totals_are_coherent(hierarchy_matrix, base,
+                                        method): # pylint: disable=redefined-outer-name
+    summing_matrix, _, number_of_stations = hierarchy_matrix
+    if method == 'bottom_up':
+        reconciled = hierarchy.reconcile_bottom_up(summing_matrix, base, number_of_stations)
+    elif method == 'top_down':
+        reconciled = hierarchy.reconcile_top_down(summing_matrix, base, [0.1, 0.2, 0.3, 0.4])
+    else:
+        variances = np.linspace(1, 2, summing_matrix.shape[0])
+        reconciled = hierarchy.reconcile_mint(summing_matrix, base, variances)
+
+    stations = reconciled[-number_of_stations:]
+    np.testing.assert_allclose(reconciled, summing_matrix @ stations)
+    np.testing.assert_allclose(reconciled[0], stations.sum(axis=0))
+
+
+def test_mint_matches_the_dense_projection(hierarchy_matrix,
+                                           base): # pylint: disable=redefined-outer-name
+    summing_matrix = hierarchy_matrix[0].toarray()
+    variances = np.linspace(1, 2, summing_matrix.shape[0])
+
+    inverse_covariance = np.diag(1 / variances)
+    projection = summing_matrix @ np.linalg.solve(
+        summing_matrix.T @ inverse_covariance @ summing_matrix,
+        summing_matrix.T @ inverse_covariance)
+
+    np.testing.assert_allclose(
+        hierarchy.reconcile_mint(hierarchy_matrix[0], base, variances), projection @ base,
+        rtol=1e-8)
+
+
+def test_mint_keeps_coherent_forecasts(hierarchy_matrix,
+                                       base): # pylint: disable=redefined-outer-name
+    summing_matrix, _, number_of_stations = hierarchy_matrix
+    coherent = summing_matrix @ base[-number_of_stations:]
+
+    np.testing.assert_allclose(
+        hierarchy.reconcile_mint(summing_matrix, coherent, np.ones(summing_matrix.shape[0])),
+        coherent, rtol=1e-8)
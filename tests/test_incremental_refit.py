@@ -0,0 +1,74 @@
+'''
+Tests of the warm-started incremental refits.
+'''
+import pandas as pd
+import pytest
+import incremental_refit
+import model_registry
+import prophet_model
+
+# Name the station model is registered under
+MODEL_NAME = 'station_1'
+
+
+@pytest.fixture
+def registered(station_model, daily_rides, registry_dir):
+    '''
+    A registry holding the station model, and the station's daily rides.
+    '''
+    station_rides = daily_rides[daily_rides['from_station_id'] == 1]
+    model_registry.register_model(station_model, MODEL_NAME, station_rides,
+                                  registry_dir=registry_dir)
+
+    return station_rides
+
+
+def rides_until(station_rides, last_day):
+    '''
+    The station's daily rides up to and including a day.
+    '''
+    return station_rides[station_rides['start_day_of_year'] <= pd.Timestamp(last_day)]
+
+
+def refit(station_rides, calendar, registry_dir, drift_threshold, name=MODEL_NAME):
+    '''
+    Runs one refit decision in-process.
+    '''
+    return incremental_refit.refit_series((name, station_rides, calendar, None,
+                                           drift_threshold, registry_dir))
+
+
+def test_models_without_new_days_are_unchanged(registered, calendar, registry_dir):
+    last_day = prophet_model.FORECAST_START - pd.Timedelta(days=1)
+    record = refit(rides_until(registered, last_day), calendar, registry_dir, 0.0)
+
+    assert record['action'] == 'unchanged'
+    assert record['version'] == record['previous_version']
+
+
+def test_drift_decides_between_skipping_and_warm_refits(registered, calendar, registry_dir):
+    station_rides = rides_until(registered, prophet_model.FORECAST_START + pd.Timedelta(days=6))
+
+    skipped = refit(station_rides, calendar, registry_dir, drift_threshold=10.0)
+    assert skipped['action'] == 'skipped'
+    assert skipped['new_days'] == 7
+
+    warm = refit(station_rides, calendar, registry_dir, drift_threshold=0.0)
+    assert warm['action'] == 'warm'
+    assert warm['version'] != warm['previous_version']
+    assert model_registry.load_metadata(MODEL_NAME, registry_dir=registry_dir)[
+        'version'] == warm['version']
+
+
+@pytest.mark.usefixtures('scratch_store')
+def test_failed_series_do_not_stop_the_others(registered, calendar, registry_dir):
+    last_day = prophet_model.FORECAST_START - pd.Timedelta(days=1)
+    failing_rides = registered.head(1).assign(from_station_id=2)
+    daily = pd.concat([rides_until(registered, last_day), failing_rides], ignore_index=True)
+
+    refits = incremental_refit.refit_models(daily, max_workers=1, calendar=calendar,
+                                            include_city=False, registry_dir=registry_dir)
+
+    assert refits.set_index('name')['action'].to_dict() == {'station_1': 'unchanged',
+                                                           'station_2': 'failed'}
+    assert refits.set_index('name').loc['station_2', 'error']
@@ -0,0 +1,55 @@
+'''
+Tests of the versioned model registry.
+'''
+import numpy as np
+import pytest
+import model_registry
+import prophet_model
+
+# Name the test models are registered under
+MODEL_NAME = 'station_1'
+
+
+@pytest.fixture(scope='module')
+def future(calendar):
+    '''
+    The days of the forecast window with their condition columns.
+    '''
+    return prophet_model.forecast_dataframe(calendar)
+
+
+def test_registered_model_predicts_like_the_fitted_one(station_model, daily_rides, registry_dir,
+                                                       future):
+    version = model_registry.register_model(station_model, MODEL_NAME, daily_rides,
+                                            hyperparameters={'seasonality_prior_scale': 20},
+                                            metrics={'mae': np.float64(1.5)},
+                                            registry_dir=registry_dir)
+    loaded = model_registry.load_model(MODEL_NAME, registry_dir=registry_dir)
+
+    np.testing.assert_allclose(loaded.predict(future)['yhat'].values,
+                               station_model.predict(future)['yhat'].values, rtol=1e-6)
+    metadata = model_registry.load_metadata(MODEL_NAME, registry_dir=registry_dir)
+    assert metadata['version'] == version
+    assert metadata['data_hash'] == model_registry.data_hash(daily_rides)
+    assert metadata['metrics'] == {'mae': 1.5}
+
+
+def test_versions_are_stable(station_model, refitted_station_model, daily_rides, registry_dir):
+    version = model_registry.register_model(station_model, MODEL_NAME, daily_rides,
+                                            registry_dir=registry_dir)
+    assert model_registry.register_model(station_model, MODEL_NAME, daily_rides,
+                                         registry_dir=registry_dir) == version
+    assert model_registry.serialize_model(station_model) == model_registry.serialize_model(
+        model_registry.load_model(MODEL_NAME, registry_dir=registry_dir))
+
+    new_version = model_registry.register_model(refitted_station_model, MODEL_NAME, daily_rides,
+                                                registry_dir=registry_dir)
+    assert new_version != version
+    assert model_registry.list_versions(MODEL_NAME, registry_dir)['version'].tolist() == [
+        version, new_version]
+    assert model_registry.load_metadata(MODEL_NAME, version, registry_dir)['version'] == version
+
+
+def test_unknown_models_raise_key_error(registry_dir):
+    with pytest.raises(KeyError):
+        model_registry.load_model('station_999', registry_dir=registry_dir)
@@ -0,0 +1,38 @@
+'''
+Tests of the Covid phase indicators computed from the phase calendar.
+'''
+import pandas as pd
+import pytest
+import phase_calendar
+import prophet_model
+
+# Boundary days of Chicago's phases with the phase the original per-row helpers
+# assigned them (None outside every phase)
+BOUNDARY_DAYS = [('2020-03-16', None), ('2020-03-17', 'phase_one'), ('2020-04-30', 'phase_one'),
+                 ('2020-05-01', 'phase_two'), ('2020-06-02', 'phase_two'),
+                 ('2020-06-03', 'phase_three'), ('2020-06-25', 'phase_three'),
+                 ('2020-06-26', 'phase_four'), ('2020-08-31', 'phase_four'),
+                 ('2020-09-01', None)]
+
+
+@pytest.mark.parametrize('day, phase', BOUNDARY_DAYS)
+def test_indicators_match_the_phase_boundaries(calendar, day, phase):
+    indicators = phase_calendar.phase_indicators([day], calendar).iloc[0]
+
+    assert indicators['covid'] == (day >= '2020-03-17')
+    assert indicators['precovid'] != indicators['covid']
+    for name, _, _ in calendar['phases']:
+        assert indicators[name] == (name == phase)
+        assert indicators['not_' + name] != indicators[name]
+
+
+def test_phase_regressors_cover_every_condition(calendar):
+    dataframe = pd.DataFrame({'ds': pd.date_range('2020-03-10', '2020-07-10')})
+    dataframe = prophet_model.add_phase_regressors(dataframe, calendar)
+
+    conditions = prophet_model.phase_conditions(calendar)
+    assert conditions == ['covid', 'precovid', 'phase_one', 'not_phase_one', 'phase_two',
+                          'not_phase_two', 'phase_three', 'not_phase_three']
+    assert dataframe[conditions].dtypes.eq(bool).all()
+    assert dataframe['phase_one'].sum() == 45
+    assert (dataframe['covid'] == (dataframe['ds'] >= '2020-03-17')).all()
@@ -0,0 +1,80 @@
+'''
+Tests of the pipeline's content-hash caching with stand-in stages.
+'''
+import os
+import shutil
+import pytest
+import pipeline
+
+
+def source_watermarks(config):
+    '''
+    Reads the stand-in source's row count, failing while it is offline.
+    '''
+    if not os.path.exists(config['source_path']):
+        raise ConnectionError('The source is offline')
+    with open(config['source_path'], encoding='utf-8') as file:
+        return {'trips': [int(file.read()), 'max_start_time']}
+
+
+def extract(config):
+    '''
+    Copies the stand-in source.
+    '''
+    shutil.copy(config['source_path'], 'raw.txt')
+
+
+def fit(config): # pylint: disable=unused-argument
+    '''
+    Copies the extracted rows.
+    '''
+    shutil.copy('raw.txt', 'fit.txt')
+
+
+def run_stages(**options):
+    '''
+    Runs an extract and a fit stage and returns the status of each.
+    '''
+    stages = [pipeline.Stage('extract', extract, outputs=['raw.txt'], inputs=source_watermarks),
+              pipeline.Stage('fit', fit, upstream=['extract'], outputs=['fit.txt'])]
+    results = pipeline.run_pipeline(config={'source_path': 'source.txt'}, stages=stages,
+                                    max_workers=2, **options)
+
+    return dict(zip(results['stage'], results['status']))
+
+
+@pytest.fixture
+def source(scratch_store):
+    '''
+    A stand-in source table with 10 rows.
+    '''
+    path = scratch_store / 'source.txt'
+    path.write_text('10')
+
+    return path
+
+
+def test_unchanged_sources_are_skipped(source): # pylint: disable=unused-argument
+    assert run_stages() == {'extract': 'ran', 'fit': 'ran'}
+    assert run_stages() == {'extract': 'skipped', 'fit': 'skipped'}
+
+
+def test_new_source_rows_are_extracted_by_default(source):
+    run_stages()
+    source.write_text('11')
+
+    assert run_stages() == {'extract': 'ran', 'fit': 'ran'}
+
+
+def test_refresh_sources_extracts_again(source): # pylint: disable=unused-argument
+    run_stages()
+
+    # The extracted rows are unchanged, so the stages downstream are still skipped
+    assert run_stages(refresh_sources=True) == {'extract': 'ran', 'fit': 'skipped'}
+
+
+def test_offline_sources_use_recorded_watermarks(source):
+    run_stages()
+    source.unlink()
+
+    assert run_stages() == {'extract': 'skipped', 'fit': 'skipped'}
@@ -0,0 +1,36 @@
+'''
+Tests of the point forecasts computed from fitted Prophet parameters.
+'''
+import numpy as np
+import pytest
+import point_forecast
+import prophet_model
+
+
+@pytest.fixture(scope='module')
+def future(calendar):
+    '''
+    The days of the forecast window with their condition columns.
+    '''
+    return prophet_model.forecast_dataframe(calendar)
+
+
+def test_point_forecast_many_matches_predict(station_model, future):
+    expected = station_model.predict(future)['yhat'].values
+    forecasts = point_forecast.point_forecast_many({'first': station_model,
+                                                    'second': station_model}, future)
+
+    assert list(forecasts.columns) == ['ds', 'first', 'second']
+    np.testing.assert_allclose(forecasts['first'].values, expected, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(forecasts['second'].values, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_point_forecast_samples_cached_intervals(station_model, future):
+    forecast = point_forecast.point_forecast(station_model, future, interval_samples=50)
+
+    assert (forecast['yhat_lower'] <= forecast['yhat_upper']).all()
+    assert forecast['yhat_lower'].mean() < forecast['yhat'].mean() < forecast[
+        'yhat_upper'].mean()
+    assert point_forecast.sample_intervals(station_model, future, 50) is (
+        point_forecast.sample_intervals(station_model, future, 50))
+    assert station_model.uncertainty_samples == prophet_model.Prophet().uncertainty_samples
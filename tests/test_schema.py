@@ -0,0 +1,42 @@
+'''
+Tests of the compact dtypes enforced on the Divvy tables.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import schema
+
+# A long station id of Data/Divvy_Bicycle_Stations.csv
+LONG_STATION_ID = 1436495105198659242
+
+
+def test_station_ids_are_int16_categories():
+    station_ids = schema.compact_station_ids(pd.Series([5, 35, 700, 35]))
+
+    assert station_ids.cat.categories.dtype == 'int16'
+    assert station_ids.astype('int64').tolist() == [5, 35, 700, 35]
+
+
+@pytest.mark.parametrize('station_id, dtype', [(40000, 'int32'), (LONG_STATION_ID, 'int64')])
+def test_out_of_range_station_ids_are_kept(station_id, dtype):
+    station_ids = schema.compact_station_ids(pd.Series([5, station_id], dtype='int64'))
+
+    assert station_ids.cat.categories.dtype == dtype
+    assert station_ids.astype('int64').tolist() == [5, station_id]
+
+
+def test_compact_categories_are_not_narrowed_again():
+    station_ids = schema.compact_station_ids(pd.Series([5, LONG_STATION_ID], dtype='int64'))
+
+    assert schema.compact_station_ids(station_ids).astype('int64').tolist() == [
+        5, LONG_STATION_ID]
+
+
+def test_enforce_dtypes_keeps_long_station_ids():
+    trips = pd.DataFrame({'from_station_id': np.array([LONG_STATION_ID, 2], dtype='int64'),
+                          'month': [1, 2]})
+    compact = schema.enforce_dtypes(trips)
+
+    assert np.asarray(compact['from_station_id']).astype('int64').tolist() == [
+        LONG_STATION_ID, 2]
+    assert compact['month'].dtype == 'int8'
@@ -0,0 +1,46 @@
+'''
+Tests of snapping dockless trips to the nearest station.
+'''
+import numpy as np
+import pandas as pd
+import schema
+import station_snapping
+
+# A long station id of Data/Divvy_Bicycle_Stations.csv
+LONG_STATION_ID = 1436495105198659242
+
+
+def test_snaps_to_nearest_station_within_cutoff():
+    snapper = station_snapping.StationSnapper([5, 35], [41.90, 41.95], [-87.65, -87.65])
+    station_ids, distances = snapper.snap([41.9001, 41.9499, 41.925, np.nan],
+                                          [-87.65, -87.65, -87.65, -87.65])
+
+    assert station_ids[:2].tolist() == [5, 35]
+    assert np.isnan(station_ids[2:]).all()
+    assert (distances[:2] < station_snapping.MAX_SNAP_DISTANCE).all()
+
+
+def test_long_id_stations_are_not_snapped_to(tmp_path):
+    path = tmp_path / 'stations.csv'
+    pd.DataFrame({'ID': [5, LONG_STATION_ID], 'Latitude': [41.90, 41.95],
+                  'Longitude': [-87.65, -87.65]}).to_csv(path, index=False)
+    snapper = station_snapping.load_station_snapper(str(path))
+    trips = pd.DataFrame({'start_station_id': [np.nan, np.nan],
+                          'start_lat': [41.9001, 41.9501], 'start_lng': [-87.65, -87.65]})
+
+    snapped = station_snapping.snap_trips(trips, snapper)
+
+    assert snapped['start_station_id'].iloc[0] == 5
+    assert np.isnan(snapped['start_station_id'].iloc[1])
+
+
+def test_station_list_ids_fit_trip_ids():
+    snapper = station_snapping.load_station_snapper()
+    stations = pd.read_csv(station_snapping.STATIONS_PATH)
+    long_stations = stations[stations['ID'] > station_snapping.MAX_STATION_ID]
+    station_ids, _ = snapper.snap(long_stations['Latitude'], long_stations['Longitude'])
+
+    assert len(long_stations) > 0
+    snapped_ids = station_ids[~np.isnan(station_ids)]
+    assert schema.station_id_dtype(snapped_ids) == 'int16'
+    assert not np.isin(snapped_ids, long_stations['ID'].astype(float)).any()
@@ -0,0 +1,10 @@
+'''
+Tests of the hyperparameter search.
+'''
+import pytest
+import tuning
+
+
+def test_unknown_strategy_lists_the_valid_ones(daily_rides):
+    with pytest.raises(ValueError, match='grid, random, successive_halving'):
+        tuning.search(daily_rides, strategy='bayesian')
@@ -0,0 +1,272 @@
+'''
+This module searches the Prophet priors and Fourier orders with grid, random or
+successive-halving search. Candidates are scored with the parallel, cached
+backtest, poor candidates are pruned after the first folds, and the results are
+saved as a leaderboard with timings.
+'''
+import itertools
+import math
+import random
+import time
+import pandas as pd
+import backtesting
+import prophet_model
+import storage
+
+# Values searched for each hyperparameter
+SEARCH_SPACE = {'seasonality_prior_scale': [0.1, 1.0, 10.0, 20.0],
+                'changepoint_prior_scale': [0.01, 0.05, 0.2, 0.5],
+                'covid_fourier_order': [3, 5, 10],
+                'precovid_fourier_order': [3, 5],
+                'phase_fourier_order': [3, 5, 8]}
+
+# Table holding the latest leaderboard
+LEADERBOARD_TABLE = 'tuning_leaderboard'
+
+# Nominal width of the Prophet and baseline prediction intervals, which the coverage
+# of a well calibrated candidate matches
+INTERVAL_WIDTH = 0.8
+
+
+def grid_candidates(search_space=None):
+    '''
+    A function that lists every combination of the search space.
+
+    Parameters
+    ----------
+    search_space : A dictionary of values per hyperparameter (defaults to SEARCH_SPACE).
+
+    Returns
+    -------
+    A list of hyperparameter dictionaries.
+    '''
+    search_space = search_space or SEARCH_SPACE
+    names = sorted(search_space)
+
+    return [dict(zip(names, values))
+            for values in itertools.product(*(search_space[name] for name in names))]
+
+
+def random_candidates(number_of_candidates, search_space=None, seed=0):
+    '''
+    A function that samples distinct combinations of the search space.
+
+    Parameters
+    ----------
+    number_of_candidates : The number of combinations to sample.
+    search_space : A dictionary of values per hyperparameter (defaults to SEARCH_SPACE).
+    seed : The random seed.
+
+    Returns
+    -------
+    A list of hyperparameter dictionaries.
+    '''
+    candidates = grid_candidates(search_space)
+
+    return random.Random(seed).sample(candidates, min(number_of_candidates, len(candidates)))
+
+
+def candidate_score(value, metric):
+    '''
+    A helper function that turns an overall metric into a score to minimize.
+
+    Parameters
+    ----------
+    value : The overall metric.
+    metric : 'mae', 'rmse', 'mape' or 'coverage'.
+
+    Returns
+    -------
+    The metric itself, or for coverage its distance from the nominal interval width.
+    '''
+    if metric == 'coverage':
+        return abs(value - INTERVAL_WIDTH)
+
+    return value
+
+
+def evaluate_candidates(dataframe, candidates, cutoffs, metric='mae', **backtest_options):
+    '''
+    A function that scores candidates on the given cutoffs, fitting the folds of
+    every candidate in one process pool. Folds evaluated before are loaded from
+    the backtest cache.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    candidates : A list of hyperparameter dictionaries.
+    cutoffs : The cutoffs to evaluate.
+    metric : The overall metric ranked on ('mae', 'rmse', 'mape' or 'coverage').
+    backtest_options : Other keyword arguments passed to backtesting.backtest_candidates.
+
+    Returns
+    -------
+    A list with every candidate's metric, score and share of the seconds spent.
+    '''
+    if not candidates:
+        return []
+
+    started = time.perf_counter()
+    results = backtesting.backtest_candidates(dataframe, candidates, cutoffs=cutoffs,
+                                              **backtest_options)
+    seconds = (time.perf_counter() - started) / len(candidates)
+
+    return [(progress.iloc[-1][metric], candidate_score(progress.iloc[-1][metric], metric),
+             seconds) for _, _, progress in results]
+
+
+def successive_halving(dataframe, candidates, cutoffs, eta=3, min_folds=1, metric='mae',
+                       **backtest_options):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that scores every candidate on the first folds, keeps the best
+    1/eta of them, and repeats on eta times more folds until one candidate is left
+    or every fold is used.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    candidates : A list of hyperparameter dictionaries.
+    cutoffs : The cutoffs in the order they are added to the evaluation.
+    eta : The fraction of candidates dropped at each rung.
+    min_folds : The number of folds in the first rung.
+    metric : The overall metric ranked on.
+    backtest_options : Other keyword arguments passed to backtesting.backtest_candidates.
+
+    Returns
+    -------
+    A list of result dictionaries, one per candidate.
+    '''
+    results = [{'candidate': candidate, 'value': None, 'score': None, 'folds': 0,
+                'seconds': 0.0, 'pruned': False} for candidate in candidates]
+    survivors = list(range(len(candidates)))
+    folds = min(min_folds, len(cutoffs))
+
+    while True:
+        # Every survivor's folds of the rung share one process pool
+        scores = evaluate_candidates(dataframe, [candidates[index] for index in survivors],
+                                     cutoffs[:folds], metric, **backtest_options)
+        for index, (value, score, seconds) in zip(survivors, scores):
+            results[index].update(value=value, score=score, folds=folds,
+                                  seconds=results[index]['seconds'] + seconds)
+
+        if folds >= len(cutoffs) or len(survivors) == 1:
+            return results
+
+        # Keep the best 1/eta of the candidates for the next rung
+        survivors.sort(key=lambda index: results[index]['score'])
+        for index in survivors[math.ceil(len(survivors) / eta):]:
+            results[index]['pruned'] = True
+        survivors = survivors[:math.ceil(len(survivors) / eta)]
+        folds = min(folds * eta, len(cutoffs))
+
+
+def pruned_search(dataframe, candidates, cutoffs, min_folds=1, tolerance=0.1, metric='mae',
+                  **backtest_options):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that scores every candidate on the first folds, prunes the
+    candidates worse than the best one on the same folds by more than the
+    tolerance, and scores the others on every fold. The folds of each step share
+    one process pool.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    candidates : A list of hyperparameter dictionaries.
+    cutoffs : The cutoffs in the order they are added to the evaluation.
+    min_folds : The number of folds scored before deciding to prune.
+    tolerance : How much worse than the best partial score a candidate may be.
+    metric : The overall metric ranked on.
+    backtest_options : Other keyword arguments passed to backtesting.backtest_candidates.
+
+    Returns
+    -------
+    A list of result dictionaries, one per candidate.
+    '''
+    results = [{'candidate': candidate, 'value': value, 'score': score, 'folds': min_folds,
+                'seconds': seconds, 'pruned': False}
+               for candidate, (value, score, seconds) in zip(candidates, evaluate_candidates(
+                   dataframe, candidates, cutoffs[:min_folds], metric, **backtest_options))]
+    if not results:
+        return results
+
+    best_partial_score = min(result['score'] for result in results)
+    for result in results:
+        result['pruned'] = result['score'] > best_partial_score * (1 + tolerance)
+    survivors = [result for result in results if not result['pruned']]
+
+    # The first folds are reused from the cache
+    scores = evaluate_candidates(dataframe, [result['candidate'] for result in survivors],
+                                 cutoffs, metric, **backtest_options)
+    for result, (value, score, seconds) in zip(survivors, scores):
+        result.update(value=value, score=score, folds=len(cutoffs),
+                      seconds=result['seconds'] + seconds)
+
+    return results
+
+
+def search(dataframe, strategy='successive_halving', number_of_candidates=50, search_space=None,
+           metric='mae', eta=3, min_folds=1, tolerance=0.1, seed=0, **backtest_options):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''
+    A function that tunes the Prophet hyperparameters and saves the leaderboard.
+
+    Parameters
+    ----------
+    dataframe : A dataframe containing Divvy ride share data at the daily level.
+    strategy : 'grid', 'random' or 'successive_halving'.
+    number_of_candidates : The number of sampled candidates for random and successive
+    halving search.
+    search_space : A dictionary of values per hyperparameter (defaults to SEARCH_SPACE).
+    metric : The overall metric ranked on ('mae', 'rmse', 'mape', or 'coverage', which is
+    ranked on its distance from INTERVAL_WIDTH).
+    eta : The fraction of candidates dropped at each successive halving rung.
+    min_folds : The number of folds scored before the first pruning decision.
+    tolerance : How much worse than the best partial score a grid or random candidate
+    may be before it is pruned.
+    seed : The random seed for sampling candidates.
+    backtest_options : Other keyword arguments passed to backtesting.backtest_candidates,
+    such as initial, period, horizon, max_workers and cache_dir.
+
+    Returns
+    -------
+    The leaderboard dataframe sorted from best to worst.
+    '''
+    # The candidates and search of every strategy, run once the cutoffs are known
+    strategies = {
+        'grid': lambda: pruned_search(dataframe, grid_candidates(search_space), cutoffs,
+                                      min_folds, tolerance, metric, **backtest_options),
+        'random': lambda: pruned_search(
+            dataframe, random_candidates(number_of_candidates, search_space, seed), cutoffs,
+            min_folds, tolerance, metric, **backtest_options),
+        'successive_halving': lambda: successive_halving(
+            dataframe, random_candidates(number_of_candidates, search_space, seed), cutoffs,
+            eta, min_folds, metric, **backtest_options)}
+    if strategy not in strategies:
+        raise ValueError('Unknown search strategy ' + str(strategy) + ', use one of ' +
+                         ', '.join(strategies))
+
+    windows = {name: backtest_options[name] for name in ['initial', 'period', 'horizon']
+               if name in backtest_options}
+
+    # The most recent folds are scored first
+    cutoffs = backtesting.backtest_cutoffs(dataframe, calendar=backtest_options.get('calendar'),
+                                           **windows)[::-1]
+
+    results = strategies[strategy]()
+
+    leaderboard = pd.DataFrame(
+        [dict(dict(prophet_model.DEFAULT_HYPERPARAMETERS, **result['candidate']),
+              **{metric: result['value'], 'score': result['score'], 'folds': result['folds'],
+                 'seconds': result['seconds'], 'pruned': result['pruned'],
+                 'strategy': strategy})
+         for result in results])
+
+    # Candidates scored on every fold rank ahead of pruned ones
+    leaderboard = leaderboard.sort_values(by=['folds', 'score'], ascending=[False, True],
+                                          ignore_index=True)
+    leaderboard.insert(0, 'rank', range(1, len(leaderboard) + 1))
+    storage.save_dataframe(leaderboard, LEADERBOARD_TABLE)
+
+    return leaderboard
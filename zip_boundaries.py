@@ -0,0 +1,221 @@
+'''
+This module assigns coordinates to zip codes offline. Zip code boundary polygons
+are loaded from a local GeoJSON file into an STRtree spatial index, and whole
+arrays of coordinates are matched to the polygons containing them with a single
+vectorized query. Repeated coordinates, such as trips starting at the same
+station, are looked up once.
+
+The boundary file is not shipped with the repository; fetch it once with
+
+    python zip_boundaries.py --download
+'''
+import argparse
+import functools
+import json
+import os
+import timeit
+import urllib.request
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+# Zip code boundaries of Chicago, e.g. the "Boundaries - ZIP Codes" GeoJSON export
+# of the Chicago Data Portal
+BOUNDARIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data',
+                               'chicago_zip_code_boundaries.geojson')
+
+# GeoJSON export of the Chicago Data Portal's "Boundaries - ZIP Codes" dataset
+BOUNDARIES_URL = ('https://data.cityofchicago.org/api/geospatial/gdcf-axmw'
+                  '?method=export&format=GeoJSON')
+
+# Feature property holding the zip code
+ZIP_PROPERTY = 'zip'
+
+
+class ZipCodeIndex: # pylint: disable=too-few-public-methods
+    '''
+    Finds the zip code polygon containing each of many coordinates.
+
+    Parameters
+    ----------
+    polygons : A sequence of shapely polygons or multipolygons.
+    polygon_zip_codes : The zip code of every polygon.
+    '''
+    def __init__(self, polygons, polygon_zip_codes):
+        self.polygons = np.asarray(polygons, dtype=object)
+        self.zip_codes = np.asarray(polygon_zip_codes, dtype=float)
+        self.tree = shapely.STRtree(self.polygons)
+
+    def query(self, latitudes, longitudes):
+        '''
+        Returns the zip code of every coordinate. Coordinates on a shared boundary
+        take the first matching polygon.
+
+        Parameters
+        ----------
+        latitudes, longitudes : Arrays of coordinates.
+
+        Returns
+        -------
+        A float array of zip codes, NaN for missing coordinates and coordinates
+        outside every polygon.
+        '''
+        coordinates = np.column_stack([np.asarray(longitudes, dtype=float),
+                                       np.asarray(latitudes, dtype=float)])
+        result = np.full(len(coordinates), np.nan)
+        valid = ~np.isnan(coordinates).any(axis=1)
+
+        # Query every distinct coordinate once
+        distinct, inverse = np.unique(coordinates[valid], axis=0, return_inverse=True)
+        point_index, polygon_index = self.tree.query(shapely.points(distinct),
+                                                     predicate='intersects')
+        first_match = np.unique(point_index, return_index=True)[1]
+        distinct_zip_codes = np.full(len(distinct), np.nan)
+        distinct_zip_codes[point_index[first_match]] = self.zip_codes[polygon_index[first_match]]
+
+        result[valid] = distinct_zip_codes[inverse.ravel()]
+
+        return result
+
+
+def download_boundaries(url=BOUNDARIES_URL, path=BOUNDARIES_PATH):
+    '''
+    A function that downloads the zip code boundary file, replacing the file only
+    once the download is complete and holds a feature collection.
+
+    Parameters
+    ----------
+    url : The GeoJSON export to download.
+    path : The GeoJSON file to write.
+
+    Returns
+    -------
+    The number of zip code features downloaded.
+    '''
+    with urllib.request.urlopen(url) as response:
+        boundaries = json.load(response)
+    number_of_features = len(boundaries['features'])
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(boundaries, file)
+    os.replace(temporary_path, path)
+
+    return number_of_features
+
+
+def load_zip_polygons(path=BOUNDARIES_PATH, zip_property=ZIP_PROPERTY):
+    '''
+    A function that reads zip code polygons from a GeoJSON feature collection.
+
+    Parameters
+    ----------
+    path : The GeoJSON file.
+    zip_property : The feature property holding the zip code.
+
+    Returns
+    -------
+    A list of shapely geometries and a list of their zip codes.
+    '''
+    with open(path, encoding='utf-8') as file:
+        features = json.load(file)['features']
+
+    return ([shape(feature['geometry']) for feature in features],
+            [int(feature['properties'][zip_property]) for feature in features])
+
+
+@functools.lru_cache(maxsize=None)
+def load_zip_code_index(path=BOUNDARIES_PATH, zip_property=ZIP_PROPERTY):
+    '''
+    A function that builds the spatial index of a boundary file once per process.
+
+    Parameters
+    ----------
+    path : The GeoJSON file.
+    zip_property : The feature property holding the zip code.
+
+    Returns
+    -------
+    A ZipCodeIndex.
+    '''
+    return ZipCodeIndex(*load_zip_polygons(path, zip_property))
+
+
+def zip_codes(latitudes, longitudes, path=BOUNDARIES_PATH):
+    '''
+    A function that assigns coordinates to the zip code polygons containing them.
+
+    Parameters
+    ----------
+    latitudes, longitudes : Arrays of coordinates.
+    path : The GeoJSON file of zip code boundaries.
+
+    Returns
+    -------
+    A float array of zip codes, NaN outside every polygon.
+    '''
+    return load_zip_code_index(path).query(latitudes, longitudes)
+
+
+def assign_trip_zip_codes(trip_data, path=BOUNDARIES_PATH):
+    '''
+    A function that adds the zip code of every trip's start coordinate.
+
+    Parameters
+    ----------
+    trip_data : Trip data with start_lat and start_lng columns.
+    path : The GeoJSON file of zip code boundaries.
+
+    Returns
+    -------
+    The trip data with a start_zip_code column, NaN where the start is unknown.
+    '''
+    trip_data = trip_data.copy()
+    trip_data['start_zip_code'] = zip_codes(trip_data['start_lat'].values,
+                                            trip_data['start_lng'].values, path)
+
+    return trip_data
+
+
+def benchmark_zip_codes(number_of_points=1000000, path=BOUNDARIES_PATH, distinct_fraction=1.0):
+    '''
+    A micro-benchmark of zip code assignment for random coordinates inside the
+    bounds of the boundary file.
+
+    Parameters
+    ----------
+    number_of_points : The number of coordinates to assign.
+    path : The GeoJSON file of zip code boundaries.
+    distinct_fraction : The share of distinct coordinates among the points.
+
+    Returns
+    -------
+    A dictionary with the seconds taken and the points assigned per minute.
+    '''
+    index = load_zip_code_index(path)
+    min_lng, min_lat, max_lng, max_lat = shapely.total_bounds(index.polygons)
+
+    rng = np.random.default_rng(0)
+    number_of_distinct = max(int(number_of_points * distinct_fraction), 1)
+    latitudes = rng.uniform(min_lat, max_lat, number_of_distinct)
+    longitudes = rng.uniform(min_lng, max_lng, number_of_distinct)
+    sample = rng.integers(0, number_of_distinct, number_of_points)
+
+    seconds = min(timeit.repeat(lambda: index.query(latitudes[sample], longitudes[sample]),
+                                number=1, repeat=3))
+
+    return {'number_of_points': number_of_points,
+            'distinct_fraction': distinct_fraction,
+            'seconds': seconds,
+            'points_per_minute': number_of_points / seconds * 60}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Match coordinates to Chicago zip codes.')
+    parser.add_argument('--download', action='store_true',
+                        help='download the zip code boundary file instead of benchmarking')
+    arguments = parser.parse_args()
+    if arguments.download:
+        print(download_boundaries(), 'zip codes written to', BOUNDARIES_PATH)
+    else:
+        print(benchmark_zip_codes())